@@ -0,0 +1,124 @@
+"""ASGI entry point for asyncio servers, e.g.
+
+    uvicorn --app-dir api asgi:app --workers 4
+
+The Flask app runs on a thread pool the size of the database connection
+pool, so blocking SQLite work never stalls the event loop and every thread
+can get a connection without waiting.  Worker processes each open the same
+memory-mapped database file, so the data is in memory only once.
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Make the sibling modules importable however the server imports this one
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import warmup
+from pool import POOL_SIZE
+from index import app as wsgi_app
+
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='county-data')
+
+
+def build_environ(scope, body):
+    """Translate an ASGI HTTP scope and request body into a WSGI environ."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI wants the raw bytes of the path as a latin-1 string
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        # The whole body has been read, whether or not it was sent chunked
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name == 'CONTENT_TYPE':
+            environ[name] = value
+        elif f'HTTP_{name}' in environ:
+            environ[f'HTTP_{name}'] += ',' + value
+        else:
+            environ[f'HTTP_{name}'] = value
+    return environ
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Load the data in the background; health checks are answered
+            # right away and data requests wait until it is ready
+            warmup.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    loop = asyncio.get_running_loop()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def call_app():
+        result = wsgi_app(build_environ(scope, body), start_response)
+        return result, iter(result)
+
+    result, chunks = await loop.run_in_executor(executor, call_app)
+    try:
+        # Streamed responses produce their chunks lazily, so each one is
+        # fetched on the thread pool too
+        chunk = await loop.run_in_executor(executor, next, chunks, None)
+        await send({'type': 'http.response.start', 'status': started['status'],
+                    'headers': started['headers']})
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
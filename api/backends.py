@@ -0,0 +1,417 @@
+import bisect
+import functools
+import json
+import math
+import string
+import sys
+
+# Column order of the county_health_rankings table
+CHR_COLUMNS = (
+    'State', 'County', 'State_code', 'County_code', 'Year_span',
+    'Measure_name', 'Measure_id', 'Numerator', 'Denominator', 'Raw_value',
+    'Confidence_Interval_Lower_Bound', 'Confidence_Interval_Upper_Bound',
+    'Data_Release_Year', 'fipscode',
+)
+MEASURE_NAME = CHR_COLUMNS.index('Measure_name')
+_SELECT = ', '.join(CHR_COLUMNS)
+_ROW_END = 1 + len(CHR_COLUMNS)
+
+# Rows per (state, measure), per measure and overall that the database keeps
+# ready for the fallback lookups (see dataset.create_fallbacks); larger
+# limits query county_health_rankings directly
+FALLBACK_ROWS = 100
+
+# SQLite's NOCASE collation only folds ASCII letters
+_NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def nocase(value):
+    """Fold a string the same way SQLite's NOCASE collation does."""
+    return value.translate(_NOCASE) if isinstance(value, str) else value
+
+
+def _newest_first(year_start, year_end):
+    # Sort key matching ORDER BY Year_end DESC, Year_start DESC (reversed);
+    # SQLite sorts NULLs last in descending order
+    return (year_end is not None, year_end or 0, year_start is not None, year_start or 0)
+
+
+class SQLiteBackend:
+    """Serves the /county_data lookups with SQL queries.
+
+    The *_rows() methods return lists of row tuples in CHR_COLUMNS order.
+    Every query runs on a connection checked out of the pool only while
+    it runs, so requests in different threads don't wait for each other.  The
+    fallback lookups read the materialized fallback tables, and the short
+    lists in 404 bodies are read once here.
+    """
+
+    name = 'sqlite'
+    uses_fallback_tables = True
+
+    def __init__(self, db, pool, zip_cache_size=65536):
+        self.pool = pool
+        # ZIP -> county resolution is memoized per backend (i.e. per dataset)
+        self.resolve_zip = functools.lru_cache(maxsize=zip_cache_size)(self._resolve_zip)
+
+        self._state_measures = {}
+        self._measures = ()
+        for row in db.execute('SELECT * FROM fallback_measures ORDER BY scope, key, position'):
+            if row['scope'] == 'state':
+                self._state_measures.setdefault(row['key'], []).append(row['Measure_name'])
+            else:
+                self._measures += (row['Measure_name'],)
+        self._sample_zips = [row['zip'] for row in db.execute('SELECT zip FROM zip_county LIMIT 100')]
+
+    def _fetchall(self, sql, params=()):
+        with self.pool.connection() as db:
+            return db.execute(sql, params).fetchall()
+
+    def _resolve_zip(self, zip_code):
+        """Return (county_key, state_key) of the ZIP's first county, or None."""
+        rows = self._fetchall(
+            'SELECT county_key, state_key FROM zip_county WHERE zip = ? LIMIT 1', (zip_code,)
+        )
+        return (rows[0]['county_key'], rows[0]['state_key']) if rows else None
+
+    def _tuples(self, sql, params):
+        # Skip the connection's dict_factory; callers pair the tuples with
+        # CHR_COLUMNS only when they serialize them.  The rows are all read
+        # before the connection goes back to the pool, so a slow client
+        # reading a stream never holds one.
+        with self.pool.connection() as db:
+            cursor = db.cursor()
+            cursor.row_factory = None
+            return cursor.execute(sql, params).fetchall()
+
+    def find_zip(self, zip_code):
+        return self._fetchall('SELECT * FROM zip_county WHERE zip = ?', (zip_code,))
+
+    def find_zips(self, zip_codes):
+        """Return {zip: [zip rows]} for every zip in zip_codes that exists."""
+        found = {}
+        rows = self._fetchall(
+            'SELECT * FROM zip_county WHERE zip IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(zip_codes)),)
+        )
+        for row in rows:
+            found.setdefault(row['zip'], []).append(row)
+        return found
+
+    def county_rows(self, county_key, measure_name, limit):
+        return self._tuples(f'''
+            SELECT DISTINCT {_SELECT}
+            FROM county_health_rankings
+            WHERE county_key = ?
+            AND Measure_name = ?
+            ORDER BY Year_end DESC, Year_start DESC
+            LIMIT ?
+        ''', (county_key, measure_name, limit))
+
+    def county_series(self, county_key, measure_name, year_from, year_to, limit):
+        """county_rows() restricted to rows whose Year_end is in [year_from, year_to].
+
+        A range scan of idx_chr_county, which already orders each county's
+        rows of a measure by year.
+        """
+        return self._tuples(f'''
+            SELECT DISTINCT {_SELECT}
+            FROM county_health_rankings
+            WHERE county_key = ?
+            AND Measure_name = ?
+            AND Year_end BETWEEN ? AND ?
+            ORDER BY Year_end DESC, Year_start DESC
+            LIMIT ?
+        ''', (county_key, measure_name, year_from, year_to, limit))
+
+    def county_profile(self, county_key, measure_names, limit):
+        """county_rows() for many measures of one county: {measure_name: rows}.
+
+        One scan of the county's entries in idx_chr_county, already in
+        measure and year order; the newest `limit` rows of each measure are
+        kept as they are read.
+        """
+        wanted = {}
+        for name in measure_names:
+            wanted.setdefault(nocase(name), []).append(name)
+        rows = self._tuples(f'''
+            SELECT DISTINCT {_SELECT}, Year_start, Year_end
+            FROM county_health_rankings
+            WHERE county_key = ?
+            AND Measure_name IN (SELECT value FROM json_each(?))
+            ORDER BY Measure_name, Year_end DESC, Year_start DESC
+        ''', (county_key, json.dumps(list(measure_names))))
+        grouped = {}
+        for row in rows:
+            group = grouped.setdefault(nocase(row[MEASURE_NAME]), [])
+            if len(group) < limit:
+                group.append(row[:len(CHR_COLUMNS)])
+        return {name: rows for measure, rows in grouped.items() for name in wanted[measure]}
+
+    def _fallback_rows(self, scope, key, measure_name, limit):
+        return self._tuples(f'''
+            SELECT {_SELECT}
+            FROM fallback_rows
+            WHERE scope = ? AND key = ? AND measure = ?
+            ORDER BY position
+            LIMIT ?
+        ''', (scope, key, measure_name, limit))
+
+    def state_rows(self, state_key, measure_name, limit):
+        if limit <= FALLBACK_ROWS:
+            return self._fallback_rows('state', state_key, measure_name, limit)
+        return self._tuples(f'''
+            SELECT DISTINCT {_SELECT}
+            FROM county_health_rankings
+            WHERE state_key = ?
+            AND Measure_name = ?
+            ORDER BY Year_end DESC, Year_start DESC
+            LIMIT ?
+        ''', (state_key, measure_name, limit))
+
+    def county_rows_many(self, county_keys, measure_name, limit):
+        """county_rows() for many counties at once: {county_key: rows}."""
+        return self._rows_by_key('county_key', county_keys, measure_name, limit)
+
+    def state_rows_many(self, state_keys, measure_name, limit):
+        """state_rows() for many states at once: {state_key: rows}."""
+        if limit > FALLBACK_ROWS:
+            return self._rows_by_key('state_key', state_keys, measure_name, limit)
+        rows = self._tuples(f'''
+            SELECT key, {_SELECT}
+            FROM fallback_rows
+            WHERE scope = 'state' AND key IN (SELECT value FROM json_each(?))
+            AND measure = ? AND position <= ?
+            ORDER BY key, position
+        ''', (json.dumps(list(state_keys)), measure_name, limit))
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row[0], []).append(row[1:])
+        return grouped
+
+    def _rows_by_key(self, key_column, keys, measure_name, limit):
+        # One query for all keys; the window keeps the newest `limit`
+        # distinct rows per key, like the LIMIT in the single-key queries.
+        rows = self._tuples(f'''
+            SELECT *
+            FROM (
+                SELECT d.*, ROW_NUMBER() OVER (
+                    PARTITION BY d._key ORDER BY d.Year_end DESC, d.Year_start DESC
+                ) AS _rank
+                FROM (
+                    SELECT DISTINCT {key_column} AS _key, {_SELECT}, Year_start, Year_end
+                    FROM county_health_rankings
+                    WHERE {key_column} IN (SELECT value FROM json_each(?))
+                    AND Measure_name = ?
+                ) d
+            )
+            WHERE _rank <= ?
+            ORDER BY _key, _rank
+        ''', (json.dumps(list(keys)), measure_name, limit))
+        grouped = {}
+        for row in rows:
+            # (_key, *CHR_COLUMNS, Year_start, Year_end, _rank)
+            grouped.setdefault(row[0], []).append(row[1:_ROW_END])
+        return grouped
+
+    def measure_rows(self, measure_name, limit):
+        if limit <= FALLBACK_ROWS:
+            return self._fallback_rows('measure', '', measure_name, limit)
+        return self._tuples(f'''
+            SELECT DISTINCT {_SELECT}
+            FROM county_health_rankings
+            WHERE Measure_name = ?
+            ORDER BY Year_end DESC, Year_start DESC
+            LIMIT ?
+        ''', (measure_name, limit))
+
+    def any_rows(self, limit):
+        if limit <= FALLBACK_ROWS:
+            return self._fallback_rows('any', '', '', limit)
+        return self._tuples(f'''
+            SELECT DISTINCT {_SELECT}
+            FROM county_health_rankings
+            ORDER BY Year_end DESC, Year_start DESC
+            LIMIT ?
+        ''', (limit,))
+
+    def county_measures(self, county_key):
+        # Alphabetical, ignoring case; every backend lists them this way
+        rows = self._fetchall('''
+            SELECT DISTINCT Measure_name
+            FROM county_health_rankings
+            WHERE county_key = ?
+            ORDER BY Measure_name
+        ''', (county_key,))
+        return [row['Measure_name'] for row in rows]
+
+    def state_measures(self, state_key, limit):
+        return self._state_measures.get(state_key, [])[:limit]
+
+    def all_measures(self, limit):
+        return list(self._measures[:limit])
+
+    def sample_zips(self, limit):
+        return self._sample_zips[:limit]
+
+
+class MemoryBackend:
+    """Serves the /county_data lookups from dictionaries built at load time.
+
+    Every row of county_health_rankings is kept once as a tuple of interned
+    strings (in CHR_COLUMNS order) and grouped into presorted, de-duplicated
+    tuples per lookup key, so a query is a dict probe and a slice.  Like
+    SQLiteBackend, the *_rows() methods return row tuples.  Measure
+    names are folded like SQLite's NOCASE collation so the results match
+    SQLiteBackend's.
+    """
+
+    name = 'memory'
+    uses_fallback_tables = False  # keeps its own presorted groups
+
+    def __init__(self, db, pool=None):
+        # Only reads db here; lookups never touch SQLite
+        zips = {}
+        sample_zips = []
+        for row in db.execute('SELECT * FROM zip_county'):
+            row = dict(row)
+            zips.setdefault(row['zip'], []).append(row)
+            if len(sample_zips) < 100:
+                sample_zips.append(row['zip'])
+        self._zips = {z: tuple(rows) for z, rows in zips.items()}
+        self._resolved = {z: (rows[0]['county_key'], rows[0]['state_key']) for z, rows in zips.items()}
+        self._sample_zips = sample_zips
+
+        by_county = {}
+        by_state = {}
+        by_measure = {}
+        all_rows = {}
+        county_measures = {}
+        state_measures = {}
+        measures = {}
+
+        cursor = db.cursor()
+        cursor.row_factory = None
+        for row in cursor.execute(f'''
+            SELECT {_SELECT}, Year_start, Year_end, county_key, state_key
+            FROM county_health_rankings
+        '''):
+            row = tuple(sys.intern(v) if isinstance(v, str) else v for v in row)
+            year_start, year_end, county, state = row[-4:]
+            row = row[:-4]
+            if row in all_rows:
+                continue  # SELECT DISTINCT
+            all_rows[row] = _newest_first(year_start, year_end)
+
+            measure = nocase(row[MEASURE_NAME])
+            by_county.setdefault((county, measure), []).append(row)
+            by_state.setdefault((state, measure), []).append(row)
+            by_measure.setdefault(measure, []).append(row)
+            county_measures.setdefault(county, {}).setdefault(measure, row[MEASURE_NAME])
+            state_measures.setdefault(state, {}).setdefault(row[MEASURE_NAME], None)
+            measures.setdefault(row[MEASURE_NAME], None)
+
+        order = all_rows.__getitem__
+        self._by_county = self._presort(by_county, order)
+        # Each county group's Year_end values, negated so they ascend and
+        # can be bisected (rows without one sort last); equal values share
+        # one int object
+        neg_years = {}
+
+        def neg_year(row):
+            newest = all_rows[row]
+            value = -newest[1] if newest[0] else math.inf
+            return neg_years.setdefault(value, value)
+        self._county_years = {k: tuple(map(neg_year, rows)) for k, rows in self._by_county.items()}
+        # Every county's groups in one record, so a profile is one dict probe
+        self._profiles = {}
+        for (county, measure), rows in self._by_county.items():
+            self._profiles.setdefault(county, {})[measure] = rows
+        self._by_state = self._presort(by_state, order)
+        self._by_measure = self._presort(by_measure, order)
+        self._all_rows = tuple(sorted(all_rows, key=order, reverse=True))
+        # Alphabetical, ignoring case, like SQLiteBackend's ORDER BY
+        self._county_measures = {
+            k: tuple(v[measure] for measure in sorted(v)) for k, v in county_measures.items()
+        }
+        self._state_measures = {k: tuple(v) for k, v in state_measures.items()}
+        self._measures = tuple(measures)
+
+    @staticmethod
+    def _presort(groups, order):
+        # sorted() is stable, so rows with the same years keep file order
+        return {k: tuple(sorted(rows, key=order, reverse=True)) for k, rows in groups.items()}
+
+    def find_zip(self, zip_code):
+        return list(self._zips.get(zip_code, ()))
+
+    def resolve_zip(self, zip_code):
+        return self._resolved.get(zip_code)
+
+    def find_zips(self, zip_codes):
+        zips = self._zips
+        return {z: list(zips[z]) for z in zip_codes if z in zips}
+
+    def county_rows(self, county_key, measure_name, limit):
+        return self._by_county.get((county_key, nocase(measure_name)), ())[:limit]
+
+    def county_series(self, county_key, measure_name, year_from, year_to, limit):
+        key = (county_key, nocase(measure_name))
+        years = self._county_years.get(key, ())
+        start = bisect.bisect_left(years, -year_to)
+        end = min(bisect.bisect_right(years, -year_from, start), start + limit)
+        return self._by_county.get(key, ())[start:end]
+
+    def county_profile(self, county_key, measure_names, limit):
+        record = self._profiles.get(county_key, {})
+        profile = {}
+        for name in measure_names:
+            rows = record.get(nocase(name))
+            if rows:
+                profile[name] = rows[:limit]
+        return profile
+
+    def county_rows_many(self, county_keys, measure_name, limit):
+        measure = nocase(measure_name)
+        found = {}
+        for key in county_keys:
+            rows = self._by_county.get((key, measure))
+            if rows:
+                found[key] = rows[:limit]
+        return found
+
+    def state_rows_many(self, state_keys, measure_name, limit):
+        measure = nocase(measure_name)
+        found = {}
+        for key in state_keys:
+            rows = self._by_state.get((key, measure))
+            if rows:
+                found[key] = rows[:limit]
+        return found
+
+    def state_rows(self, state_key, measure_name, limit):
+        return self._by_state.get((state_key, nocase(measure_name)), ())[:limit]
+
+    def measure_rows(self, measure_name, limit):
+        return self._by_measure.get(nocase(measure_name), ())[:limit]
+
+    def any_rows(self, limit):
+        return self._all_rows[:limit]
+
+    def county_measures(self, county_key):
+        return list(self._county_measures.get(county_key, ()))
+
+    def state_measures(self, state_key, limit):
+        return list(self._state_measures.get(state_key, ())[:limit])
+
+    def all_measures(self, limit):
+        return list(self._measures[:limit])
+
+    def sample_zips(self, limit):
+        return self._sample_zips[:limit]
+
+
+BACKENDS = {
+    SQLiteBackend.name: SQLiteBackend,
+    MemoryBackend.name: MemoryBackend,
+}
@@ -0,0 +1,83 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# `encoded` maps a Content-Encoding to the compressed body, filled on demand
+CachedResponse = namedtuple('CachedResponse', 'status body mimetype etag expires encoded')
+
+
+class ResponseCache:
+    """Bounded LRU cache of serialized responses with an optional TTL.
+
+    Entries belong to one dataset version; the first lookup with a newer
+    version empties the cache, so a reload never serves stale bodies.
+    Requests still running on an older version (started before a reload)
+    neither read nor fill it.
+    """
+
+    def __init__(self, max_entries=4096, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        # True if entries of this version may be used; versions only grow
+        if self._version is None or version > self._version:
+            self._entries.clear()
+            self._version = version
+        return version == self._version
+
+    def get(self, key, version):
+        """Return the CachedResponse for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key) if self._check_version(version) else None
+            if entry is not None and entry.expires is not None and entry.expires < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, version, status, body, mimetype):
+        """Store a serialized response body and return its CachedResponse."""
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        entry = CachedResponse(status, body, mimetype, etag, expires, {})
+        if self.max_entries <= 0:
+            return entry
+        with self._lock:
+            if not self._check_version(version):
+                return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'dataset_version': self._version,
+            }
@@ -0,0 +1,825 @@
+import sqlite3
+import os
+import codecs
+import csv
+import itertools
+import json
+import logging
+import math
+import threading
+import time
+import urllib.parse
+from array import array
+
+from backends import BACKENDS, CHR_COLUMNS, FALLBACK_ROWS
+from geo import CountyIndex
+from ranks import Distributions
+from search import PlaceIndex
+from pool import POOL_SIZE, ConnectionPool
+from snapshot import Snapshot, SnapshotBackend, SnapshotError
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the source CSV files (overridable for local testing)
+CSV_DIR = os.environ.get(
+    'COUNTY_CSV_DIR',
+    os.path.join(os.path.dirname(__file__), '..', 'csv_data')
+)
+COUNTY_HEALTH_CSV = 'county_health_rankings.csv'
+ZIP_COUNTY_CSV = 'zip_county.csv'
+# Optional county geography for /county_data/nearby, as published by the
+# Census Bureau: the counties Gazetteer file (centroids) and the county
+# adjacency file.  Without them the endpoint is unavailable.
+COUNTY_GAZETTEER_FILE = 'county_gazetteer.txt'
+COUNTY_ADJACENCY_FILE = 'county_adjacency.txt'
+
+# Prebuilt database file produced by `python3 csv_to_sqlite.py --build`.  When
+# it exists it is opened directly instead of importing the CSVs at runtime.
+DB_PATH = os.environ.get(
+    'COUNTY_DB_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'csv_data', 'county_health.db')
+)
+# Snapshot file produced by `python3 csv_to_sqlite.py --snapshot`: the data
+# /county_data needs in a compact memory-mapped format (see snapshot.py)
+SNAPSHOT_PATH = os.environ.get(
+    'COUNTY_SNAPSHOT_PATH',
+    os.path.join(os.path.dirname(__file__), '..', 'csv_data', 'county_health.snap')
+)
+# Check the snapshot's checksum when opening it (reads the whole file)
+SNAPSHOT_VERIFY = os.environ.get('COUNTY_SNAPSHOT_VERIFY', '') == '1'
+# Which lookup backend serves /county_data: 'sqlite', 'memory' or 'snapshot';
+# by default the snapshot when its file exists and 'sqlite' otherwise
+BACKEND = os.environ.get('COUNTY_DATA_BACKEND', '')
+
+MMAP_SIZE = int(os.environ.get('COUNTY_DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+# CSV files are inserted this many rows at a time
+CSV_CHUNK_ROWS = 5000
+# detect_encoding() reads the files this many bytes at a time
+CSV_SNIFF_BYTES = 64 * 1024
+
+# Bumped whenever the table layout changes; prebuilt database files with a
+# different version are ignored (rebuild them with csv_to_sqlite.py --build)
+SCHEMA_VERSION = 5
+
+# How often (in seconds) a request may check the data files for changes; a
+# negative value turns hot reloading off
+RELOAD_CHECK_INTERVAL = float(os.environ.get('COUNTY_RELOAD_CHECK_INTERVAL', '5'))
+
+
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+# Suffixes that name the kind of county-equivalent rather than the county
+# itself.  ' city' is deliberately not here: Virginia and Maryland have both
+# e.g. "Baltimore County" and "Baltimore city", and they are different places.
+COUNTY_SUFFIXES = (
+    ' city and borough', ' census area', ' municipality', ' municipio',
+    ' borough', ' parish', ' county',
+)
+
+
+def normalize_county_name(name):
+    """Return the canonical form of a county name used for matching."""
+    name = ' '.join(name.split()).lower()
+    for suffix in COUNTY_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def county_key(fips, state, county):
+    """Return the join key shared by a county's zip_county and health rows.
+
+    This is the 5 digit county FIPS code whenever one is available, and
+    "<state>:<normalized county name>" otherwise.
+    """
+    fips = (fips or '').strip()
+    if fips.isdigit() and len(fips) <= 5 and int(fips) > 0:
+        return fips.zfill(5)
+    return f'{(state or "").strip().upper()}:{normalize_county_name(county or "")}'
+
+
+def state_key(key):
+    """Return the state part of a county_key()."""
+    return key[:2] if key[:1].isdigit() else key.split(':', 1)[0]
+
+
+def parse_year_span(span):
+    """Return (start, end) years of a Year_span like "2018-2020" or "2020".
+
+    Both are None if the span isn't in either form.
+    """
+    parts = (span or '').replace(' ', '').split('-')
+    if len(parts) <= 2 and all(part.isdigit() for part in parts):
+        return int(parts[0]), int(parts[-1])
+    return None, None
+
+
+def year_span_order(span):
+    """Sort key for Year_spans matching ORDER BY Year_end, Year_start."""
+    start, end = parse_year_span(span)
+    return (end is not None, end or 0, start or 0)
+
+
+def _real(value):
+    try:
+        number = float(value)
+    except ValueError:
+        return None  # '' and the odd non-numeric marker are stored as NULL
+    return number if math.isfinite(number) else None
+
+
+def _integer(value):
+    value = value.strip()
+    return int(value) if value.isdigit() else None
+
+
+def _health_row(row):
+    """Validate and convert one county_health_rankings CSV row, or return None."""
+    # State, County, State_code, County_code, Year_span, Measure_name, ..., fipscode
+    if not 13 <= len(row) <= 14 or not row[5].strip():
+        return None
+    row = row + [''] * (14 - len(row))
+    fips = row[13]
+    if not fips.strip() and row[2].strip().isdigit() and row[3].strip().isdigit():
+        fips = row[2].strip().zfill(2) + row[3].strip().zfill(3)
+    # Either column may hold the two letter abbreviation
+    state = row[2] if row[2].strip().isalpha() else row[0]
+    key = county_key(fips, state, row[1])
+    # Numerator, Denominator, Raw_value and the confidence bounds are
+    # numbers, Data_Release_Year a year; empty strings become NULL
+    row[7:12] = map(_real, row[7:12])
+    row[12] = _integer(row[12])
+    return row + [key, state_key(key), *parse_year_span(row[4])]
+
+
+def _gazetteer_row(row):
+    """Convert one Gazetteer counties row, or return None."""
+    # USPS, GEOID, ANSICODE, NAME, ..., INTPTLAT, INTPTLONG
+    if len(row) < 6 or not row[1].strip().isdigit():
+        return None
+    lat, lon = _real(row[-2]), _real(row[-1])
+    if lat is None or lon is None:
+        return None
+    state = row[0].strip()
+    return [county_key(row[1], state, row[3]), row[3].strip(), state, lat, lon]
+
+
+def _adjacency_row(row):
+    """Convert one county adjacency row, or return None."""
+    # County Name, County GEOID, Neighbor Name, Neighbor GEOID
+    if len(row) != 4 or not row[1].strip().isdigit() or not row[3].strip().isdigit():
+        return None
+    return [county_key(row[1], '', row[0]), county_key(row[3], '', row[2])]
+
+
+def _zip_row(row):
+    """Validate and convert one zip_county CSV row, or return None."""
+    # zip, ..., county, county_state, state_abbreviation, county_code, ...
+    if len(row) != 10 or not row[0].strip().isdigit() or len(row[0].strip()) > 5:
+        return None
+    # Spreadsheets like to drop the leading zeros
+    row[0] = row[0].strip().zfill(5)
+    key = county_key(row[5], row[4], row[2])
+    return row + [key, state_key(key)]
+
+
+def create_tables(db):
+    """Create the county_health_rankings, zip_county and county geography tables."""
+    # Create tables with case-insensitive collation
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS county_health_rankings (
+            State TEXT COLLATE NOCASE,
+            County TEXT COLLATE NOCASE,
+            State_code TEXT COLLATE NOCASE,
+            County_code TEXT,
+            Year_span TEXT,
+            Measure_name TEXT COLLATE NOCASE,
+            Measure_id TEXT,
+            Numerator REAL,
+            Denominator REAL,
+            Raw_value REAL,
+            Confidence_Interval_Lower_Bound REAL,
+            Confidence_Interval_Upper_Bound REAL,
+            Data_Release_Year INTEGER,
+            fipscode TEXT,
+            county_key TEXT,
+            state_key TEXT,
+            Year_start INTEGER,
+            Year_end INTEGER
+        )
+    ''')
+
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS zip_county (
+            zip TEXT,
+            default_state TEXT COLLATE NOCASE,
+            county TEXT COLLATE NOCASE,
+            county_state TEXT COLLATE NOCASE,
+            state_abbreviation TEXT COLLATE NOCASE,
+            county_code TEXT,
+            zip_pop TEXT,
+            zip_pop_in_county TEXT,
+            n_counties TEXT,
+            default_city TEXT,
+            county_key TEXT,
+            state_key TEXT
+        )
+    ''')
+
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS county_geo (
+            county_key TEXT,
+            name TEXT,
+            state TEXT,
+            lat REAL,
+            lon REAL
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS county_adjacency (
+            county_key TEXT,
+            neighbor_key TEXT
+        )
+    ''')
+    # Sorted Raw_values per measure and year, nationally (state_key '') and
+    # per state; filled in by create_distributions()
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS county_distributions (
+            measure TEXT,
+            release_year INTEGER,
+            year_span TEXT,
+            state_key TEXT,
+            value_blob BLOB
+        )
+    ''')
+
+
+def create_indexes(db):
+    """Create the indexes used by the /county_data lookups."""
+    # Serve the county, state and measure lookups (and their ORDER BY)
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chr_county
+        ON county_health_rankings (county_key, Measure_name, Year_end, Year_start)
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chr_state
+        ON county_health_rankings (state_key, Measure_name, Year_end, Year_start)
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chr_measure
+        ON county_health_rankings (Measure_name, Year_end, Year_start)
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_zip_county_zip ON zip_county (zip)')
+
+
+def create_fallbacks(db, top_n=FALLBACK_ROWS):
+    """Materialize the results of the /county_data fallback lookups.
+
+    The state-only, measure-only and any-row fallbacks each need a DISTINCT
+    and a sort over thousands of rows.  Instead, the newest top_n distinct
+    rows of every (state, measure), every measure and the whole table are
+    stored here in order (ties in file order), so a fallback is an index
+    range read like the county lookup.  The measures of every state and of
+    the whole table, for the 404 body, are stored the same way.  Rebuilds
+    the tables from scratch, so rerun it whenever the data changes.
+    """
+    columns = ', '.join(CHR_COLUMNS)
+    db.execute('DROP TABLE IF EXISTS fallback_rows')
+    db.execute('DROP TABLE IF EXISTS fallback_measures')
+    db.execute(f'''
+        CREATE TABLE fallback_rows (
+            scope TEXT,
+            key TEXT,
+            measure TEXT COLLATE NOCASE,
+            position INTEGER,
+            {columns},
+            PRIMARY KEY (scope, key, measure, position)
+        ) WITHOUT ROWID
+    ''')
+    db.execute('''
+        CREATE TABLE fallback_measures (
+            scope TEXT,
+            key TEXT,
+            position INTEGER,
+            Measure_name TEXT,
+            PRIMARY KEY (scope, key, position)
+        ) WITHOUT ROWID
+    ''')
+
+    # One row per distinct row of county_health_rankings, with only what the
+    # ranking needs; state_key and the years follow from the other columns
+    db.execute('DROP TABLE IF EXISTS temp.distinct_rows')
+    db.execute('DROP TABLE IF EXISTS temp.ranked')
+    db.execute(f'''
+        CREATE TEMP TABLE distinct_rows AS
+        SELECT MIN(rowid) AS first_row, state_key, Measure_name, Year_start, Year_end
+        FROM county_health_rankings
+        GROUP BY {columns}
+    ''')
+    db.execute('''
+        CREATE TEMP TABLE ranked (
+            scope TEXT, key TEXT, measure TEXT, position INTEGER,
+            first_row INTEGER, Year_start INTEGER, Year_end INTEGER
+        )
+    ''')
+
+    # The top rows of a measure are among the top rows of its states, and
+    # the top rows overall among those of the measures, so each scope only
+    # ranks what the one before it kept
+    scopes = (
+        ('state', 'distinct_rows', 'state_key', 'Measure_name'),
+        ('measure', "(SELECT * FROM ranked WHERE scope = 'state')", "''", 'measure'),
+        ('any', "(SELECT * FROM ranked WHERE scope = 'measure')", "''", "''"),
+    )
+    for scope, source, key, measure in scopes:
+        db.execute(f'''
+            INSERT INTO ranked
+            SELECT ?, key, measure, position, first_row, Year_start, Year_end
+            FROM (
+                SELECT {key} AS key, {measure} AS measure, first_row, Year_start, Year_end,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY {key}, {measure} COLLATE NOCASE
+                        ORDER BY Year_end DESC, Year_start DESC, first_row
+                    ) AS position
+                FROM {source}
+            )
+            WHERE position <= ?
+        ''', (scope, top_n))
+
+    db.execute(f'''
+        INSERT INTO fallback_rows
+        SELECT r.scope, r.key, r.measure, r.position, {', '.join('c.' + c for c in CHR_COLUMNS)}
+        FROM ranked r JOIN county_health_rankings c ON c.rowid = r.first_row
+    ''')
+    db.execute('DROP TABLE temp.distinct_rows')
+    db.execute('DROP TABLE temp.ranked')
+
+    for scope, key in (('state', 'state_key'), ('all', "''")):
+        db.execute(f'''
+            INSERT INTO fallback_measures
+            SELECT ?, {key}, ROW_NUMBER() OVER (
+                PARTITION BY {key} ORDER BY MIN(rowid)
+            ), Measure_name
+            FROM county_health_rankings
+            GROUP BY {key}, Measure_name
+        ''', (scope,))
+
+
+def create_distributions(db):
+    """Store the per-state and national Raw_value distributions (see ranks.Distributions).
+
+    Like the fallback tables, rerun it whenever the data changes.
+    """
+    Distributions.compute(db).store(db)
+
+
+def detect_encoding(path):
+    """Guess a CSV file's encoding from its byte order mark and contents.
+
+    UTF-8 (with or without a BOM) and UTF-16 with a BOM are recognized;
+    anything that isn't valid UTF-8 is read as Windows-1252, which is what
+    spreadsheet exports usually are.  The whole file is checked (a block
+    at a time), since one stray byte anywhere fails a UTF-8 load.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        block = f.read(CSV_SNIFF_BYTES)
+        if block.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return 'utf-16'
+        try:
+            while block:
+                decoder.decode(block)
+                block = f.read(CSV_SNIFF_BYTES)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return 'cp1252'
+    return 'utf-8-sig'
+
+
+def open_csv(path):
+    """Open a CSV file for csv.reader() in its detected encoding."""
+    return open(path, 'r', encoding=detect_encoding(path), newline='')
+
+
+def read_csv_rows(path, convert, delimiter=','):
+    """Yield convert(row) for every data row of a CSV file, one at a time.
+
+    Rows convert() rejects (by returning None) are skipped and reported in
+    one warning instead of failing the load.
+    """
+    skipped = []
+    with open_csv(path) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader, None)
+        logger.debug("%s header: %s", os.path.basename(path), header)
+        for row in reader:
+            if not row:
+                continue
+            row = convert(row)
+            if row is None:
+                skipped.append(reader.line_num)
+                continue
+            yield row
+    if skipped:
+        logger.warning("Skipped %d invalid rows in %s (lines %s%s)", len(skipped), path,
+                       ', '.join(map(str, skipped[:10])), ', ...' if len(skipped) > 10 else '')
+
+
+def insert_rows(db, table, rows, chunk_size=CSV_CHUNK_ROWS):
+    """Insert rows into table in fixed-size chunks and return the row count.
+
+    Only one chunk is held in memory at a time.  Nothing is committed here,
+    so the caller decides where the transaction ends.
+    """
+    count = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return count
+        db.executemany(f'INSERT INTO {table} VALUES ({",".join("?" * len(chunk[0]))})', chunk)
+        count += len(chunk)
+
+
+def bulk_load_pragmas(db):
+    """Turn off the rollback journal and fsyncs for a bulk load.
+
+    Only safe for databases that are thrown away if the load fails: the
+    in-memory database, or a file that is renamed into place afterwards.
+    """
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+
+
+def load_health_csv(db, path, mode='append'):
+    """Stream a county_health_rankings CSV file into the database.
+
+    mode is 'append' to add every row, or 'upsert' to replace the rows of
+    every Data_Release_Year the file contains and keep the other years, so
+    a new yearly release can be added to an existing database.
+    """
+    if mode not in ('append', 'upsert'):
+        raise ValueError(f'Unknown load mode {mode!r}')
+    rows = read_csv_rows(path, _health_row)
+    if mode == 'append':
+        count = insert_rows(db, 'county_health_rankings', rows)
+    else:
+        # Stage the file first; its release years are only known at the end
+        db.execute('CREATE TEMP TABLE incoming AS SELECT * FROM county_health_rankings WHERE 0')
+        count = insert_rows(db, 'incoming', rows)
+        replaced = db.execute('''
+            DELETE FROM county_health_rankings
+            WHERE Data_Release_Year IN (SELECT Data_Release_Year FROM incoming)
+        ''').rowcount
+        db.execute('INSERT INTO county_health_rankings SELECT * FROM incoming')
+        db.execute('DROP TABLE incoming')
+        logger.info("Replaced %d existing rows of the same release years", replaced)
+    logger.info("County health rows inserted: %d", count)
+    return count
+
+
+def load_zip_csv(db, path):
+    """Stream a zip_county CSV file into the database."""
+    count = insert_rows(db, 'zip_county', read_csv_rows(path, _zip_row))
+    logger.info("Zip county rows inserted: %d", count)
+    return count
+
+
+def load_geo_files(db, csv_dir=CSV_DIR):
+    """Load the county centroids and adjacency, if their files are there."""
+    gazetteer = os.path.join(csv_dir, COUNTY_GAZETTEER_FILE)
+    if not os.path.exists(gazetteer):
+        logger.info("No %s, /county_data/nearby is disabled", gazetteer)
+        return 0
+    # The Gazetteer is tab-separated, the adjacency file pipe-separated
+    count = insert_rows(db, 'county_geo', read_csv_rows(gazetteer, _gazetteer_row, '\t'))
+    logger.info("County centroids inserted: %d", count)
+    adjacency = os.path.join(csv_dir, COUNTY_ADJACENCY_FILE)
+    if os.path.exists(adjacency):
+        pairs = insert_rows(db, 'county_adjacency', read_csv_rows(adjacency, _adjacency_row, '|'))
+        logger.info("County adjacency pairs inserted: %d", pairs)
+    return count
+
+
+def load_csv_files(db, csv_dir=CSV_DIR):
+    """Load the CSV files into the (already created, empty) tables.
+
+    Raises if a file is missing or can't be read, without committing.
+    """
+    logger.info("Loading data from %s", csv_dir)
+    bulk_load_pragmas(db)
+
+    # Errors propagate: a partly loaded database must not be committed
+    # and served
+    load_health_csv(db, os.path.join(csv_dir, COUNTY_HEALTH_CSV))
+    load_zip_csv(db, os.path.join(csv_dir, ZIP_COUNTY_CSV))
+    load_geo_files(db, csv_dir)
+
+    db.commit()
+
+
+def init_db(csv_dir=CSV_DIR, fallbacks=True):
+    """Initialize the in-memory database and load data.
+
+    The fallback tables are only built when `fallbacks` is set, since only
+    the SQLite backend reads them.
+    """
+    try:
+        # The connection is shared by every request thread, so allow it to
+        # be used outside the thread that created it.  It is only ever read.
+        db = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES,
+                             check_same_thread=False)
+        db.row_factory = dict_factory
+
+        create_tables(db)
+        load_csv_files(db, csv_dir)
+        create_indexes(db)
+        create_distributions(db)
+        if fallbacks:
+            create_fallbacks(db)
+
+        # Debug: Log some sample data
+        if logger.isEnabledFor(logging.DEBUG):
+            for table in ('zip_county', 'county_health_rankings'):
+                rows = db.execute(f'SELECT * FROM {table} LIMIT 5').fetchall()
+                logger.debug("Sample data from %s: %s", table, json.dumps(rows, indent=2))
+
+        # Nothing writes to the data after loading
+        db.execute('PRAGMA query_only = ON')
+
+        return db
+
+    except Exception:
+        logger.exception("Error in init_db")
+        raise
+
+
+def open_db(db_path=DB_PATH):
+    """Open a prebuilt database file read-only and memory-mapped."""
+    # immutable=1 lets SQLite skip file locking entirely; the build step
+    # only ever replaces the file, it never rewrites it in place.
+    uri = 'file:' + urllib.parse.quote(os.path.abspath(db_path)) + '?mode=ro&immutable=1'
+    db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    db.row_factory = dict_factory
+    db.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    db.execute('PRAGMA query_only = ON')
+    return db
+
+
+def schema_version(db):
+    return db.execute('PRAGMA user_version').fetchone()['user_version']
+
+
+def source_signature(csv_dir=CSV_DIR, db_path=DB_PATH, snapshot_path=SNAPSHOT_PATH):
+    """Return a value that changes whenever the data files change."""
+    signature = []
+    paths = (snapshot_path, db_path, os.path.join(csv_dir, COUNTY_HEALTH_CSV),
+             os.path.join(csv_dir, ZIP_COUNTY_CSV), os.path.join(csv_dir, COUNTY_GAZETTEER_FILE),
+             os.path.join(csv_dir, COUNTY_ADJACENCY_FILE))
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+class ZipCounties:
+    """Every county a ZIP code spans, with its share of the ZIP's population.
+
+    Built once per dataset as parallel arrays: the counties of the ZIP with
+    ordinal i are _counties[_offsets[i]:_offsets[i + 1]] (indexes into
+    _county_info), with their weights at the same positions in _weights.
+    Weights come from zip_pop_in_county, are normalized to add up to 1 and
+    are sorted largest first.
+    """
+
+    def __init__(self, db):
+        ordinals = {}
+        county_ids = {}
+        county_info = []
+        offsets = array('I', [0])
+        counties = array('I')
+        weights = array('d')
+
+        def add_zip(group):
+            total = sum(weight for _, weight in group)
+            group.sort(key=lambda item: -item[1])
+            for county_id, weight in group:
+                counties.append(county_id)
+                # No population figures at all: split the ZIP evenly
+                weights.append(weight / total if total > 0 else 1 / len(group))
+            offsets.append(len(counties))
+
+        group = []
+        rows = db.execute('''
+            SELECT zip, county_key, state_key, county, state_abbreviation, zip_pop_in_county
+            FROM zip_county
+            ORDER BY zip, rowid
+        ''')
+        for row in rows:
+            if row['zip'] not in ordinals:
+                if group:
+                    add_zip(group)
+                ordinals[row['zip']] = len(ordinals)
+                group = []
+            info = (row['county_key'], row['state_key'], row['county'], row['state_abbreviation'])
+            if info not in county_ids:
+                county_ids[info] = len(county_info)
+                county_info.append(info)
+            group.append((county_ids[info], _real(row['zip_pop_in_county'] or '') or 0.0))
+        if group:
+            add_zip(group)
+
+        self._ordinals = ordinals
+        self._county_info = county_info
+        self._offsets = offsets
+        self._counties = counties
+        self._weights = weights
+
+    def get(self, zip_code):
+        """Return [(county_key, state_key, county, state, weight), ...] or None."""
+        i = self._ordinals.get(zip_code)
+        if i is None:
+            return None
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return [self._county_info[county] + (weight,)
+                for county, weight in zip(self._counties[start:end], self._weights[start:end])]
+
+
+class Dataset:
+    """A loaded, read-only copy of the data shared by all requests.
+
+    A Dataset is never modified after it is built, except that the place
+    search index is built on first use (the warm-up builds it right after
+    loading).  Reloading builds a new one and swaps it in, so requests that
+    already hold the old one keep using it until they finish.  A dataset
+    loaded from a snapshot has no database (db and pool are None); its
+    backend carries the counts, the ZIP index, the county index and the
+    distributions instead.
+    """
+
+    def __init__(self, db, pool, backend, signature, version):
+        self.db = db
+        self.pool = pool
+        self.backend = backend
+        self.signature = signature
+        self.version = version
+        self.loaded_at = time.time()
+        self.load_seconds = None  # set by load_dataset once everything is built
+        self._places = None
+        self._places_lock = threading.Lock()
+
+        if db is None:
+            self.zip_count = backend.zip_count
+            self.health_count = backend.health_count
+            self.zip_counties = backend.zip_counties
+            self._county_index = None
+            self._distributions = None
+            return
+
+        # Counted once here rather than on every request
+        self.zip_count = db.execute('SELECT COUNT(*) AS n FROM zip_county').fetchone()['n']
+        self.health_count = db.execute(
+            'SELECT COUNT(*) AS n FROM county_health_rankings').fetchone()['n']
+        self.zip_counties = ZipCounties(db)
+        self._county_index = CountyIndex.from_db(db)
+        self._distributions = Distributions.from_db(db)
+
+    @property
+    def county_index(self):
+        """County centroids and adjacency (see geo.CountyIndex)."""
+        if self._county_index is None:
+            return self.backend.county_index  # built on first use from the snapshot
+        return self._county_index
+
+    @property
+    def distributions(self):
+        """Per-state and national Raw_value distributions (see ranks.Distributions)."""
+        if self._distributions is None:
+            return self.backend.distributions  # read from the snapshot on first use
+        return self._distributions
+
+    @property
+    def places(self):
+        """City and county name search (see search.PlaceIndex), built on first use."""
+        if self._places is None:
+            with self._places_lock:
+                if self._places is None:
+                    self._places = (PlaceIndex.from_db(self.db) if self.db is not None
+                                    else self.backend.places)
+        return self._places
+
+
+_dataset = None
+_dataset_lock = threading.Lock()
+_last_check = 0.0
+
+
+def load_dataset(csv_dir=CSV_DIR, db_path=DB_PATH, backend=BACKEND, snapshot_path=SNAPSHOT_PATH):
+    """Build a new Dataset from the snapshot, the prebuilt database file or the CSV files."""
+    started = time.monotonic()
+    signature = source_signature(csv_dir, db_path, snapshot_path)
+    version = _dataset.version + 1 if _dataset is not None else 1
+    if not backend:
+        backend = 'snapshot' if os.path.exists(snapshot_path) else 'sqlite'
+
+    if backend == 'snapshot':
+        try:
+            snapshot = Snapshot(snapshot_path, verify=SNAPSHOT_VERIFY)
+        except (OSError, SnapshotError) as e:
+            logger.warning("Ignoring snapshot: %s; rebuild it with csv_to_sqlite.py --snapshot", e)
+            backend = 'sqlite'
+        else:
+            logger.info("Opened snapshot %s", snapshot_path)
+            dataset = Dataset(None, None, SnapshotBackend(snapshot), signature, version)
+            dataset.load_seconds = time.monotonic() - started
+            logger.info("Loaded dataset version %d in %.3f s", version, dataset.load_seconds)
+            return dataset
+
+    db = None
+    if os.path.exists(db_path):
+        db = open_db(db_path)
+        if schema_version(db) != SCHEMA_VERSION:
+            logger.warning("Ignoring %s: schema version %d, expected %d; rebuild it with "
+                           "csv_to_sqlite.py --build", db_path, schema_version(db), SCHEMA_VERSION)
+            db.close()
+            db = None
+        else:
+            logger.info("Opened prebuilt database %s", db_path)
+            pool = ConnectionPool(lambda: open_db(db_path), POOL_SIZE)
+    if db is None:
+        # The in-memory database only exists in this one connection
+        db = init_db(csv_dir, BACKENDS[backend].uses_fallback_tables)
+        pool = ConnectionPool.shared(db)
+    dataset = Dataset(db, pool, BACKENDS[backend](db, pool), signature, version)
+    dataset.load_seconds = time.monotonic() - started
+    logger.info("Loaded dataset version %d in %.3f s", version, dataset.load_seconds)
+    return dataset
+
+
+def get_dataset():
+    """Return the process-wide dataset, loading or reloading it if needed.
+
+    The first caller loads the data while any concurrent callers wait for
+    it.  Afterwards the data files are checked for changes at most once every
+    RELOAD_CHECK_INTERVAL seconds; when they have changed, one thread
+    rebuilds the data while the others keep serving the previous copy.
+    """
+    global _dataset, _last_check
+
+    dataset = _dataset
+    if dataset is None:
+        with _dataset_lock:
+            if _dataset is None:
+                _dataset = load_dataset()
+                _last_check = time.monotonic()
+            return _dataset
+
+    now = time.monotonic()
+    if RELOAD_CHECK_INTERVAL >= 0 and now - _last_check >= RELOAD_CHECK_INTERVAL:
+        # Only one thread checks/reloads; everyone else carries on
+        if _dataset_lock.acquire(blocking=False):
+            try:
+                _last_check = now
+                if source_signature() != _dataset.signature:
+                    logger.info("Source data files changed, reloading dataset")
+                    _dataset = load_dataset()
+            except Exception:
+                logger.exception("Error reloading dataset, keeping the current one")
+            finally:
+                _dataset_lock.release()
+        dataset = _dataset
+
+    return dataset
+
+
+def loaded_dataset():
+    """Return the current dataset without loading or reloading it (None before the first load)."""
+    return _dataset
+
+
+def reload_dataset():
+    """Force a reload of the dataset and return the new one."""
+    global _dataset, _last_check
+    with _dataset_lock:
+        _dataset = load_dataset()
+        _last_check = time.monotonic()
+        return _dataset
+
+
+def _after_fork():
+    # A lock held by a loading thread of the parent would never be released
+    global _dataset_lock
+    _dataset_lock = threading.Lock()
+    if _dataset is not None:
+        _dataset._places_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,81 @@
+import gzip
+import json
+import re
+
+from backends import CHR_COLUMNS
+
+# orjson and brotli are optional speedups; everything works without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# orjson writes floats below 1e-4 or from 1e16 on differently from json
+# (0.000025 for 2.5e-05, 1e20 for 1e+20); its output for them contains one
+# of these (strings can match too, which only costs a second encoding)
+_ORJSON_FLOAT_FORMS = re.compile(rb'[0-9]e|0\.0000')
+
+# Bodies smaller than this are sent uncompressed (about one network packet)
+COMPRESS_MIN_BYTES = 1400
+
+
+def dumps(obj, pretty=False):
+    """Serialize obj to UTF-8 JSON bytes, compact unless pretty is set.
+
+    Uses orjson when it is installed.  Both paths write non-ASCII text as
+    UTF-8 and use the same separators and 2-space indentation; floats are
+    written like Python's repr() (2.5e-05, 1e+20), so bodies that orjson
+    would format differently are encoded with json instead.  Clients (and
+    ETags) see the same output either way.
+    """
+    if orjson is not None:
+        body = orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+        if not _ORJSON_FLOAT_FORMS.search(body):
+            return body
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def as_text(value):
+    """Format a stored value the way the CSV files wrote it (NULL as '')."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def row_dict(row, strings=False):
+    """Turn a county_health_rankings row tuple into the response object.
+
+    Numeric columns are JSON numbers (or null) unless strings is set, which
+    gives every column as a string like responses used to.
+    """
+    if strings:
+        row = map(as_text, row)
+    return dict(zip(CHR_COLUMNS, row))
+
+
+def row_dicts(rows, strings=False):
+    return [row_dict(row, strings) for row in rows]
+
+
+def choose_encoding(accept_encodings):
+    """Pick the best compression the client accepts, or None."""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
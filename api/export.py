@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Bulk export of one measure for every county in a state or the country.
+
+Rows are read in one indexed query and kept column by column.  The optional
+per-year aggregates are computed over the Raw_value column with NumPy when
+it is installed (and with sorted lists otherwise), and tables are written
+as CSV, Arrow/Parquet (with pyarrow) or .npz (with NumPy).
+
+Command line use (see --help):
+
+    python3 api/export.py "Adult obesity" --state MA --aggregate -o obesity_ma.csv
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import math
+import os
+import sys
+
+# Make the sibling data modules importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from backends import CHR_COLUMNS
+from dataset import year_span_order
+from encoding import as_text
+
+# numpy and pyarrow are optional; CSV export works without either
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+    'npz': 'application/octet-stream',
+}
+DEFAULT_PERCENTILES = (25, 50, 75)
+
+_SELECT = ', '.join(CHR_COLUMNS)
+
+
+def available_formats():
+    """Return the export formats the installed packages support."""
+    formats = ['csv']
+    if pa is not None:
+        formats += ['parquet', 'arrow']
+    if np is not None:
+        formats.append('npz')
+    return formats
+
+
+def state_keys(db, state):
+    """Return the state_key values a state abbreviation or FIPS code stands for."""
+    state = state.strip().upper()
+    keys = {state}
+    for row in db.execute(
+        'SELECT DISTINCT state_key FROM zip_county WHERE state_abbreviation = ?', (state,)
+    ):
+        keys.add(row['state_key'])
+    return keys
+
+
+def select_columns(db, measure_name, state=None):
+    """Return {column: [values]} for measure_name, in CHR_COLUMNS order.
+
+    Covers every county of `state` (an abbreviation or FIPS code), or of
+    the whole country when state is None, ordered by county and newest
+    year first.
+    """
+    sql = f'SELECT DISTINCT {_SELECT} FROM county_health_rankings WHERE Measure_name = ?'
+    params = [measure_name]
+    if state:
+        sql += ' AND state_key IN (SELECT value FROM json_each(?))'
+        params.append(json.dumps(sorted(state_keys(db, state))))
+    sql += ' ORDER BY county_key, Year_end DESC, Year_start DESC'
+
+    cursor = db.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(sql, params).fetchall()
+    columns = list(zip(*rows)) if rows else [()] * len(CHR_COLUMNS)
+    return {name: list(values) for name, values in zip(CHR_COLUMNS, columns)}
+
+
+def aggregate(table, percentiles=DEFAULT_PERCENTILES):
+    """Per-Year_span count, min, max, mean and percentiles of Raw_value.
+
+    Percentiles interpolate linearly between the closest values, like
+    numpy.percentile's default.  Rows without a Raw_value are skipped.
+    Returns a table like select_columns(), newest Year_span first.
+    """
+    if np is not None:
+        spans, counts, mins, maxes, means, points = _aggregate_numpy(table, percentiles)
+    else:
+        spans, counts, mins, maxes, means, points = _aggregate_lists(table, percentiles)
+
+    order = sorted(range(len(spans)), key=lambda i: year_span_order(spans[i]), reverse=True)
+    result = {
+        'Year_span': [spans[i] for i in order],
+        'count': [int(counts[i]) for i in order],
+        'min': [float(mins[i]) for i in order],
+        'max': [float(maxes[i]) for i in order],
+        'mean': [float(means[i]) for i in order],
+    }
+    for p, values in zip(percentiles, points):
+        result[f'p{p:g}'] = [float(values[i]) for i in order]
+    return result
+
+
+def _aggregate_numpy(table, percentiles):
+    values = np.array(table['Raw_value'], dtype=float)  # None becomes NaN
+    keep = ~np.isnan(values)
+    spans, groups = np.unique(np.array(table['Year_span'], dtype=object)[keep], return_inverse=True)
+    values = values[keep]
+    if not len(values):
+        return [], [], [], [], [], [[] for _ in percentiles]
+
+    # Sort by group, then value: each group is one contiguous sorted run
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=len(spans))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    sums = np.add.reduceat(values, starts)
+    points = []
+    for p in percentiles:
+        position = starts + (counts - 1) * (p / 100)
+        low = np.floor(position).astype(int)
+        high = np.ceil(position).astype(int)
+        points.append(values[low] + (values[high] - values[low]) * (position - low))
+    return (list(spans), counts, np.minimum.reduceat(values, starts),
+            np.maximum.reduceat(values, starts), sums / counts, points)
+
+
+def _aggregate_lists(table, percentiles):
+    groups = {}
+    for span, value in zip(table['Year_span'], table['Raw_value']):
+        if value is not None:
+            groups.setdefault(span, []).append(value)
+
+    spans = list(groups)
+    counts, mins, maxes, means = [], [], [], []
+    points = [[] for _ in percentiles]
+    for span in spans:
+        values = sorted(groups[span])
+        counts.append(len(values))
+        mins.append(values[0])
+        maxes.append(values[-1])
+        means.append(math.fsum(values) / len(values))
+        for p, column in zip(percentiles, points):
+            position = (len(values) - 1) * (p / 100)
+            low, high = math.floor(position), math.ceil(position)
+            column.append(values[low] + (values[high] - values[low]) * (position - low))
+    return spans, counts, mins, maxes, means, points
+
+
+def write(table, fmt):
+    """Serialize a table to bytes in one of available_formats()."""
+    if fmt not in available_formats():
+        raise ValueError(f'Unsupported export format {fmt!r}; available: {", ".join(available_formats())}')
+    return _WRITERS[fmt](table)
+
+
+def _write_csv(table):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(table)
+    writer.writerows(
+        [as_text(value) for value in row] for row in zip(*table.values())
+    )
+    return out.getvalue().encode('utf-8')
+
+
+def _write_arrow(table):
+    sink = pa.BufferOutputStream()
+    arrow_table = pa.table(table)
+    with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return sink.getvalue().to_pybytes()
+
+
+def _write_parquet(table):
+    sink = pa.BufferOutputStream()
+    pa.parquet.write_table(pa.table(table), sink)
+    return sink.getvalue().to_pybytes()
+
+
+def _write_npz(table):
+    arrays = {}
+    for name, values in table.items():
+        if all(value is None or isinstance(value, (int, float)) for value in values):
+            arrays[name] = np.array(values, dtype=float)  # missing values are NaN
+        else:
+            arrays[name] = np.array(['' if value is None else str(value) for value in values])
+    out = io.BytesIO()
+    np.savez_compressed(out, **arrays)
+    return out.getvalue()
+
+
+_WRITERS = {
+    'csv': _write_csv,
+    'parquet': _write_parquet,
+    'arrow': _write_arrow,
+    'npz': _write_npz,
+}
+
+
+def parse_percentiles(text):
+    """Parse "25,50,75" into a tuple of numbers between 0 and 100."""
+    percentiles = tuple(float(p) for p in text.split(',') if p.strip())
+    if not all(0 <= p <= 100 for p in percentiles):
+        raise ValueError('Percentiles must be between 0 and 100')
+    return percentiles
+
+
+def main(argv=None):
+    from dataset import get_dataset
+
+    parser = argparse.ArgumentParser(description='Export one measure for every county of a state '
+                                                 'or of the whole country.')
+    parser.add_argument('measure_name')
+    parser.add_argument('--state', help='state abbreviation or FIPS code (default: every state)')
+    parser.add_argument('--format', default='csv', choices=list(MIMETYPES))
+    parser.add_argument('--aggregate', action='store_true',
+                        help='write per-year min/max/mean/percentiles instead of the rows')
+    parser.add_argument('--percentiles', default=','.join(map(str, DEFAULT_PERCENTILES)))
+    parser.add_argument('-o', '--output', help='output file (default: standard output)')
+    args = parser.parse_args(argv)
+    if args.format not in available_formats():
+        parser.error(f'--format {args.format} needs {"numpy" if args.format == "npz" else "pyarrow"}')
+    try:
+        percentiles = parse_percentiles(args.percentiles)
+    except ValueError as e:
+        parser.error(f'--percentiles: {e}')
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    db = get_dataset().db
+    if db is None:
+        sys.exit('Export needs the SQLite database or the CSV files; '
+                 'set COUNTY_DATA_BACKEND=sqlite to skip the snapshot')
+    table = select_columns(db, args.measure_name, args.state)
+    if args.aggregate:
+        table = aggregate(table, percentiles)
+    body = write(table, args.format)
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(body)
+    else:
+        sys.stdout.buffer.write(body)
+
+
+if __name__ == '__main__':
+    main()
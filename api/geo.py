@@ -0,0 +1,122 @@
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+# Grid cell size in degrees; small enough that a query looks at a few dozen
+# counties, large enough that most queries only touch a handful of cells
+CELL_DEGREES = 1.0
+_LON_CELLS = int(360 / CELL_DEGREES)
+# Radius the nearest() search starts with, doubled until it finds k counties
+_START_RADIUS_KM = 100.0
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance between two points in degrees."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell(lat, lon):
+    return int(math.floor(lat / CELL_DEGREES)), int(math.floor(lon / CELL_DEGREES)) % _LON_CELLS
+
+
+class CountyIndex:
+    """County centroids in a grid of CELL_DEGREES cells, plus adjacency.
+
+    A radius query only measures the distance to the counties in the cells
+    the circle overlaps, and nearest() widens the radius until it has
+    enough counties, so neither scans the whole country.  Keys are
+    county_keys (5-digit FIPS codes).  Built once per dataset.
+    """
+
+    def __init__(self, counties=(), adjacency=()):
+        # counties: (county_key, name, state, lat, lon); adjacency: (county_key, neighbor_key)
+        self._counties = {}
+        self._cells = {}
+        for key, name, state, lat, lon in counties:
+            self._counties[key] = (name, state, lat, lon)
+            self._cells.setdefault(_cell(lat, lon), []).append((key, lat, lon))
+        self._adjacent = {}
+        for key, neighbor in adjacency:
+            if key != neighbor and key in self._counties and neighbor in self._counties:
+                neighbors = self._adjacent.setdefault(key, [])
+                if neighbor not in neighbors:
+                    neighbors.append(neighbor)
+
+    @classmethod
+    def from_db(cls, db):
+        counties = ((row['county_key'], row['name'], row['state'], row['lat'], row['lon'])
+                    for row in db.execute('SELECT * FROM county_geo'))
+        adjacency = ((row['county_key'], row['neighbor_key'])
+                     for row in db.execute('SELECT * FROM county_adjacency ORDER BY rowid'))
+        return cls(counties, adjacency)
+
+    def __len__(self):
+        return len(self._counties)
+
+    def get(self, county_key):
+        """Return (name, state, lat, lon) of a county, or None."""
+        return self._counties.get(county_key)
+
+    def adjacent(self, county_key):
+        """Return [(distance_km, county_key)] of the counties bordering one, nearest first."""
+        county = self._counties.get(county_key)
+        if county is None:
+            return []
+        lat, lon = county[2:]
+        found = []
+        for key in self._adjacent.get(county_key, ()):
+            other = self._counties[key]
+            found.append((distance_km(lat, lon, other[2], other[3]), key))
+        return sorted(found)
+
+    def within(self, county_key, radius_km):
+        """Return [(distance_km, county_key)] of the other counties whose
+        centroids are within radius_km of this one's, nearest first."""
+        county = self._counties.get(county_key)
+        if county is None:
+            return []
+        return [item for item in self._within(county[2], county[3], radius_km)
+                if item[1] != county_key]
+
+    def nearest(self, county_key, k):
+        """Return [(distance_km, county_key)] of the k counties nearest to one."""
+        county = self._counties.get(county_key)
+        if county is None:
+            return []
+        k = min(k, len(self._counties) - 1)
+        radius = _START_RADIUS_KM
+        while True:
+            found = self.within(county_key, radius)
+            # Everything within the radius was found, so the k nearest of
+            # them are the k nearest overall
+            if len(found) >= k or radius > math.pi * EARTH_RADIUS_KM:
+                return found[:k]
+            radius *= 2
+
+    def _within(self, lat, lon, radius_km):
+        lat_span = math.degrees(radius_km / EARTH_RADIUS_KM)
+        lat_low, lat_high = max(-90.0, lat - lat_span), min(90.0, lat + lat_span)
+        # Degrees of longitude shrink towards the poles; near one, or for a
+        # huge radius, every longitude is in range
+        widest = max(abs(lat_low), abs(lat_high))
+        if widest >= 89.0 or lat_span >= 90.0:
+            lon_cells = range(_LON_CELLS)
+        else:
+            lon_span = lat_span / math.cos(math.radians(widest))
+            first = int(math.floor((lon - lon_span) / CELL_DEGREES))
+            last = int(math.floor((lon + lon_span) / CELL_DEGREES))
+            lon_cells = range(_LON_CELLS) if last - first >= _LON_CELLS else \
+                [i % _LON_CELLS for i in range(first, last + 1)]
+
+        found = []
+        for lat_cell in range(int(math.floor(lat_low / CELL_DEGREES)),
+                              int(math.floor(lat_high / CELL_DEGREES)) + 1):
+            for lon_cell in lon_cells:
+                for key, other_lat, other_lon in self._cells.get((lat_cell, lon_cell), ()):
+                    distance = distance_km(lat, lon, other_lat, other_lon)
+                    if distance <= radius_km:
+                        found.append((distance, key))
+        found.sort()
+        return found
@@ -1,13 +1,62 @@
 from flask import Flask, request, jsonify, render_template, g, current_app
-import sqlite3
 import os
-import csv
-import traceback
+import sys
+import hmac
+import math
 import json
+import logging
+import time
+import functools
+from itertools import chain
+
+# Make the sibling data modules importable however the app is started
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# The data layer (dataset and its loaders) and the export module are only
+# imported when first needed, or by the warm-up thread
+import warmup
+from warmup import DataNotReady, get_dataset
+import metrics
+from metrics import stage
+from cache import ResponseCache
+from ratelimit import RateLimiter
+from schema import Schema, Field, is_zip_code, is_int, is_number, one_of, is_list, max_length, is_true
+from backends import CHR_COLUMNS, MEASURE_NAME
+from encoding import dumps, row_dict, row_dicts, choose_encoding, compress, COMPRESS_MIN_BYTES
+
+# INFO logs dataset loads; DEBUG adds per-request diagnostics
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
-app.config['API_KEY'] = 'cs1060-hw4-apikey'  # Simple API key for authentication
+# API keys accepted in the X-API-Key header, comma-separated in COUNTY_API_KEYS
+app.config['API_KEYS'] = tuple(
+    key.strip() for key in os.environ.get('COUNTY_API_KEYS', 'cs1060-hw4-apikey').split(',')
+    if key.strip()
+)
+# Requests per second each API key may make, in bursts of up to
+# RATE_LIMIT_BURST; off (0) unless COUNTY_RATE_LIMIT is set
+app.config['RATE_LIMIT'] = float(os.environ.get('COUNTY_RATE_LIMIT', '0'))
+app.config['RATE_LIMIT_BURST'] = int(os.environ.get('COUNTY_RATE_LIMIT_BURST', '100'))
+app.config['BATCH_MAX_ZIPS'] = 10000  # Largest zip list /county_data/batch accepts
+app.config['MAX_LIMIT'] = 1000  # Largest limit (rows per county and measure) accepted
+# Most counties /county_data/nearby returns, and its largest radius in km
+app.config['NEARBY_MAX_COUNTIES'] = 100
+app.config['NEARBY_MAX_RADIUS_KM'] = 1000
+# Most results and longest query /county_data/search accepts
+app.config['SEARCH_MAX_RESULTS'] = 50
+app.config['SEARCH_MAX_QUERY'] = 100
+# Response cache for /county_data: entry limit, optional TTL in seconds (0 for
+# none) and the max-age advertised to clients and CDNs
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('COUNTY_CACHE_MAX_ENTRIES', '4096'))
+app.config['CACHE_TTL'] = float(os.environ.get('COUNTY_CACHE_TTL', '0'))
+app.config['CACHE_MAX_AGE'] = int(os.environ.get('COUNTY_CACHE_MAX_AGE', '3600'))
+app.config['CACHE_MAX_BODY'] = 1024 * 1024  # Larger responses are not cached
+# Minimum seconds between two requests logging debug diagnostics
+app.config['DIAGNOSTICS_INTERVAL'] = float(os.environ.get('COUNTY_DIAGNOSTICS_INTERVAL', '10'))
 
 # Allowed measures
 ALLOWED_MEASURES = {
@@ -25,132 +74,277 @@ ALLOWED_MEASURES = {
     "Daily fine particulate matter"
 }
 
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+# Row tuple positions used by the weighted aggregate, the trends and the
+# percentile ranks
+RAW_VALUE = CHR_COLUMNS.index('Raw_value')
+YEAR_SPAN = CHR_COLUMNS.index('Year_span')
+RELEASE_YEAR = CHR_COLUMNS.index('Data_Release_Year')
 
-def init_db():
-    """Initialize the in-memory database and load data."""
-    try:
-        db = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
-        db.row_factory = dict_factory
-        
-        # Create tables with case-insensitive collation
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS county_health_rankings (
-                State TEXT COLLATE NOCASE,
-                County TEXT COLLATE NOCASE,
-                State_code TEXT COLLATE NOCASE,
-                County_code TEXT,
-                Year_span TEXT,
-                Measure_name TEXT COLLATE NOCASE,
-                Measure_id TEXT,
-                Numerator TEXT,
-                Denominator TEXT,
-                Raw_value TEXT,
-                Confidence_Interval_Lower_Bound TEXT,
-                Confidence_Interval_Upper_Bound TEXT,
-                Data_Release_Year TEXT,
-                fipscode TEXT
-            )
-        ''')
-        
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS zip_county (
-                zip TEXT,
-                default_state TEXT COLLATE NOCASE,
-                county TEXT COLLATE NOCASE,
-                county_state TEXT COLLATE NOCASE,
-                state_abbreviation TEXT COLLATE NOCASE,
-                county_code TEXT,
-                zip_pop TEXT,
-                zip_pop_in_county TEXT,
-                n_counties TEXT,
-                default_city TEXT
-            )
-        ''')
-        
-        # Load data from CSV files
-        csv_dir = os.path.join(os.path.dirname(__file__), '..', 'csv_data')
-        print(f"Loading data from {csv_dir}")
-        
-        try:
-            # Check if the files exist
-            county_health_path = os.path.join(csv_dir, 'county_health_rankings.csv')
-            zip_county_path = os.path.join(csv_dir, 'zip_county.csv')
-            
-            print(f"County health file exists: {os.path.exists(county_health_path)}")
-            print(f"Zip county file exists: {os.path.exists(zip_county_path)}")
-            
-            # Load county health rankings data
-            with open(county_health_path, 'r', encoding='utf-8-sig') as f:
-                reader = csv.reader(f)
-                header = next(reader)  # Skip header but keep it
-                print(f"County health CSV header: {header}")
-                
-                # Count rows for debugging
-                rows = list(reader)
-                print(f"County health rows to insert: {len(rows)}")
-                
-                db.executemany(
-                    'INSERT INTO county_health_rankings VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
-                    rows
-                )
-                print("County health data inserted successfully")
-            
-            # Load zip to county mapping data
-            with open(zip_county_path, 'r', encoding='utf-8-sig') as f:
-                reader = csv.reader(f)
-                header = next(reader)  # Skip header but keep it
-                print(f"Zip county CSV header: {header}")
-                
-                # Count rows for debugging
-                rows = list(reader)
-                print(f"Zip county rows to insert: {len(rows)}")
-                
-                db.executemany(
-                    'INSERT INTO zip_county VALUES (?,?,?,?,?,?,?,?,?,?)',
-                    rows
-                )
-                print("Zip county data inserted successfully")
-        except Exception as e:
-            print(f"Error loading CSV data: {str(e)}")
-            print(traceback.format_exc())
-        
-        db.commit()
-        
-        # Debug: Print some sample data
-        print("\nSample data from zip_county:")
-        cursor = db.execute('SELECT * FROM zip_county LIMIT 5')
-        for row in cursor:
-            print(json.dumps(row, indent=2))
-            
-        print("\nSample data from county_health_rankings:")
-        cursor = db.execute('SELECT * FROM county_health_rankings LIMIT 5')
-        for row in cursor:
-            print(json.dumps(row, indent=2))
-            
-        return db
-        
-    except Exception as e:
-        print(f"Error in init_db: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
-        raise
+# Bounds of the year_from / year_to filters when only one is given
+MIN_YEAR, MAX_YEAR = 0, 9999
+
+# Request bodies, checked before any dataset work (see schema.py)
+def is_measure_selection(value):
+    """One allowed measure, a list of them or "*" (a county profile)."""
+    if isinstance(value, list):
+        return all(isinstance(m, str) and m in ALLOWED_MEASURES for m in value)
+    return value == '*' or (isinstance(value, str) and value in ALLOWED_MEASURES)
+
+def is_profile(measure_name):
+    return isinstance(measure_name, list) or measure_name == '*'
+
+def is_series(values):
+    return (values['latest_only'] or values['trend']
+            or values['year_from'] is not None or values['year_to'] is not None)
+
+ZIP_FIELD = Field('zip', (is_zip_code, 'Invalid ZIP code format'), required=True)
+LIMIT_FIELD = Field('limit', (is_int(1, app.config['MAX_LIMIT']), 'Invalid limit parameter'), default=10)
+STRINGS_FIELD = Field('numeric_strings', default=False, convert=bool)
+YEAR_ERROR = 'Invalid year_from or year_to parameter'
+
+COUNTY_DATA_SCHEMA = Schema(
+    ZIP_FIELD,
+    Field('measure_name', (is_measure_selection, 'Invalid measure_name'), required=True),
+    LIMIT_FIELD,
+    Field('year_from', (is_int(MIN_YEAR, MAX_YEAR), YEAR_ERROR)),
+    Field('year_to', (is_int(MIN_YEAR, MAX_YEAR), YEAR_ERROR)),
+    Field('latest_only', default=False, convert=bool),
+    Field('trend', default=False, convert=bool),
+    STRINGS_FIELD,
+    Field('sample_mode', default=False),
+    Field('all_counties', default=False, convert=bool),
+    Field('weighted', default=False, convert=bool),
+    Field('percentile_rank', default=False, convert=bool),
+    checks=[
+        (lambda v: v['year_from'] is None or v['year_to'] is None or v['year_from'] <= v['year_to'],
+         'year_from is after year_to'),
+        (lambda v: not (v['all_counties'] and is_series(v)),
+         'year_from, year_to, latest_only and trend only apply to single-county lookups'),
+        (lambda v: not (is_profile(v['measure_name']) and (
+            v['all_counties'] or v['year_from'] is not None or v['year_to'] is not None)),
+         'all_counties, year_from and year_to need a single measure_name'),
+    ],
+)
+
+LISTS_ERROR = 'zips and measure_names must be lists'
+BATCH_SCHEMA = Schema(
+    Field('zips', (is_list, LISTS_ERROR),
+          (max_length(app.config['BATCH_MAX_ZIPS']),
+           f"At most {app.config['BATCH_MAX_ZIPS']} zips per batch"), required=True),
+    Field('measure_names', (is_list, LISTS_ERROR), required=True),
+    LIMIT_FIELD,
+    STRINGS_FIELD,
+)
+
+NEARBY_SCHEMA = Schema(
+    ZIP_FIELD,
+    Field('measure_name', (one_of(ALLOWED_MEASURES), 'Invalid measure_name'), required=True),
+    LIMIT_FIELD,
+    Field('k', (is_int(1, app.config['NEARBY_MAX_COUNTIES']),
+                f"k must be between 1 and {app.config['NEARBY_MAX_COUNTIES']}")),
+    Field('radius_km', (is_number(0, app.config['NEARBY_MAX_RADIUS_KM']),
+                        f"radius_km must be more than 0 and at most {app.config['NEARBY_MAX_RADIUS_KM']}")),
+    Field('adjacent', default=False, convert=is_true),
+    STRINGS_FIELD,
+    checks=[
+        (lambda v: (v['k'] is not None) + (v['radius_km'] is not None) + v['adjacent'] == 1,
+         'Give exactly one of k, radius_km or "adjacent": true'),
+    ],
+)
+
+def is_query(value):
+    return isinstance(value, str) and 0 < len(value.strip()) <= app.config['SEARCH_MAX_QUERY']
+
+def is_state(value):
+    return isinstance(value, str) and len(value) == 2 and value.isalpha()
+
+SEARCH_SCHEMA = Schema(
+    Field('query', (is_query, f"query must be 1 to {app.config['SEARCH_MAX_QUERY']} characters"),
+          required=True),
+    Field('type', (one_of(('city', 'county')), 'type must be "city" or "county"')),
+    Field('state', (is_state, 'state must be a 2-letter abbreviation')),
+    Field('limit', (is_int(1, app.config['SEARCH_MAX_RESULTS']),
+                    f"limit must be between 1 and {app.config['SEARCH_MAX_RESULTS']}"), default=10),
+)
+
+def request_body():
+    """The request's JSON object, or None if it has none (or isn't an object)."""
+    with stage('parse'):
+        data = request.get_json(silent=True)
+    return data if isinstance(data, dict) and data else None
+
+def ranked_dict(row, strings=False, ranks=None):
+    """row_dict(), plus the row's percentile ranks when ranks is (distributions, state_key).
+
+    The ranks compare Raw_value with every county's for the same measure,
+    release and Year_span, within the state (null when state_key is None)
+    and nationally.
+    """
+    item = row_dict(row, strings)
+    if ranks is not None:
+        distributions, state_key = ranks
+        item['state_percentile_rank'], item['national_percentile_rank'] = distributions.rank(
+            row[MEASURE_NAME], row[RELEASE_YEAR], row[YEAR_SPAN], state_key, row[RAW_VALUE])
+    return item
+
+def ranked_dicts(rows, strings=False, ranks=None):
+    if ranks is None:
+        return row_dicts(rows, strings)
+    return [ranked_dict(row, strings, ranks) for row in rows]
+
+response_cache = ResponseCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL'] or None)
+rate_limiter = RateLimiter(app.config['RATE_LIMIT'], app.config['RATE_LIMIT_BURST'])
+request_metrics = metrics.Metrics()
 
 def get_db():
-    """Get database connection."""
-    if not hasattr(g, 'db'):
-        g.db = init_db()
-    return g.db
+    """Get the shared database connection for this request.
+
+    The dataset is loaded once per process and shared by all requests; the
+    request keeps a reference to it so a reload can't swap it out mid-query.
+    Queries made while serving a request should go through the backend or
+    g.dataset.pool, which hand each thread its own connection.
+    """
+    if not hasattr(g, 'dataset'):
+        g.dataset = get_dataset()
+    return g.dataset.db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """Close database connection at the end of the request."""
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    """Release this request's reference to the shared dataset."""
+    g.pop('dataset', None)
+
+_last_diagnostics = 0.0
+
+def log_diagnostics(dataset, zip_code):
+    """Log what the database holds for zip_code.
+
+    Only runs when debug logging is on, and at most once every
+    DIAGNOSTICS_INTERVAL seconds, so it never slows down production traffic.
+    """
+    global _last_diagnostics
+    if not logger.isEnabledFor(logging.DEBUG) or dataset.db is None:
+        return
+    now = time.monotonic()
+    if now - _last_diagnostics < current_app.config['DIAGNOSTICS_INTERVAL']:
+        return
+    _last_diagnostics = now
+
+    with dataset.pool.connection() as db:
+        tables = [t['name'] for t in db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        logger.debug("Tables in database: %s", tables)
+        logger.debug("Records in zip_county: %d, county_health_rankings: %d",
+                     dataset.zip_count, dataset.health_count)
+
+        zip_data = db.execute('SELECT * FROM zip_county WHERE zip = ?', (zip_code,)).fetchall()
+        logger.debug("Found %d matching ZIP code records for %s: %s", len(zip_data), zip_code,
+                     json.dumps(zip_data))
+        if zip_data:
+            county_key = zip_data[0]['county_key']
+            county_data = db.execute(
+                'SELECT DISTINCT * FROM county_health_rankings WHERE county_key = ? LIMIT 5',
+                (county_key,)
+            ).fetchall()
+            logger.debug("Found %d general records for county %s: %s", len(county_data), county_key,
+                         json.dumps(county_data))
+            measures = [r['Measure_name'] for r in db.execute(
+                'SELECT DISTINCT Measure_name FROM county_health_rankings WHERE county_key = ?',
+                (county_key,)
+            )]
+            logger.debug("Available measures for this county: %s", measures)
+
+def wants_stream(data):
+    """Whether the client asked for an NDJSON stream instead of one JSON body."""
+    if data.get('stream') is True:
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+def wants_pretty():
+    """Whether the client asked for indented JSON (?pretty=1 or X-Pretty-Print)."""
+    value = request.args.get('pretty') or request.headers.get('X-Pretty-Print', '')
+    return value.lower() in ('1', 'true', 'yes')
+
+def json_response(obj, status=200, pretty=False):
+    """Serialize obj into a JSON response, compact unless pretty is set."""
+    return app.response_class(dumps(obj, pretty), status=status, mimetype='application/json')
+
+def ndjson_response(items, headers=None):
+    """Stream items as compact JSON, one per line, as they are produced.
+
+    Row lookups are read in full before the response starts (see
+    SQLiteBackend._tuples); only their serialization is spread out.
+    """
+    def generate():
+        for item in items:
+            yield dumps(item) + b'\n'
+    return app.response_class(generate(), status=200, mimetype='application/x-ndjson',
+                              headers=headers)
+
+def cached_response(entry, hit):
+    """Turn a CachedResponse into a response with ETag/Cache-Control headers.
+
+    Large bodies are compressed once per encoding and the result is kept
+    with the entry, so cache hits don't compress again.
+    """
+    body, etag, encoding = entry.body, entry.etag, None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding:
+            if encoding not in entry.encoded:
+                with stage('compress'):
+                    entry.encoded[encoding] = compress(body, encoding)
+            body, etag = entry.encoded[encoding], f'{etag}-{encoding}'
+
+    if entry.status == 200 and etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, status=entry.status, mimetype=entry.mimetype)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if len(entry.body) >= COMPRESS_MIN_BYTES:
+        response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={current_app.config['CACHE_MAX_AGE']}"
+    response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response
+
+@app.before_request
+def start_timing():
+    metrics.start_request()
+
+# Registered before compress_response so it runs after it and sees the
+# compression time
+@app.after_request
+def record_timing(response):
+    """Add a Server-Timing header and record the request in the metrics.
+
+    Streamed responses are timed up to the point their first byte is ready.
+    """
+    total, timings = metrics.request_timings()
+    response.headers['Server-Timing'] = metrics.server_timing(total, timings)
+    request_metrics.observe_request(request.endpoint or 'unmatched', response.status_code,
+                                    total, timings)
+    return response
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/csv'}
+
+@app.after_request
+def compress_response(response):
+    """Compress large JSON and CSV bodies the client accepts gzip or br for."""
+    if (response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding:
+        with stage('compress'):
+            response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
 
 # Home route
 @app.route('/')
@@ -162,14 +356,49 @@ def home():
 def county_data_page():
     return render_template('index.html')
 
-# Check for valid API key
+# Liveness check: answers as soon as the process is up
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok', 'ready': warmup.is_ready()})
+
+# Readiness check: 503 until the dataset has loaded
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    dataset = warmup.current_dataset()
+    if dataset is None:
+        return jsonify({'status': 'loading'}), 503, {'Retry-After': '5'}
+    return jsonify({'status': 'ready', 'version': dataset.version, 'backend': dataset.backend.name})
+
+@app.errorhandler(DataNotReady)
+def data_not_ready(e):
+    return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+
+def find_api_key(api_key):
+    """Return the configured key matching api_key, or None.
+
+    Every key is compared, in constant time, so the response time doesn't
+    reveal how much of a key was right.
+    """
+    given = api_key.encode('utf-8', 'surrogateescape')
+    found = None
+    for key in current_app.config['API_KEYS']:
+        if hmac.compare_digest(given, key.encode('utf-8')):
+            found = key
+    return found
+
+# Check for a valid API key, then the key's rate limit
 def require_api_key(f):
     def decorated(*args, **kwargs):
-        api_key = request.headers.get('X-API-Key')
-        if api_key and api_key == current_app.config['API_KEY']:
-            return f(*args, **kwargs)
-        else:
+        with stage('auth'):
+            api_key = request.headers.get('X-API-Key')
+            key = find_api_key(api_key) if api_key else None
+            retry_after = rate_limiter.take(key) if key else 0
+        if key is None:
             return jsonify({'error': 'Authentication required'}), 401
+        if retry_after:
+            return (jsonify({'error': 'Rate limit exceeded, slow down'}), 429,
+                    {'Retry-After': str(math.ceil(retry_after))})
+        return f(*args, **kwargs)
     decorated.__name__ = f.__name__
     return decorated
 
@@ -178,210 +407,683 @@ def require_api_key(f):
 @require_api_key
 def county_data():
     try:
-        data = request.get_json()
-        if not data:
+        data = request_body()
+        if data is None:
             return jsonify({'error': 'No JSON data provided'}), 400
 
         # Easter egg for teapot status
         if data.get('coffee') == 'teapot':
             return "I'm a teapot", 418
 
-        # Extract parameters
-        zip_code = data.get('zip')
-        measure_name = data.get('measure_name')
-        limit = data.get('limit', 10)  # Default to 10
-
-        # Validate inputs
-        if not zip_code or not measure_name:
-            return jsonify({'error': 'Missing required parameters'}), 400
-
-        if not (isinstance(zip_code, str) and zip_code.isdigit() and len(zip_code) == 5):
-            return jsonify({'error': 'Invalid ZIP code format'}), 400
-
-        if measure_name not in ALLOWED_MEASURES:
-            return jsonify({'error': 'Invalid measure_name'}), 400
-
-        if not isinstance(limit, int) or limit < 1:
-            return jsonify({'error': 'Invalid limit parameter'}), 400
-
-        # Execute SQL query
-        db = get_db()
-        
-        # Check that tables exist and have data
-        tables_check = db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
-        print(f"\nTables in database: {[t['name'] for t in tables_check]}")
-        
-        # Count records in each table
-        zip_count = db.execute("SELECT COUNT(*) as count FROM zip_county").fetchone()
-        health_count = db.execute("SELECT COUNT(*) as count FROM county_health_rankings").fetchone()
-        print(f"Records in zip_county: {zip_count['count']}")
-        print(f"Records in county_health_rankings: {health_count['count']}")
-        
-        # If tables are empty, return a more helpful error
-        if zip_count['count'] == 0 or health_count['count'] == 0:
+        with stage('validate'):
+            values, error = COUNTY_DATA_SCHEMA.validate(data)
+            if error:
+                return jsonify({'error': error}), 400
+
+            zip_code = values['zip']
+            measure_name = values['measure_name']
+            limit = values['limit']
+            # A list of measures or "*" asks for a county profile
+            profile = is_profile(measure_name)
+            if profile:
+                measure_names = (sorted(ALLOWED_MEASURES) if measure_name == '*'
+                                 else list(dict.fromkeys(measure_name)))
+            series = is_series(values)
+            year_from = MIN_YEAR if values['year_from'] is None else values['year_from']
+            year_to = MAX_YEAR if values['year_to'] is None else values['year_to']
+            latest_only = values['latest_only']
+            trend = values['trend']
+
+            stream = wants_stream(data)
+            pretty = wants_pretty()
+            strings = values['numeric_strings']
+            sample_mode = values['sample_mode']
+            all_counties = values['all_counties']
+            weighted = values['weighted']
+            percentile_rank = values['percentile_rank']
+
+        with stage('dataset'):
+            get_db()
+        dataset = g.dataset
+
+        # If tables are empty, return a more helpful error (counted at load time)
+        if dataset.zip_count == 0 or dataset.health_count == 0:
             return jsonify({'error': 'Database tables are empty. Please check CSV data loading.'}), 500
-        
-        # Debug: Print ZIP code data with more careful error handling
-        print(f"\nLooking up ZIP code {zip_code}:")
-        try:
-            zip_data = db.execute('SELECT * FROM zip_county WHERE zip = ?', (zip_code,)).fetchall()
-            print(f"Found {len(zip_data)} matching ZIP code records")
-            
-            for row in zip_data:
-                print(json.dumps(row, indent=2))
-            
-            if not zip_data:
-                # No matching ZIP code - let's show some available ZIP codes to help with testing
-                sample_zips = db.execute('SELECT zip FROM zip_county LIMIT 5').fetchall()
-                available_zips = [row['zip'] for row in sample_zips]
-                return jsonify({
-                    'error': f'ZIP code {zip_code} not found in database',
-                    'sample_zip_codes': available_zips
-                }), 404
-
-            # Get county and state info
-            county_name = zip_data[0]['county'].replace(' County', '')
-            state_name = zip_data[0]['county_state']
-            state_code = zip_data[0]['state_abbreviation']
-            
-            print(f"\nLooking for data with:")
-            print(f"County: {county_name} or {county_name} County")
-            print(f"State: {state_name} ({state_code})")
-            
-            # Debug: Show all records for this exact county and state
-            print("\nAll records for this exact county and state:")
-            county_data = db.execute('''
-                SELECT DISTINCT *
-                FROM county_health_rankings
-                WHERE (County = ? COLLATE NOCASE OR County = ? || ' County' COLLATE NOCASE)
-                AND State_code = ? COLLATE NOCASE
-                LIMIT 5
-            ''', (county_name, county_name, state_code)).fetchall()
-            
-            print(f"Found {len(county_data)} general county records")
-            for row in county_data:
-                print(json.dumps(row, indent=2))
-            
-            # Get all available measures for this exact county and state
-            all_measures = db.execute('''
-                SELECT DISTINCT Measure_name
-                FROM county_health_rankings
-                WHERE (County = ? COLLATE NOCASE OR County = ? || ' County' COLLATE NOCASE)
-                AND State_code = ? COLLATE NOCASE
-            ''', (county_name, county_name, state_code)).fetchall()
-        except Exception as e:
-            print(f"Error querying database: {str(e)}")
-            print(traceback.format_exc())
-            return jsonify({'error': f'Database query error: {str(e)}'}), 500
-        
-        available_measures = [row['Measure_name'] for row in all_measures]
-        print(f"\nAvailable measures for this county: {available_measures}")
-        
-        # Try a more flexible query if no measures were found 
-        if not available_measures:
-            print("No measures found for the exact county/state. Trying a more general query...")
-            # Try a broader search using just state code
-            broad_measures = db.execute('''
-                SELECT DISTINCT Measure_name 
-                FROM county_health_rankings 
-                WHERE State_code = ? COLLATE NOCASE
-                LIMIT 10
-            ''', (state_code,)).fetchall()
-            
-            available_measures = [row['Measure_name'] for row in broad_measures]
-            print(f"Found {len(available_measures)} measures in state {state_code}")
-            
-            # If still no measures, get any available measure from the database
-            if not available_measures:
-                all_db_measures = db.execute('SELECT DISTINCT Measure_name FROM county_health_rankings LIMIT 15').fetchall()
-                available_measures = [row['Measure_name'] for row in all_db_measures]
-                print(f"No measures in state. Using {len(available_measures)} sample measures from database")
-        
-        # Modified query to be more explicit about state matching and case-insensitive
-        query = '''
-        SELECT DISTINCT chr.* 
-        FROM county_health_rankings chr
-        WHERE (chr.County = ? COLLATE NOCASE OR chr.County = ? || ' County' COLLATE NOCASE)
-        AND chr.State_code = ? COLLATE NOCASE
-        AND chr.Measure_name = ? COLLATE NOCASE
-        ORDER BY chr.Year_span DESC
-        LIMIT ?
-        '''
-        
-        print(f"\nExecuting query for measure '{measure_name}'")
-        rows = db.execute(query, (county_name, county_name, state_code, measure_name, limit)).fetchall()
-        
-        # If no data is found
+
+        log_diagnostics(dataset, zip_code)
+
+        if profile:
+            # Always one JSON document
+            stream = False
+            lookup = functools.partial(lookup_county_profile, dataset, zip_code, measure_names,
+                                       1 if latest_only else limit, trend, pretty, strings,
+                                       percentile_rank)
+        elif series:
+            # Trends are always one JSON document
+            stream = stream and not trend
+            lookup = functools.partial(lookup_county_series, dataset, zip_code, measure_name,
+                                       1 if latest_only else limit, year_from, year_to, trend,
+                                       stream, pretty, strings, percentile_rank)
+        elif all_counties:
+            # Always one JSON document, so it can be cached even when streaming was asked for
+            stream = False
+            lookup = functools.partial(lookup_zip_counties, dataset, zip_code, measure_name, limit,
+                                       weighted, pretty, strings, percentile_rank)
+        else:
+            lookup = functools.partial(lookup_county_data, dataset, zip_code, measure_name, limit,
+                                       sample_mode, stream, pretty, strings, percentile_rank)
+
+        if stream:
+            return lookup()
+
+        # The data only changes with the dataset version, so identical
+        # requests can be answered with the bytes produced the first time
+        cache_key = (zip_code, tuple(measure_names) if profile else measure_name, limit, bool(sample_mode), pretty, strings,
+                     all_counties, weighted, series and (year_from, year_to, latest_only, trend),
+                     percentile_rank)
+        with stage('cache'):
+            entry = response_cache.get(cache_key, dataset.version)
+        hit = entry is not None
+        if not hit:
+            response = app.make_response(lookup())
+            body = response.get_data()
+            if response.status_code not in (200, 404) or len(body) > current_app.config['CACHE_MAX_BODY']:
+                return response
+            with stage('cache'):
+                entry = response_cache.put(cache_key, dataset.version, response.status_code,
+                                           body, response.mimetype)
+        return cached_response(entry, hit)
+
+    except DataNotReady:
+        raise
+    except Exception:
+        # The details go to the log only; a traceback per failed request
+        # is slow to build and shows clients how the server works
+        logger.exception("Error in county_data")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def unknown_zip_response(backend, zip_code, pretty=False):
+    """404 for a ZIP code that isn't in the data, with some that are."""
+    request_metrics.count_fallback('unknown_zip')
+    with stage('fallback'):
+        available_zips = backend.sample_zips(5)
+    return json_response({
+        'error': f'ZIP code {zip_code} not found in database',
+        'sample_zip_codes': available_zips
+    }, status=404, pretty=pretty)
+
+def lookup_county_data(dataset, zip_code, measure_name, limit, sample_mode, stream, pretty=False,
+                       strings=False, percentile_rank=False):
+    """Build the /county_data response for an already validated request.
+
+    Rows come from the backend as tuples and are only paired with the
+    column names as they are serialized.
+    """
+    backend = dataset.backend
+
+    try:
+        # Memoized per dataset, so usually no query at all
+        with stage('resolve_zip'):
+            resolved = backend.resolve_zip(zip_code)
+    except Exception as e:
+        logger.exception("Error querying database")
+        return jsonify({'error': f'Database query error: {str(e)}'}), 500
+
+    if resolved is None:
+        return unknown_zip_response(backend, zip_code, pretty)
+
+    # The keys were normalized at load time
+    county_key, state_key = resolved
+    # The state fallback's rows are from the same state; sample rows are not
+    ranks = (dataset.distributions, state_key) if percentile_rank else None
+
+    # The common case: one indexed query for the county and measure
+    with stage('query'):
+        rows = backend.county_rows(county_key, measure_name, limit)
+
+    # If no data is found
+    if not rows:
+        # Try a simpler query that ignores the county
+        logger.debug("No results for county %s. Trying with just state %s and measure...",
+                     county_key, state_key)
+        request_metrics.count_fallback('state')
+        with stage('fallback'):
+            rows = backend.state_rows(state_key, measure_name, limit)
+
         if not rows:
-            # Try a simpler query that ignores county name
-            print("No results with county name. Trying with just state code and measure...")
-            simpler_query = '''
-            SELECT DISTINCT * 
-            FROM county_health_rankings 
-            WHERE State_code = ? COLLATE NOCASE
-            AND Measure_name = ? COLLATE NOCASE
-            ORDER BY Year_span DESC
-            LIMIT ?
-            '''
-            rows = db.execute(simpler_query, (state_code, measure_name, limit)).fetchall()
-            
-            if not rows:
-                # Check for sample_mode parameter which can force returning sample data
-                sample_mode = data.get('sample_mode', False)
-                
-                if sample_mode:
-                    print("Sample mode enabled - fetching sample data instead")
-                    # Find any row with this measure regardless of location
-                    sample_query = '''
-                    SELECT DISTINCT * 
-                    FROM county_health_rankings 
-                    WHERE Measure_name = ? COLLATE NOCASE
-                    ORDER BY Year_span DESC
-                    LIMIT ?
-                    '''
-                    sample_rows = db.execute(sample_query, (measure_name, limit)).fetchall()
-                    
-                    # If measure not found, get any data for demo purposes
-                    if not sample_rows:
-                        print("No rows for this measure at all - fetching any sample data")
-                        any_data_query = '''
-                        SELECT DISTINCT * 
-                        FROM county_health_rankings
-                        ORDER BY Year_span DESC
-                        LIMIT ?
-                        '''
-                        sample_rows = db.execute(any_data_query, (limit,)).fetchall()
-                        
-                    if sample_rows:
-                        print(f"Returning {len(sample_rows)} sample rows")
-                        return app.response_class(
-                            response=json.dumps({
-                                'note': 'Sample data returned as no exact match was found',
-                                'data': sample_rows
-                            }, indent=2),
-                            status=200,
-                            mimetype='application/json'
-                        )
-                
-                # If sample mode is off or no sample data found, return 404 with helpful info
-                return jsonify({
-                    'error': f'No data found for ZIP {zip_code} and measure {measure_name}',
-                    'available_measures': available_measures,
-                    'sample_zip_codes': db.execute('SELECT zip FROM zip_county LIMIT 5').fetchall(),
-                    'hint': 'Add "sample_mode": true to your request to get sample data for testing'
-                }), 404
-
-        # Return formatted JSON response
-        return app.response_class(
-            response=json.dumps(rows, indent=2),
-            status=200,
-            mimetype='application/json'
+            if sample_mode:
+                logger.debug("Sample mode enabled - fetching sample data instead")
+                request_metrics.count_fallback('sample_mode')
+                # Find any row with this measure regardless of location
+                with stage('fallback'):
+                    sample_rows = backend.measure_rows(measure_name, limit)
+
+                # If measure not found, get any data for demo purposes
+                if not sample_rows:
+                    logger.debug("No rows for this measure at all - fetching any sample data")
+                    with stage('fallback'):
+                        sample_rows = backend.any_rows(limit)
+
+                # Rows from anywhere are only ranked nationally
+                sample_ranks = (ranks[0], None) if ranks else None
+
+                if sample_rows and stream:
+                    return ndjson_response((ranked_dict(row, strings, sample_ranks)
+                                            for row in sample_rows), headers={
+                        'X-Note': 'Sample data returned as no exact match was found'
+                    })
+
+                if sample_rows:
+                    with stage('serialize'):
+                        return json_response({
+                            'note': 'Sample data returned as no exact match was found',
+                            'data': ranked_dicts(sample_rows, strings, sample_ranks)
+                        }, pretty=pretty)
+
+            # Get the measures that do exist for this county, falling
+            # back to the state and then to any measures at all
+            request_metrics.count_fallback('not_found')
+            with stage('fallback'):
+                available_measures = backend.county_measures(county_key)
+                if not available_measures:
+                    available_measures = backend.state_measures(state_key, 10)
+                if not available_measures:
+                    available_measures = backend.all_measures(15)
+                sample_zips = backend.sample_zips(5)
+
+            # If sample mode is off or no sample data found, return 404 with helpful info
+            return json_response({
+                'error': f'No data found for ZIP {zip_code} and measure {measure_name}',
+                'available_measures': available_measures,
+                'sample_zip_codes': [{'zip': z} for z in sample_zips],
+                'hint': 'Add "sample_mode": true to your request to get sample data for testing'
+            }, status=404, pretty=pretty)
+
+    if stream:
+        return ndjson_response(ranked_dict(row, strings, ranks) for row in rows)
+
+    with stage('serialize'):
+        return json_response(ranked_dicts(rows, strings, ranks), pretty=pretty)
+
+def lookup_county_series(dataset, zip_code, measure_name, limit, year_from, year_to, trend,
+                         stream, pretty=False, strings=False, percentile_rank=False):
+    """Build the /county_data response for a year range, latest_only or trend request.
+
+    Only the county's own rows are used (no state or sample fallbacks), so
+    the years and trend always describe that one county.
+    """
+    backend = dataset.backend
+    with stage('resolve_zip'):
+        resolved = backend.resolve_zip(zip_code)
+    if resolved is None:
+        return unknown_zip_response(backend, zip_code, pretty)
+    county_key = resolved[0]
+    ranks = (dataset.distributions, resolved[1]) if percentile_rank else None
+
+    # A range scan of the county's rows, which are kept sorted by year
+    with stage('query'):
+        rows = list(backend.county_series(county_key, measure_name, year_from, year_to, limit))
+
+    if not rows:
+        request_metrics.count_fallback('not_found')
+        with stage('fallback'):
+            all_rows = backend.county_series(county_key, measure_name, MIN_YEAR, MAX_YEAR,
+                                             dataset.health_count)
+            available_years = list(dict.fromkeys(row[YEAR_SPAN] for row in all_rows))
+            available_measures = [] if available_years else backend.county_measures(county_key)
+        return json_response({
+            'error': f'No data found for ZIP {zip_code} and measure {measure_name} '
+                     f'in years {year_from}-{year_to}',
+            'available_years': available_years,
+            'available_measures': available_measures,
+        }, status=404, pretty=pretty)
+
+    if stream:
+        return ndjson_response(ranked_dict(row, strings, ranks) for row in rows)
+
+    with stage('serialize'):
+        if not trend:
+            return json_response(ranked_dicts(rows, strings, ranks), pretty=pretty)
+        return json_response({
+            'data': ranked_dicts(rows, strings, ranks),
+            'trend': trend_values(rows),
+        }, pretty=pretty)
+
+def lookup_county_profile(dataset, zip_code, measure_names, limit, trend, pretty=False,
+                          strings=False, percentile_rank=False):
+    """Build the /county_data response for a list of measures (or "*").
+
+    All the measures come from one lookup of the county's record; measures
+    without data are listed in missing_measures.
+    """
+    backend = dataset.backend
+    with stage('resolve_zip'):
+        resolved = backend.resolve_zip(zip_code)
+    if resolved is None:
+        return unknown_zip_response(backend, zip_code, pretty)
+    county_key, state_key = resolved
+
+    with stage('query'):
+        profile = backend.county_profile(county_key, measure_names, limit)
+
+    if not profile:
+        request_metrics.count_fallback('not_found')
+        with stage('fallback'):
+            available_measures = backend.county_measures(county_key)
+        return json_response({
+            'error': f'No data found for ZIP {zip_code} and the requested measures',
+            'available_measures': available_measures,
+        }, status=404, pretty=pretty)
+
+    ranks = (dataset.distributions, state_key) if percentile_rank else None
+    with stage('serialize'):
+        result = {
+            'zip': zip_code,
+            'county_key': county_key,
+            'state_key': state_key,
+            'measures': {name: ranked_dicts(profile[name], strings, ranks)
+                         for name in measure_names if name in profile},
+            'missing_measures': [name for name in measure_names if name not in profile],
+        }
+        if trend:
+            result['trends'] = {name: trend_values(profile[name])
+                                for name in measure_names if name in profile}
+        return json_response(result, pretty=pretty)
+
+def trend_values(rows):
+    """Year-over-year changes and the least-squares slope of Raw_value per year.
+
+    rows are one county's rows of one measure, newest first.  Each
+    Year_span counts once (its newest release) and is placed at the middle
+    of its years, so "2016-2018" sits at 2017.
+    """
+    from dataset import parse_year_span
+
+    points = {}
+    for row in rows:
+        start, end = parse_year_span(row[YEAR_SPAN])
+        if row[RAW_VALUE] is None or end is None:
+            continue
+        best = points.get(row[YEAR_SPAN])
+        if best is None or (row[RELEASE_YEAR] or 0) > (best[2] or 0):
+            points[row[YEAR_SPAN]] = ((start + end) / 2, row[RAW_VALUE], row[RELEASE_YEAR])
+    series = sorted((year, value, span) for span, (year, value, _) in points.items())
+
+    deltas = []
+    for (year, value, span), (prev_year, prev_value, prev_span) in zip(series[1:], series):
+        change = value - prev_value
+        deltas.append({
+            'Year_span': span,
+            'previous': prev_span,
+            'change': round(change, 6),
+            'change_per_year': round(change / (year - prev_year), 6) if year != prev_year else None,
+        })
+    deltas.reverse()  # newest first, like the rows
+
+    slope = None
+    if len(series) >= 2:
+        mean_year = sum(year for year, _, _ in series) / len(series)
+        mean_value = sum(value for _, value, _ in series) / len(series)
+        spread = sum((year - mean_year) ** 2 for year, _, _ in series)
+        if spread:
+            slope = round(sum((year - mean_year) * (value - mean_value)
+                              for year, value, _ in series) / spread, 6)
+    return {'points': len(series), 'slope_per_year': slope, 'deltas': deltas}
+
+def weighted_values(counties, rows_by_county):
+    """Population-weighted mean Raw_value per Year_span, newest first.
+
+    Each year only counts the counties that have a value for it, with their
+    weights scaled back up to 1; `coverage` says how much of the ZIP's
+    population those counties hold.
+    """
+    from dataset import year_span_order
+
+    years = {}
+    for county_key, _, _, _, weight in counties:
+        for row in rows_by_county.get(county_key, ()):
+            if row[RAW_VALUE] is not None:
+                year = years.setdefault(row[YEAR_SPAN], [0.0, 0.0])
+                year[0] += row[RAW_VALUE] * weight
+                year[1] += weight
+    return [
+        {'Year_span': span, 'Raw_value': years[span][0] / years[span][1], 'coverage': years[span][1]}
+        for span in sorted(years, key=year_span_order, reverse=True)
+    ]
+
+def lookup_zip_counties(dataset, zip_code, measure_name, limit, weighted, pretty=False,
+                        strings=False, percentile_rank=False):
+    """Build the /county_data response for every county a ZIP code spans."""
+    from dataset import state_key
+    with stage('resolve_zip'):
+        counties = dataset.zip_counties.get(zip_code)
+    if counties is None:
+        request_metrics.count_fallback('unknown_zip')
+        return json_response({
+            'error': f'ZIP code {zip_code} not found in database',
+            'sample_zip_codes': dataset.backend.sample_zips(5)
+        }, status=404, pretty=pretty)
+
+    # Precomputed at load time; one query covers all of the counties
+    with stage('query'):
+        rows_by_county = dataset.backend.county_rows_many(
+            [county[0] for county in counties], measure_name, limit
         )
+    if not rows_by_county:
+        request_metrics.count_fallback('not_found')
+        return json_response({
+            'error': f'No data found for ZIP {zip_code} and measure {measure_name}',
+            'available_measures': dataset.backend.county_measures(counties[0][0]),
+        }, status=404, pretty=pretty)
 
-    except Exception as e:
-        print(f"Error in county_data: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
-        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+    with stage('serialize'):
+        result = {
+            'zip': zip_code,
+            'measure_name': measure_name,
+            'counties': [
+                {
+                    'county': county,
+                    'state': state,
+                    'county_key': county_key,
+                    'weight': weight,
+                    'data': ranked_dicts(rows_by_county.get(county_key, ()), strings,
+                                         (dataset.distributions, state_key(county_key))
+                                         if percentile_rank else None),
+                }
+                for county_key, _, county, state, weight in counties
+            ],
+        }
+        if weighted:
+            result['weighted'] = weighted_values(counties, rows_by_county)
+        return json_response(result, pretty=pretty)
+
+# Dataset and cache statistics
+@app.route('/county_data/stats', methods=['GET'])
+@require_api_key
+def county_data_stats():
+    dataset = get_dataset()
+    return jsonify({
+        'dataset': {
+            'version': dataset.version,
+            'loaded_at': dataset.loaded_at,
+            'backend': dataset.backend.name,
+            'zip_county_rows': dataset.zip_count,
+            'county_health_rows': dataset.health_count,
+            'connection_pool': dataset.pool.stats() if dataset.pool else None,
+        },
+        'response_cache': response_cache.stats(),
+    })
+
+# Prometheus metrics: request latency per stage, cache and dataset gauges
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    body = request_metrics.render(warmup.current_dataset(), response_cache.stats())
+    return app.response_class(body, status=200, content_type=metrics.CONTENT_TYPE)
+
+# Bulk export of one measure for a whole state or the whole country
+@app.route('/county_data/export', methods=['GET'])
+@require_api_key
+def county_data_export():
+    import export
+
+    measure_name = request.args.get('measure_name')
+    state = request.args.get('state')
+    fmt = request.args.get('format', 'csv')
+
+    if measure_name not in ALLOWED_MEASURES:
+        return jsonify({'error': 'Invalid measure_name'}), 400
+
+    if state is not None and not (len(state) == 2 and (state.isalpha() or state.isdigit())):
+        return jsonify({'error': 'Invalid state parameter'}), 400
+
+    if fmt not in export.available_formats():
+        return jsonify({
+            'error': f'Unsupported format {fmt}',
+            'available_formats': export.available_formats()
+        }), 400
+
+    try:
+        percentiles = export.parse_percentiles(request.args.get('percentiles', '25,50,75'))
+    except ValueError:
+        return jsonify({'error': 'Invalid percentiles parameter'}), 400
+
+    if get_db() is None:
+        return jsonify({'error': 'Bulk export needs the SQLite database; this server is '
+                                 'serving from a snapshot'}), 501
+
+    with stage('query'), g.dataset.pool.connection() as db:
+        table = export.select_columns(db, measure_name, state)
+    if request.args.get('aggregate', '').lower() in ('1', 'true', 'yes'):
+        with stage('aggregate'):
+            table = export.aggregate(table, percentiles)
+
+    with stage('serialize'):
+        body = export.write(table, fmt)
+    name = f"{measure_name}{'-' + state if state else ''}".lower().replace(' ', '_')
+    return app.response_class(
+        body,
+        status=200,
+        mimetype=export.MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{name}.{fmt}"'}
+    )
+
+def batch_items(backend, county_keys, measure_names, limit, strings=False):
+    """Yield a result or error item for every (zip, measure) pair.
+
+    county_keys maps each zip to its (county_key, state_key).  There is one
+    query per measure for all counties, plus one for the states of the
+    counties that had no data (the same fallback as /county_data).
+    """
+    all_counties = {county for county, _ in county_keys.values()}
+    for measure_name in measure_names:
+        by_county = backend.county_rows_many(all_counties, measure_name, limit)
+        missing_states = {state for county, state in county_keys.values() if county not in by_county}
+        by_state = {}
+        if missing_states:
+            request_metrics.count_fallback('state')
+            by_state = backend.state_rows_many(missing_states, measure_name, limit)
+
+        for zip_code, (county, state) in county_keys.items():
+            rows = by_county.get(county) or by_state.get(state)
+            if rows:
+                yield {'zip': zip_code, 'measure_name': measure_name, 'data': row_dicts(rows, strings)}
+            else:
+                yield {
+                    'zip': zip_code,
+                    'measure_name': measure_name,
+                    'error': f'No data found for ZIP {zip_code} and measure {measure_name}'
+                }
+
+# Batch endpoint: many ZIPs x many measures in one request
+@app.route('/county_data/batch', methods=['POST'])
+@require_api_key
+def county_data_batch():
+    try:
+        data = request_body()
+        if data is None:
+            return jsonify({'error': 'No JSON data provided'}), 400
+
+        # Validate the request as a whole; individual bad items are
+        # reported in `errors` instead of failing the batch
+        with stage('validate'):
+            values, error = BATCH_SCHEMA.validate(data)
+        if error:
+            return jsonify({'error': error}), 400
+        zip_codes = values['zips']
+        measure_names = values['measure_names']
+        limit = values['limit']
+
+        errors = []
+        valid_zips = []
+        for zip_code in zip_codes:
+            if not (isinstance(zip_code, str) and zip_code.isdigit() and len(zip_code) == 5):
+                errors.append({'zip': zip_code, 'error': 'Invalid ZIP code format'})
+            else:
+                valid_zips.append(zip_code)
+        valid_zips = list(dict.fromkeys(valid_zips))  # drop duplicates, keep order
+
+        valid_measures = []
+        for measure_name in measure_names:
+            if not (isinstance(measure_name, str) and measure_name in ALLOWED_MEASURES):
+                errors.append({'measure_name': measure_name, 'error': 'Invalid measure_name'})
+            else:
+                valid_measures.append(measure_name)
+        valid_measures = list(dict.fromkeys(valid_measures))
+
+        get_db()
+        backend = g.dataset.backend
+
+        # Resolve every ZIP in one pass
+        with stage('resolve_zip'):
+            zip_data = backend.find_zips(valid_zips)
+        county_keys = {}
+        for zip_code in valid_zips:
+            if zip_code in zip_data:
+                first = zip_data[zip_code][0]
+                county_keys[zip_code] = (first['county_key'], first['state_key'])
+            else:
+                errors.append({'zip': zip_code, 'error': f'ZIP code {zip_code} not found in database'})
+
+        items = batch_items(backend, county_keys, valid_measures, limit,
+                            values['numeric_strings'])
+
+        if wants_stream(data):
+            # One line per problem, then one per (zip, measure) as it is found
+            return ndjson_response(chain(errors, items))
+
+        results = {zip_code: {} for zip_code in county_keys}
+        with stage('query'):
+            for item in items:
+                if 'data' in item:
+                    results[item['zip']][item['measure_name']] = item['data']
+                else:
+                    errors.append(item)
+
+        with stage('serialize'):
+            return json_response({'results': results, 'errors': errors}, pretty=wants_pretty())
+
+    except DataNotReady:
+        raise
+    except Exception:
+        logger.exception("Error in county_data_batch")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Counties near a ZIP code's county, with their data for one measure
+@app.route('/county_data/nearby', methods=['POST'])
+@require_api_key
+def county_data_nearby():
+    data = request_body()
+    if data is None:
+        return jsonify({'error': 'No JSON data provided'}), 400
+
+    try:
+        with stage('validate'):
+            values, error = NEARBY_SCHEMA.validate(data)
+        if error:
+            return jsonify({'error': error}), 400
+        zip_code = values['zip']
+        measure_name = values['measure_name']
+        limit = values['limit']
+        k = values['k']
+        radius_km = values['radius_km']
+        adjacent = values['adjacent']
+        max_counties = current_app.config['NEARBY_MAX_COUNTIES']
+
+        get_db()
+        dataset = g.dataset
+        counties = dataset.county_index
+        if not len(counties):
+            return jsonify({'error': 'County locations are not loaded on this server'}), 501
+
+        backend = dataset.backend
+        with stage('resolve_zip'):
+            resolved = backend.resolve_zip(zip_code)
+        if resolved is None:
+            return unknown_zip_response(backend, zip_code, wants_pretty())
+        county_key = resolved[0]
+        origin = counties.get(county_key)
+        if origin is None:
+            return jsonify({'error': f'No location for the county of ZIP {zip_code}'}), 404
+
+        with stage('spatial'):
+            if adjacent:
+                found = counties.adjacent(county_key)
+            elif k is not None:
+                found = counties.nearest(county_key, k)
+            else:
+                found = counties.within(county_key, radius_km)
+        truncated = len(found) > max_counties
+        found = [(0.0, county_key)] + found[:max_counties]
+
+        with stage('query'):
+            rows_by_county = backend.county_rows_many([key for _, key in found], measure_name, limit)
+
+        with stage('serialize'):
+            strings = values['numeric_strings']
+            result = {
+                'zip': zip_code,
+                'measure_name': measure_name,
+                'county_key': county_key,
+                'counties': [
+                    {
+                        'county_key': key,
+                        'county': counties.get(key)[0],
+                        'state': counties.get(key)[1],
+                        'distance_km': round(distance, 3),
+                        'data': row_dicts(rows_by_county.get(key, ()), strings),
+                    }
+                    for distance, key in found
+                ],
+            }
+            if truncated:
+                result['truncated'] = True
+            return json_response(result, pretty=wants_pretty())
+
+    except DataNotReady:
+        raise
+    except Exception:
+        logger.exception("Error in county_data_nearby")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# ZIP codes and counties by (partial or misspelled) city or county name
+@app.route('/county_data/search', methods=['POST'])
+@require_api_key
+def county_data_search():
+    data = request_body()
+    if data is None:
+        return jsonify({'error': 'No JSON data provided'}), 400
+
+    try:
+        with stage('validate'):
+            values, error = SEARCH_SCHEMA.validate(data)
+        if error:
+            return jsonify({'error': error}), 400
+
+        get_db()
+        with stage('search'):
+            found = g.dataset.places.search(values['query'], values['limit'], values['type'],
+                                            values['state'])
+
+        with stage('serialize'):
+            results = []
+            for score, match, (kind, name, state, county_key, zips, population) in found:
+                result = {'type': kind, 'name': name, 'state': state}
+                if county_key is not None:
+                    result['county_key'] = county_key
+                result.update(zips=zips, population=population, score=score, match=match)
+                results.append(result)
+            return json_response({'query': values['query'], 'results': results}, pretty=wants_pretty())
+
+    except DataNotReady:
+        raise
+    except Exception:
+        logger.exception("Error in county_data_search")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Start loading the data as soon as the process starts instead of on the
+# first request (COUNTY_WARM_UP=0 to disable)
+if os.environ.get('COUNTY_WARM_UP', '1') != '0':
+    warmup.start()
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
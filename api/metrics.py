@@ -0,0 +1,172 @@
+import bisect
+import contextlib
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context
+
+# Histogram bucket upper bounds in seconds, from a cache hit to a slow fallback
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Counts of observations per bucket, like a Prometheus histogram."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        """Yield (le, cumulative count) pairs, ending with +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield ('+Inf' if bound == float('inf') else f'{bound:g}'), total
+
+
+class Metrics:
+    """Request counters and latency histograms for the whole process.
+
+    Handlers time their stages with stage(); the after_request hook passes
+    the totals to observe_request().  render() writes everything in the
+    Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)            # (endpoint, status) -> count
+        self.latency = defaultdict(Histogram)       # endpoint -> Histogram
+        self.stages = defaultdict(Histogram)        # (endpoint, stage) -> Histogram
+        self.fallbacks = defaultdict(int)           # fallback path -> count
+
+    def observe_request(self, endpoint, status, seconds, stages):
+        with self._lock:
+            self.requests[endpoint, status] += 1
+            self.latency[endpoint].observe(seconds)
+            for name, stage_seconds in stages.items():
+                self.stages[endpoint, name].observe(stage_seconds)
+
+    def count_fallback(self, path):
+        """Count a request answered by one of the slow fallback paths."""
+        with self._lock:
+            self.fallbacks[path] += 1
+
+    def render(self, dataset=None, cache_stats=None):
+        """Return all metrics in the Prometheus text exposition format."""
+        out = []
+
+        def family(name, kind, help_text):
+            out.append(f'# HELP county_data_{name} {help_text}')
+            out.append(f'# TYPE county_data_{name} {kind}')
+
+        def sample(name, value, **labels):
+            if labels:
+                text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                out.append(f'county_data_{name}{{{text}}} {_number(value)}')
+            else:
+                out.append(f'county_data_{name} {_number(value)}')
+
+        def histogram(name, hist, **labels):
+            for le, count in hist.samples():
+                sample(f'{name}_bucket', count, **labels, le=le)
+            sample(f'{name}_sum', hist.sum, **labels)
+            sample(f'{name}_count', sum(hist.counts), **labels)
+
+        with self._lock:
+            family('requests_total', 'counter', 'Requests handled, by endpoint and status code.')
+            for (endpoint, status), count in sorted(self.requests.items()):
+                sample('requests_total', count, endpoint=endpoint, status=status)
+
+            family('request_duration_seconds', 'histogram',
+                   'Time to produce a response, up to the first byte of streamed ones.')
+            for endpoint, hist in sorted(self.latency.items()):
+                histogram('request_duration_seconds', hist, endpoint=endpoint)
+
+            family('stage_duration_seconds', 'histogram', 'Time spent in each stage of a request.')
+            for (endpoint, stage_name), hist in sorted(self.stages.items()):
+                histogram('stage_duration_seconds', hist, endpoint=endpoint, stage=stage_name)
+
+            family('fallback_total', 'counter',
+                   'Requests answered by a fallback path instead of the county query.')
+            for path, count in sorted(self.fallbacks.items()):
+                sample('fallback_total', count, path=path)
+
+        if cache_stats is not None:
+            family('cache_hits_total', 'counter', 'Response cache hits.')
+            sample('cache_hits_total', cache_stats['hits'])
+            family('cache_misses_total', 'counter', 'Response cache misses.')
+            sample('cache_misses_total', cache_stats['misses'])
+            family('cache_evictions_total', 'counter', 'Response cache evictions.')
+            sample('cache_evictions_total', cache_stats['evictions'])
+            family('cache_entries', 'gauge', 'Responses in the cache.')
+            sample('cache_entries', cache_stats['entries'])
+            family('cache_hit_ratio', 'gauge', 'Response cache hits over lookups since start.')
+            sample('cache_hit_ratio', cache_stats['hit_ratio'])
+
+        family('dataset_ready', 'gauge', 'Whether the dataset has finished loading.')
+        sample('dataset_ready', int(dataset is not None))
+        if dataset is not None:
+            family('dataset_version', 'gauge', 'Version of the loaded dataset; goes up on reload.')
+            sample('dataset_version', dataset.version)
+            family('dataset_load_seconds', 'gauge', 'Time it took to load the current dataset.')
+            sample('dataset_load_seconds', dataset.load_seconds or 0.0)
+            family('dataset_loaded_timestamp_seconds', 'gauge', 'When the current dataset was loaded.')
+            sample('dataset_loaded_timestamp_seconds', dataset.loaded_at)
+            family('dataset_rows', 'gauge', 'Rows in each table of the current dataset.')
+            sample('dataset_rows', dataset.zip_count, table='zip_county')
+            sample('dataset_rows', dataset.health_count, table='county_health_rankings')
+            if dataset.pool is not None:
+                pool = dataset.pool.stats()
+                family('pool_connections', 'gauge', 'Database connections opened and idle.')
+                sample('pool_connections', pool['opened'], state='opened')
+                sample('pool_connections', pool['idle'], state='idle')
+
+        return '\n'.join(out) + '\n'
+
+
+def _number(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def start_request():
+    """Start timing the current request."""
+    g.request_started = time.perf_counter()
+    g.timings = {}
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the time spent in the with block to the request's `name` stage."""
+    timings = g.get('timings') if has_request_context() else None
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def request_timings():
+    """Return (total seconds, {stage: seconds}) for the current request."""
+    return time.perf_counter() - g.request_started, g.timings
+
+
+def server_timing(total, timings):
+    """Format stage timings as a Server-Timing header value, in milliseconds."""
+    parts = [f'{name};dur={seconds * 1000:.3f}' for name, seconds in timings.items()]
+    parts.append(f'total;dur={total * 1000:.3f}')
+    return ', '.join(parts)
@@ -0,0 +1,60 @@
+import contextlib
+import os
+import queue
+import threading
+
+# Read-only connections to the prebuilt database file, i.e. how many queries
+# can run at the same time.  Every connection maps the same file, so the data
+# is held once in the page cache however many connections (or worker
+# processes) there are.
+POOL_SIZE = int(os.environ.get('COUNTY_DB_POOL_SIZE', str(min(32, (os.cpu_count() or 1) + 4))))
+
+
+class ConnectionPool:
+    """Read-only SQLite connections shared by the request threads.
+
+    Each thread checks a connection out for the duration of a query, so up
+    to `size` queries run in parallel (sqlite3 releases the GIL while SQLite
+    works).  Connections are opened on first use and then reused.  With
+    size=None the pool hands out the one connection `connect` returns to
+    everyone, which is what the in-memory database needs.
+    """
+
+    def __init__(self, connect, size=None):
+        self._connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size) if size else None
+        self._shared = None if size else connect()
+        self._lock = threading.Lock()
+        self.opened = 0 if size else 1
+
+    @classmethod
+    def shared(cls, db):
+        """A pool that always hands out db."""
+        return cls(lambda: db)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check a connection out, waiting for one if all are in use."""
+        if self._slots is None:
+            yield self._shared
+            return
+
+        self._slots.acquire()
+        try:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                db = self._connect()
+                with self._lock:
+                    self.opened += 1
+            try:
+                yield db
+            finally:
+                self._idle.put(db)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {'size': self.size, 'opened': self.opened, 'idle': self._idle.qsize()}
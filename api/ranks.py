@@ -0,0 +1,100 @@
+import bisect
+import collections
+import sys
+from array import array
+
+from backends import nocase
+
+
+def percentile_rank(values, value):
+    """Percent of the sorted values below value, counting ties as half."""
+    if not values or value is None:
+        return None
+    below = bisect.bisect_left(values, value)
+    equal = bisect.bisect_right(values, value, below) - below
+    return round(100 * (below + equal / 2) / len(values), 1)
+
+
+class Distributions:
+    """Sorted Raw_values of every county for each measure and year.
+
+    There is one distribution per (measure, Data_Release_Year, Year_span)
+    across the country, and one per state within it, each counting a
+    county's value once.  They are computed when the database is built
+    and stored in the county_distributions table (and in snapshots), so
+    loading them reads a few thousand arrays and ranking a value is two
+    binary searches instead of a scan of county_health_rankings.
+    """
+
+    def __init__(self, groups=None):
+        # (nocase measure, release year, year span, state_key or None) -> sorted values
+        self._values = groups if groups is not None else {}
+
+    @classmethod
+    def compute(cls, db):
+        """Compute the distributions from db's county_health_rankings."""
+        cursor = db.cursor()
+        cursor.row_factory = None  # plain tuples; there are a lot of rows
+        # Each county's distinct values per measure and year (state and
+        # national rows have county code 000 and are left out)
+        by_year = collections.defaultdict(set)
+        for row in cursor.execute('''
+            SELECT Measure_name, Data_Release_Year, Year_span, county_key, state_key, Raw_value
+            FROM county_health_rankings
+            WHERE Raw_value IS NOT NULL AND county_key NOT GLOB '[0-9][0-9]000'
+        '''):
+            by_year[row[:3]].add(row[3:])
+        # Measure names match like the lookups, ignoring case
+        merged = collections.defaultdict(set)
+        for (measure, release, span), counties in by_year.items():
+            merged[nocase(measure), release, span] |= counties
+
+        groups = {}
+        for key, counties in merged.items():
+            groups[key + (None,)] = sorted(value for _, _, value in counties)
+            for _, state_key, value in counties:
+                groups.setdefault(key + (state_key,), []).append(value)
+        for values in groups.values():
+            values.sort()
+        return cls(groups)
+
+    @classmethod
+    def from_db(cls, db):
+        """Load the distributions stored in db's county_distributions table."""
+        cursor = db.cursor()
+        cursor.row_factory = None
+        groups = {}
+        for measure, release, span, state_key, blob in cursor.execute(
+                'SELECT measure, release_year, year_span, state_key, value_blob FROM county_distributions'):
+            values = array('d')
+            values.frombytes(blob)
+            if sys.byteorder != 'little':
+                values.byteswap()
+            groups[measure, release, span, state_key or None] = values
+        return cls(groups)
+
+    def store(self, db):
+        """Replace the contents of db's county_distributions table with these distributions."""
+        db.execute('DELETE FROM county_distributions')
+        rows = []
+        for measure, release, span, state_key, values in self.groups():
+            values = array('d', values)
+            if sys.byteorder != 'little':
+                values.byteswap()  # stored little-endian on every machine
+            rows.append((measure, release, span, state_key or '', values.tobytes()))
+        db.executemany('INSERT INTO county_distributions VALUES (?, ?, ?, ?, ?)', rows)
+
+    def __len__(self):
+        return len(self._values)
+
+    def groups(self):
+        """Return [(measure, release year, year span, state_key or None, sorted values)]."""
+        return [key + (values,) for key, values in self._values.items()]
+
+    def rank(self, measure_name, release_year, year_span, state_key, value):
+        """Return the (state, national) percentile ranks of a value, each None if unknown."""
+        key = (nocase(measure_name), release_year, year_span)
+        national = percentile_rank(self._values.get(key + (None,)), value)
+        if state_key is None or national is None:
+            return None, national
+        return percentile_rank(self._values.get(key + (state_key,)), value), national
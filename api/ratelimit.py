@@ -0,0 +1,36 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """Token buckets per API key, refilled at `rate` tokens per second.
+
+    Each request takes one token; a key whose bucket is empty is turned
+    away until it has refilled.  Buckets start full, so a client can make
+    `burst` requests at once before the rate applies.  A rate of 0 turns
+    limiting off.  Only authenticated keys get a bucket, so the number of
+    buckets is bounded by the configured keys.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> [tokens, last refill time]
+
+    def take(self, key):
+        """Take a token for key; return 0 if allowed, else seconds until one is available."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
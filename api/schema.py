@@ -0,0 +1,94 @@
+"""Declarative validation of JSON request bodies.
+
+A Schema is built once, at import time, from Fields that each list
+(check, error) rules, and compiled into flat tuples.  Validating a body is
+a single pass over them: the first rule that fails gives the error, and
+the values (with defaults filled in and conversions applied) come back in
+a dict.
+"""
+
+MISSING_PARAMETERS = 'Missing required parameters'
+_ABSENT = object()
+
+
+class Field:
+    """One body field: its rules, default and optional conversion.
+
+    Rules only run on values the client sent; the default is used as is.
+    A required field that is missing or empty fails with
+    MISSING_PARAMETERS before any rule runs.
+    """
+
+    def __init__(self, name, *rules, default=None, required=False, convert=None):
+        self.name = name
+        self.rules = rules
+        self.default = default
+        self.required = required
+        self.convert = convert
+
+
+class Schema:
+    def __init__(self, *fields, checks=()):
+        self.fields = fields
+        self._required = tuple(field.name for field in fields if field.required)
+        self._steps = tuple((field.name, field.default, field.rules, field.convert)
+                            for field in fields)
+        # (check(values), error) rules that involve several fields
+        self._checks = tuple(checks)
+
+    def validate(self, data):
+        """Return (values, None) for a valid body, or (None, error message)."""
+        for name in self._required:
+            if not data.get(name):
+                return None, MISSING_PARAMETERS
+        values = {}
+        for name, default, rules, convert in self._steps:
+            value = data.get(name, _ABSENT)
+            if value is _ABSENT:
+                value = default
+            else:
+                for check, error in rules:
+                    if not check(value):
+                        return None, error
+            values[name] = value if convert is None else convert(value)
+        for check, error in self._checks:
+            if not check(values):
+                return None, error
+        return values, None
+
+
+# Rule checks
+
+def is_zip_code(value):
+    return isinstance(value, str) and len(value) == 5 and value.isdigit()
+
+
+def is_int(low=None, high=None):
+    def check(value):
+        return (isinstance(value, int) and not isinstance(value, bool)
+                and (low is None or value >= low) and (high is None or value <= high))
+    return check
+
+
+def is_number(above=None, high=None):
+    def check(value):
+        return (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and (above is None or value > above) and (high is None or value <= high))
+    return check
+
+
+def one_of(choices):
+    choices = frozenset(choices)
+    return lambda value: isinstance(value, str) and value in choices
+
+
+def is_list(value):
+    return isinstance(value, list)
+
+
+def max_length(n):
+    return lambda value: len(value) <= n
+
+
+def is_true(value):
+    return value is True
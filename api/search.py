@@ -0,0 +1,229 @@
+import bisect
+import collections
+import functools
+import heapq
+import re
+import unicodedata
+from array import array
+
+# Lowest trigram similarity (Dice coefficient) a fuzzy match may have
+MIN_SIMILARITY = 0.45
+# Scores of the kinds of match, best first; fuzzy matches score their
+# similarity, scaled below the prefix matches
+EXACT, NAME_PREFIX, WORD_PREFIX = 1.0, 0.9, 0.8
+FUZZY_SCALE = 0.75
+# Searches remembered per index (autocomplete repeats a lot of prefixes)
+CACHE_SIZE = 4096
+
+# Prefix index entries are tier << 32 | place id, so the smallest entries
+# are the best matches: the tier of the match, then the most populous place
+_PLACE = (1 << 32) - 1
+_WORD = 2 << 32  # the key starts at a later word of the name
+_NOT_EXACT = 1 << 32  # added to the entries whose key only starts with the query
+_SCORES = (EXACT, NAME_PREFIX, WORD_PREFIX, WORD_PREFIX)
+
+_NOT_ALNUM = re.compile(r'[^0-9a-z]+')
+
+
+def normalize_place(name):
+    """Lower-case a place name, drop its accents ("Añasco" -> "anasco") and
+    reduce punctuation and spaces to single spaces."""
+    name = (name or '').casefold()
+    if not name.isascii():
+        name = ''.join(c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c))
+    return _NOT_ALNUM.sub(' ', name).strip()
+
+
+def trigrams(name):
+    """Return the set of 3-letter windows of a normalized name, padded with spaces."""
+    padded = f'  {name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PlaceIndex:
+    """Cities (zip_county.default_city) and counties, searchable by name.
+
+    Every word position of every normalized name is a key in sorted lists
+    (of all places, of each kind and of each state), so a prefix query
+    ("cambr", "york") is a binary search for the range of keys that start
+    with it.  Queries that aren't the start of
+    any name (typos, "cambrige") look up the names that start with the same
+    letter and share enough trigrams with them instead.  Both only touch
+    the names that can match, never the ZIP table.  Built once per dataset.
+    """
+
+    def __init__(self, rows=()):
+        # rows: (zip, city, city_state, county, county_state, county_key, zip_pop, zip_pop_in_county)
+        # A ZIP's population counts once for its city, and in proportion to
+        # its share in each of its counties
+        cities, counties = {}, {}
+        for zip_code, city, city_state, county, county_state, key, zip_pop, share in rows:
+            zips = cities.get((city, city_state, None))
+            if zips is None:
+                zips = cities[city, city_state, None] = {}
+            zips[zip_code] = zip_pop
+            zips = counties.get((county, county_state, key))
+            if zips is None:
+                zips = counties[county, county_state, key] = {}
+            zips[zip_code] = zips.get(zip_code, 0.0) + zip_pop * share
+
+        # Spellings that normalize to the same name are one place, shown
+        # with the spelling most of its ZIP codes use
+        places = {}  # (kind, normalized name, state, county_key) -> [name, zips, population, name's zips]
+        for kind, found in (('city', cities), ('county', counties)):
+            for (name, state, key), zips in found.items():
+                norm = normalize_place(name)
+                if not norm:
+                    continue
+                name = name.strip()
+                place = places.get((kind, norm, state, key))
+                if place is None:
+                    place = places[kind, norm, state, key] = [name, set(), 0.0, len(zips)]
+                elif (len(zips), place[0]) > (place[3], name):
+                    place[0], place[3] = name, len(zips)
+                for zip_code, population in zips.items():
+                    if zip_code not in place[1]:
+                        place[1].add(zip_code)
+                        place[2] += population
+
+        # Most populous first, so equally good matches come out in that order
+        order = sorted(places, key=lambda p: (-round(places[p][2]), p[1], p[2] or '', p[0], p[3] or ''))
+        self._places = [
+            (p[0], places[p][0], p[2], p[3], sorted(places[p][1]), round(places[p][2]))
+            for p in order
+        ]
+        names = {}  # normalized name -> ids of the places with it, in order
+        for i, p in enumerate(order):
+            names.setdefault(p[1], []).append(i)
+        self._names = list(names)
+        self._name_places = list(names.values())
+
+        # Prefix indexes of all places, of each kind and of each state
+        entries = collections.defaultdict(list)
+        for name, ids in names.items():
+            words = name.split(' ')
+            for w in range(len(words)):
+                key = ' '.join(words[w:])
+                tier = _WORD if w else 0
+                for i in ids:
+                    entry = (key, tier | i)
+                    entries[None].append(entry)
+                    entries[order[i][0]].append(entry)
+                    entries[order[i][2]].append(entry)
+        self._prefixes = {}
+        for scope, scope_entries in entries.items():
+            scope_entries.sort()
+            self._prefixes[scope] = ([key for key, _ in scope_entries],
+                                     array('Q', [entry for _, entry in scope_entries]))
+
+        # Trigram postings, split by the first letter of the name; the
+        # leading trigram ("  c") is the first letter, so it isn't listed
+        postings = collections.defaultdict(list)
+        self._trigram_counts = array('H')
+        for n, name in enumerate(self._names):
+            grams = trigrams(name)
+            self._trigram_counts.append(len(grams))
+            grams.discard('  ' + name[0])
+            for gram in grams:
+                postings[name[0] + gram].append(n)
+        self._postings = {key: array('I', ids) for key, ids in postings.items()}
+
+        self.search = functools.lru_cache(maxsize=CACHE_SIZE)(self._search)
+
+    @classmethod
+    def from_db(cls, db):
+        cursor = db.cursor()
+        cursor.row_factory = None
+        return cls.from_rows(cursor.execute('''
+            SELECT zip, default_city, default_state, county, state_abbreviation, county_key,
+                zip_pop, zip_pop_in_county
+            FROM zip_county
+        '''))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the index from zip_county rows as stored (populations as text)."""
+        from dataset import _real  # dataset imports this module
+
+        return cls(
+            (zip_code, city or '', city_state, county or '', county_state, key,
+             _real(zip_pop or '') or 0.0, _real(share or '') or 0.0)
+            for zip_code, city, city_state, county, county_state, key, zip_pop, share in rows
+        )
+
+    def __len__(self):
+        return len(self._places)
+
+    def _search(self, query, limit=10, kind=None, state=None):
+        """Return [(score, match, place)] of the best limit places for a query, best first.
+
+        match is 'exact', 'prefix' or 'fuzzy', and place is (kind, name,
+        state, county_key or None, zips, population).  kind ('city' or
+        'county') and state (2-letter abbreviation) narrow the results.
+        """
+        query = normalize_place(query)
+        if not query:
+            return []
+        state = state.upper() if state else None
+
+        def wanted(i):
+            place = self._places[i]
+            return (kind is None or place[0] == kind) and (state is None or place[2] == state)
+
+        # Keys equal to the query, then the keys it is a prefix of
+        keys, entries = self._prefixes.get(state or kind, ([], ()))
+        first = bisect.bisect_left(keys, query)
+        middle = bisect.bisect_right(keys, query, first)
+        last = bisect.bisect_left(keys, query + '\uffff', middle)
+        if state and kind:
+            # A state's places of both kinds; there are only a few of them
+            found = heapq.nsmallest(2 * limit, (entry for entry in entries[first:middle]
+                                                if wanted(entry & _PLACE)))
+            found += [entry + _NOT_EXACT for entry in heapq.nsmallest(
+                2 * limit, (entry for entry in entries[middle:last] if wanted(entry & _PLACE)))]
+        else:
+            # A place turns up once per word of its name that the query
+            # starts, so twice the limit leaves enough after duplicates
+            found = heapq.nsmallest(2 * limit, entries[first:middle])
+            found += [entry + _NOT_EXACT for entry in heapq.nsmallest(2 * limit, entries[middle:last])]
+
+        best = {}  # place id -> (score, match)
+        for entry in sorted(found):
+            i, tier = entry & _PLACE, entry >> 32
+            if i not in best:
+                best[i] = (_SCORES[tier], 'exact' if tier == 0 else 'prefix')
+
+        if not best:
+            # Most similar names first, until the limit is reached and the
+            # similarity drops
+            score = None
+            for n, similarity in sorted(self._similar(query), key=lambda item: -item[1]):
+                if len(best) >= limit and round(similarity * FUZZY_SCALE, 3) < score:
+                    break
+                score = round(similarity * FUZZY_SCALE, 3)
+                for i in self._name_places[n]:
+                    if wanted(i):
+                        best[i] = (score, 'fuzzy')
+
+        # Place ids are in population order, so they break ties
+        top = heapq.nsmallest(limit, best.items(), key=lambda item: (-item[1][0], item[0]))
+        return [(score, match, self._places[i]) for i, (score, match) in top]
+
+    def _similar(self, query):
+        # Names sharing enough trigrams with query: [(name id, Dice similarity)]
+        # Only names with the same first letter; a typo there isn't found
+        grams = trigrams(query)
+        size = len(grams)
+        grams.discard('  ' + query[0])
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self._postings.get(query[0] + gram, ()))
+        # Dice >= MIN_SIMILARITY needs at least this many shared trigrams
+        # (besides the leading one), even for a name with no other trigrams
+        needed = MIN_SIMILARITY * size / (2 - MIN_SIMILARITY) - 1
+        found = []
+        for n in [n for n, count in shared.items() if count >= needed]:
+            similarity = 2 * (shared[n] + 1) / (size + self._trigram_counts[n])
+            if similarity >= MIN_SIMILARITY:
+                found.append((n, similarity))
+        return found
@@ -0,0 +1,574 @@
+"""Compact, memory-mapped snapshot of the data /county_data serves.
+
+A snapshot is one file built offline from the loaded database
+(`python3 csv_to_sqlite.py --snapshot`).  It holds every distinct
+county_health_rankings row column by column, with the strings interned in
+one sorted string table, the county centroids and adjacency, the
+per-state and national Raw_value distributions, plus the lookup indexes that SQLite or
+MemoryBackend would otherwise build at startup.  Opening it maps the file
+and reads a small header, so a fresh process can serve right away, and the
+pages are shared by every process that maps the same file.
+
+Layout (little-endian):
+
+    header    magic, format version, section count, BLAKE2b checksum of
+              everything after the header
+    sections  name, array typecode, offset and length of each section
+    data      8-byte aligned arrays, read through memoryview casts
+
+String columns hold ids into the string table, which is sorted so ids
+compare like the strings themselves.  Missing strings are NO_STRING,
+missing reals NaN and missing integers NO_INTEGER.
+"""
+import bisect
+import functools
+import hashlib
+import json
+import math
+import mmap
+import operator
+import os
+import struct
+import sys
+from array import array
+
+from backends import CHR_COLUMNS, MEASURE_NAME, _newest_first, nocase
+from geo import CountyIndex
+from ranks import Distributions
+from search import PlaceIndex
+
+MAGIC = b'CHRSNAP\x00'
+# Bumped whenever the layout changes; older snapshots are ignored
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sII32s')
+SECTION = struct.Struct('<48s8sQQ')
+ALIGN = 8
+
+NO_STRING = 0xFFFFFFFF
+NO_INTEGER = -2 ** 31
+
+ZIP_COLUMNS = (
+    'zip', 'default_state', 'county', 'county_state', 'state_abbreviation', 'county_code',
+    'zip_pop', 'zip_pop_in_county', 'n_counties', 'default_city', 'county_key', 'state_key',
+)
+REAL_COLUMNS = {'Numerator', 'Denominator', 'Raw_value',
+                'Confidence_Interval_Lower_Bound', 'Confidence_Interval_Upper_Bound'}
+INTEGER_COLUMNS = {'Data_Release_Year', 'Year_start', 'Year_end'}
+# Rows kept for sample_zips(), in file order
+SAMPLE_ZIPS = 100
+
+
+class SnapshotError(ValueError):
+    """The file is not a snapshot this version can read."""
+
+
+def _typecode(column):
+    if column in REAL_COLUMNS:
+        return 'd'
+    if column in INTEGER_COLUMNS:
+        return 'i'
+    return 'I'
+
+
+def write_snapshot(db, path):
+    """Write a snapshot of db's county_health_rankings, zip_county and county geography to path.
+
+    Rows are de-duplicated like the lookups' SELECT DISTINCT and sorted by
+    county, measure and newest year first (ties in file order), so each
+    county and measure is one contiguous run.
+    """
+    from dataset import _real  # dataset imports this module
+
+    cursor = db.cursor()
+    cursor.row_factory = None
+
+    # county_health_rankings, with the columns the indexes need at the end
+    rows = {}
+    for row in cursor.execute(f'''
+        SELECT {', '.join(CHR_COLUMNS)}, Year_start, Year_end, county_key, state_key
+        FROM county_health_rankings
+        ORDER BY rowid
+    '''):
+        rows.setdefault(row, len(rows))
+    rows = list(rows)
+    zips = cursor.execute(
+        f'SELECT {", ".join(ZIP_COLUMNS)} FROM zip_county ORDER BY rowid').fetchall()
+    geo = cursor.execute(
+        'SELECT county_key, name, state, lat, lon FROM county_geo ORDER BY rowid').fetchall()
+    distributions = sorted(Distributions.from_db(db).groups(),
+                           key=lambda group: tuple(str(part) for part in group[:4]))
+    adjacency = cursor.execute(
+        'SELECT county_key, neighbor_key FROM county_adjacency ORDER BY rowid').fetchall()
+
+    strings = set()
+    string_columns = [i for i, column in enumerate(CHR_COLUMNS) if _typecode(column) == 'I']
+    for row in rows:
+        strings.update(row[i] for i in string_columns)
+        strings.update(row[-2:])
+        strings.add(nocase(row[MEASURE_NAME]))
+    for row in zips:
+        strings.update(row)
+    for row in geo:
+        strings.update(row[:3])
+    for group in distributions:
+        strings.update((group[0], group[2], group[3]))
+    strings.discard(None)
+    strings = sorted(strings)
+    ids = {s: i for i, s in enumerate(strings)}
+
+    def string_id(value):
+        return NO_STRING if value is None else ids[value]
+
+    end = len(CHR_COLUMNS)
+    newest = [_newest_first(row[end], row[end + 1]) for row in rows]
+    county = [string_id(row[end + 2]) for row in rows]
+    state = [string_id(row[end + 3]) for row in rows]
+    measure = [ids[nocase(row[MEASURE_NAME])] for row in rows]
+
+    # Rows are stored in county order; the other orders are permutations of it
+    def ordered(positions, group):
+        # newest first, ties in file order (positions are in file order)
+        positions = sorted(positions, key=lambda i: newest[i], reverse=True)
+        return sorted(positions, key=group)
+
+    order = ordered(range(len(rows)), lambda i: (county[i], measure[i]))
+    position = {row: i for i, row in enumerate(order)}
+    state_order = [position[i] for i in ordered(range(len(rows)), lambda i: (state[i], measure[i]))]
+    measure_order = [position[i] for i in ordered(range(len(rows)), lambda i: measure[i])]
+    any_order = [position[i] for i in ordered(range(len(rows)), lambda i: 0)]
+
+    sections = {}
+    for c, column in enumerate(CHR_COLUMNS + ('Year_start', 'Year_end')):
+        code = _typecode(column)
+        if code == 'I':
+            values = (string_id(rows[i][c]) for i in order)
+        elif code == 'd':
+            values = (math.nan if rows[i][c] is None else rows[i][c] for i in order)
+        else:
+            values = (NO_INTEGER if rows[i][c] is None else rows[i][c] for i in order)
+        sections['chr.' + column] = array(code, values)
+
+    def index(name, keys, positions):
+        # One key per run of equal keys(p) over the row positions p, with
+        # where each run starts in positions (and a final end)
+        index_keys, starts = array('Q'), array('I')
+        for n, p in enumerate(positions):
+            key = keys(p)
+            if not index_keys or key != index_keys[-1]:
+                index_keys.append(key)
+                starts.append(n)
+        starts.append(len(positions))
+        sections[name + '.keys'] = index_keys
+        sections[name + '.starts'] = starts
+
+    def composite(first, second):
+        return first << 32 | second
+
+    index('county', lambda p: composite(county[order[p]], measure[order[p]]), range(len(order)))
+    index('state', lambda p: composite(state[order[p]], measure[order[p]]), state_order)
+    index('measure', lambda p: measure[order[p]], measure_order)
+    sections['state.rows'] = array('I', state_order)
+    sections['measure.rows'] = array('I', measure_order)
+    sections['any.rows'] = array('I', any_order)
+
+    # zip_county, grouped by ZIP in file order
+    zip_order = sorted(range(len(zips)), key=lambda i: zips[i][0])
+    for c, column in enumerate(ZIP_COLUMNS):
+        sections['zip.' + column] = array('I', (string_id(zips[i][c]) for i in zip_order))
+    zip_codes, zip_starts = array('I'), array('I')
+    for n, i in enumerate(zip_order):
+        if not zip_codes or zips[i][0] != f'{zip_codes[-1]:05d}':
+            zip_codes.append(int(zips[i][0]))
+            zip_starts.append(n)
+    zip_starts.append(len(zip_order))
+    sections['zip.codes'] = zip_codes
+    sections['zip.starts'] = zip_starts
+
+    # Every county of each ZIP with its population share, largest first,
+    # the way dataset.ZipCounties computes them
+    spans, weights = array('I'), array('d')
+    for z in range(len(zip_codes)):
+        group = [(n, _real(zips[zip_order[n]][7] or '') or 0.0)
+                 for n in range(zip_starts[z], zip_starts[z + 1])]
+        total = sum(weight for _, weight in group)
+        group.sort(key=lambda item: -item[1])
+        for n, weight in group:
+            spans.append(n)
+            weights.append(weight / total if total > 0 else 1 / len(group))
+    sections['zip.spans'] = spans
+    sections['zip.weights'] = weights
+
+    # County centroids, and adjacency as pairs of positions in them
+    sections['geo.county_key'] = array('I', (string_id(row[0]) for row in geo))
+    sections['geo.name'] = array('I', (string_id(row[1]) for row in geo))
+    sections['geo.state'] = array('I', (string_id(row[2]) for row in geo))
+    sections['geo.lat'] = array('d', (row[3] for row in geo))
+    sections['geo.lon'] = array('d', (row[4] for row in geo))
+    geo_position = {row[0]: n for n, row in enumerate(geo)}
+    sections['geo.adjacency'] = array('I', (
+        geo_position[key] for pair in adjacency if all(key in geo_position for key in pair)
+        for key in pair
+    ))
+
+    # Distributions: one group per (measure, release year, span, state or
+    # NO_STRING for the country) with its slice of the values
+    sections['rank.measure'] = array('I', (string_id(group[0]) for group in distributions))
+    sections['rank.release'] = array('i', (NO_INTEGER if group[1] is None else group[1]
+                                            for group in distributions))
+    sections['rank.span'] = array('I', (string_id(group[2]) for group in distributions))
+    sections['rank.state'] = array('I', (string_id(group[3]) for group in distributions))
+    rank_starts, rank_values = array('I', [0]), array('d')
+    for group in distributions:
+        rank_values.extend(group[4])
+        rank_starts.append(len(rank_values))
+    sections['rank.starts'] = rank_starts
+    sections['rank.values'] = rank_values
+
+    state_measures = {}
+    all_measures = {}
+    for row in rows:
+        state_measures.setdefault(row[end + 3], {}).setdefault(row[MEASURE_NAME], None)
+        all_measures.setdefault(row[MEASURE_NAME], None)
+    meta = {
+        'byteorder': sys.byteorder,
+        'chr_rows': len(rows),
+        'zip_rows': len(zips),
+        'state_measures': {k: list(v) for k, v in state_measures.items()},
+        'all_measures': list(all_measures),
+        'sample_zips': [row[0] for row in zips[:SAMPLE_ZIPS]],
+    }
+    sections['meta'] = json.dumps(meta).encode('utf-8')
+    offsets, data = array('Q', [0]), bytearray()
+    for s in strings:
+        data += s.encode('utf-8')
+        offsets.append(len(data))
+    sections['strings.offsets'] = offsets
+    sections['strings.data'] = bytes(data)
+
+    _write_sections(path, sections)
+
+
+def _write_sections(path, sections):
+    table_size = HEADER.size + SECTION.size * len(sections)
+    offset = _aligned(table_size)
+    entries, chunks = [], []
+    for name, value in sections.items():
+        assert len(name) <= 48, name
+        code = value.typecode if isinstance(value, array) else 'B'
+        raw = value.tobytes() if isinstance(value, array) else value
+        entries.append(SECTION.pack(name.encode('ascii'), code.encode('ascii'), offset, len(raw)))
+        padding = _aligned(len(raw)) - len(raw)
+        chunks.append(raw + b'\0' * padding)
+        offset += len(raw) + padding
+
+    body = b''.join(entries) + b'\0' * (_aligned(table_size) - table_size) + b''.join(chunks)
+    checksum = hashlib.blake2b(body, digest_size=32).digest()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(sections), checksum))
+        f.write(body)
+    os.replace(tmp_path, path)
+
+
+def _aligned(size):
+    return -(-size // ALIGN) * ALIGN
+
+
+class Snapshot:
+    """A snapshot file mapped into memory.
+
+    Sections are memoryviews straight into the mapping; nothing is copied
+    or parsed up front except the header and the small `meta` section.
+    With verify=True the checksum is checked first, which reads the whole
+    file.
+    """
+
+    def __init__(self, path, verify=False):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        if len(view) < HEADER.size:
+            raise SnapshotError(f'{path} is too short to be a snapshot')
+        magic, version, count, checksum = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise SnapshotError(f'{path} is not a snapshot')
+        if version != FORMAT_VERSION:
+            raise SnapshotError(f'{path} has format version {version}, expected {FORMAT_VERSION}')
+        if verify and hashlib.blake2b(view[HEADER.size:], digest_size=32).digest() != checksum:
+            raise SnapshotError(f'{path} is corrupt (checksum mismatch)')
+
+        self.sections = {}
+        for i in range(count):
+            name, code, offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            if offset + length > len(view):
+                raise SnapshotError(f'{path} is truncated')
+            section = view[offset:offset + length]
+            code = code.rstrip(b'\0').decode('ascii')
+            self.sections[name.rstrip(b'\0').decode('ascii')] = section if code == 'B' else section.cast(code)
+
+        self.meta = json.loads(bytes(self.sections['meta']))
+        if self.meta['byteorder'] != sys.byteorder:
+            raise SnapshotError(f'{path} was built on a {self.meta["byteorder"]}-endian machine')
+        self._offsets = self.sections['strings.offsets']
+        self._data = self.sections['strings.data']
+        self._strings = {}
+
+    def string(self, i):
+        """Return string i of the string table, or None for NO_STRING."""
+        if i == NO_STRING:
+            return None
+        value = self._strings.get(i)
+        if value is None:
+            value = str(self._data[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+            self._strings[i] = value  # a handful of distinct values per column
+        return value
+
+    def string_id(self, value):
+        """Return the id of value in the string table, or None."""
+        low, high = 0, len(self._offsets) - 1
+        while low < high:
+            mid = (low + high) // 2
+            if self.string(mid) < value:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self._offsets) - 1 and self.string(low) == value:
+            return low
+        return None
+
+
+def _real_value(value):
+    return None if value != value else value  # NaN marks a missing value
+
+
+def _integer_value(value):
+    return None if value == NO_INTEGER else value
+
+
+class SnapshotBackend:
+    """Serves the /county_data lookups from a Snapshot.
+
+    Rows are read column by column from the mapping and turned into
+    tuples in CHR_COLUMNS order only for the rows a request returns.  The
+    results match MemoryBackend's.
+    """
+
+    name = 'snapshot'
+    uses_fallback_tables = False
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        sections = snapshot.sections
+        string = snapshot.string
+        self._columns = []
+        for column in CHR_COLUMNS:
+            code = _typecode(column)
+            convert = string if code == 'I' else _real_value if code == 'd' else _integer_value
+            self._columns.append((sections['chr.' + column], convert))
+        self._zip_columns = {column: sections['zip.' + column] for column in ZIP_COLUMNS}
+        self._zip_codes = sections['zip.codes']
+        self._zip_starts = sections['zip.starts']
+        self._indexes = {
+            name: (sections[name + '.keys'], sections[name + '.starts'], sections.get(name + '.rows'))
+            for name in ('county', 'state', 'measure')
+        }
+        self._any_rows = sections['any.rows']
+        self._year_end = sections['chr.Year_end']
+        self.zip_counties = SnapshotZipCounties(self)
+        self.zip_count = snapshot.meta['zip_rows']
+        self.health_count = snapshot.meta['chr_rows']
+
+    @functools.cached_property
+    def county_index(self):
+        """The CountyIndex, built on first use so opening stays instant."""
+        # Snapshots without the geo sections get an empty index
+        sections = self.snapshot.sections
+        if 'geo.county_key' not in sections:
+            return CountyIndex()
+        keys = [self.snapshot.string(i) for i in sections['geo.county_key']]
+        string = self.snapshot.string
+        counties = zip(keys, map(string, sections['geo.name']), map(string, sections['geo.state']),
+                       sections['geo.lat'], sections['geo.lon'])
+        pairs = sections['geo.adjacency']
+        return CountyIndex(counties, ((keys[pairs[i]], keys[pairs[i + 1]])
+                                      for i in range(0, len(pairs), 2)))
+
+    @functools.cached_property
+    def distributions(self):
+        """The Distributions, as slices of the mapped values, built on first use."""
+        sections = self.snapshot.sections
+        if 'rank.starts' not in sections:
+            return Distributions()
+        string = self.snapshot.string
+        starts, values = sections['rank.starts'], sections['rank.values']
+        groups = {}
+        for n, (measure, release, span, state) in enumerate(zip(
+                sections['rank.measure'], sections['rank.release'],
+                sections['rank.span'], sections['rank.state'])):
+            groups[string(measure), _integer_value(release), string(span), string(state)] = \
+                values[starts[n]:starts[n + 1]]
+        return Distributions(groups)
+
+    @functools.cached_property
+    def places(self):
+        """The PlaceIndex of the zip sections."""
+        string = self.snapshot.string
+        columns = [self._zip_columns[column] for column in (
+            'zip', 'default_city', 'default_state', 'county', 'state_abbreviation', 'county_key',
+            'zip_pop', 'zip_pop_in_county')]
+        return PlaceIndex.from_rows(tuple(map(string, row)) for row in zip(*columns))
+
+    def _row(self, i):
+        return tuple(convert(values[i]) for values, convert in self._columns)
+
+    def _rows(self, positions):
+        return [self._row(i) for i in positions]
+
+    def _group(self, index, key, limit):
+        # Row positions of the group with `key` in one of the indexes
+        keys, starts, rows = self._indexes[index]
+        if key is None:
+            return ()
+        i = bisect.bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return ()
+        start, end = starts[i], min(starts[i + 1], starts[i] + limit)
+        return range(start, end) if rows is None else rows[start:end]
+
+    def _key(self, first, measure_name):
+        first = self.snapshot.string_id(first)
+        measure = self.snapshot.string_id(nocase(measure_name))
+        if first is None or measure is None:
+            return None
+        return first << 32 | measure
+
+    def _zip_range(self, zip_code):
+        if not (isinstance(zip_code, str) and zip_code.isdigit() and len(zip_code) == 5):
+            return range(0)
+        code = int(zip_code)
+        i = bisect.bisect_left(self._zip_codes, code)
+        if i == len(self._zip_codes) or self._zip_codes[i] != code:
+            return range(0)
+        return range(self._zip_starts[i], self._zip_starts[i + 1])
+
+    def _zip_string(self, column, n):
+        return self.snapshot.string(self._zip_columns[column][n])
+
+    def find_zip(self, zip_code):
+        string = self.snapshot.string
+        return [{column: string(values[n]) for column, values in self._zip_columns.items()}
+                for n in self._zip_range(zip_code)]
+
+    def find_zips(self, zip_codes):
+        found = {}
+        for zip_code in zip_codes:
+            rows = self.find_zip(zip_code)
+            if rows:
+                found[zip_code] = rows
+        return found
+
+    def resolve_zip(self, zip_code):
+        for n in self._zip_range(zip_code):
+            return self._zip_string('county_key', n), self._zip_string('state_key', n)
+        return None
+
+    def county_rows(self, county_key, measure_name, limit):
+        return self._rows(self._group('county', self._key(county_key, measure_name), limit))
+
+    def county_series(self, county_key, measure_name, year_from, year_to, limit):
+        # County groups are contiguous and newest first, so Year_end descends
+        # within one (rows without one hold NO_INTEGER and come last)
+        group = self._group('county', self._key(county_key, measure_name), self.health_count)
+        if not group:
+            return []
+        years = self._year_end
+        start = bisect.bisect_left(years, -year_to, group.start, group.stop, key=operator.neg)
+        end = bisect.bisect_right(years, -year_from, start, group.stop, key=operator.neg)
+        return self._rows(range(start, min(end, start + limit)))
+
+    def county_profile(self, county_key, measure_names, limit):
+        # A county's groups are adjacent in the county index, one per measure
+        county = self.snapshot.string_id(county_key)
+        if county is None:
+            return {}
+        string_id = self.snapshot.string_id
+        wanted = {}
+        for name in measure_names:
+            wanted.setdefault(string_id(nocase(name)), []).append(name)
+        keys, starts, _ = self._indexes['county']
+        first = bisect.bisect_left(keys, county << 32)
+        last = bisect.bisect_left(keys, (county + 1) << 32)
+        profile = {}
+        for i in range(first, last):
+            names = wanted.get(keys[i] & 0xFFFFFFFF)
+            if names:
+                rows = self._rows(range(starts[i], min(starts[i + 1], starts[i] + limit)))
+                profile.update((name, rows) for name in names)
+        return profile
+
+    def state_rows(self, state_key, measure_name, limit):
+        return self._rows(self._group('state', self._key(state_key, measure_name), limit))
+
+    def county_rows_many(self, county_keys, measure_name, limit):
+        found = {}
+        for key in county_keys:
+            rows = self.county_rows(key, measure_name, limit)
+            if rows:
+                found[key] = rows
+        return found
+
+    def state_rows_many(self, state_keys, measure_name, limit):
+        found = {}
+        for key in state_keys:
+            rows = self.state_rows(key, measure_name, limit)
+            if rows:
+                found[key] = rows
+        return found
+
+    def measure_rows(self, measure_name, limit):
+        return self._rows(self._group('measure', self.snapshot.string_id(nocase(measure_name)), limit))
+
+    def any_rows(self, limit):
+        return self._rows(self._any_rows[:limit])
+
+    def county_measures(self, county_key):
+        county = self.snapshot.string_id(county_key)
+        if county is None:
+            return []
+        keys, starts, _ = self._indexes['county']
+        names, string = self._columns[MEASURE_NAME][0], self.snapshot.string
+        first = bisect.bisect_left(keys, county << 32)
+        last = bisect.bisect_left(keys, (county + 1) << 32)
+        # Alphabetical, ignoring case, like SQLiteBackend (not string id order)
+        return sorted((string(names[starts[i]]) for i in range(first, last)), key=nocase)
+
+    def state_measures(self, state_key, limit):
+        return self.snapshot.meta['state_measures'].get(state_key, [])[:limit]
+
+    def all_measures(self, limit):
+        return self.snapshot.meta['all_measures'][:limit]
+
+    def sample_zips(self, limit):
+        return self.snapshot.meta['sample_zips'][:limit]
+
+
+class SnapshotZipCounties:
+    """dataset.ZipCounties for a snapshot, read from its zip sections."""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._spans = backend.snapshot.sections['zip.spans']
+        self._weights = backend.snapshot.sections['zip.weights']
+
+    def get(self, zip_code):
+        """Return [(county_key, state_key, county, state, weight), ...] or None."""
+        rows = self._backend._zip_range(zip_code)
+        if not rows:
+            return None
+        string = self._backend._zip_string
+        return [
+            (string('county_key', n), string('state_key', n), string('county', n),
+             string('state_abbreviation', n), self._weights[i])
+            for i, n in ((i, self._spans[i]) for i in rows)
+        ]
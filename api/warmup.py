@@ -0,0 +1,96 @@
+"""Background loading of the data layer.
+
+The web layer imports only this module at startup.  start() imports the
+data modules and loads the dataset on a background thread, so the process
+answers health checks and serves the HTML pages while the data loads.
+Handlers that need the data call get_dataset(), which waits for the first
+load to finish instead of starting a load of its own.
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+
+# Seconds a request waits for the first load before it is answered with 503
+READY_TIMEOUT = float(os.environ.get('COUNTY_READY_TIMEOUT', '30'))
+
+logger = logging.getLogger(__name__)
+
+_ready = threading.Event()
+_start_lock = threading.Lock()
+_thread = None
+_started_at = None
+
+
+class DataNotReady(Exception):
+    """The dataset is still loading and didn't finish within the timeout."""
+
+
+def data_module():
+    """Import and return the dataset module (the data layer)."""
+    return importlib.import_module('dataset')
+
+
+def _load():
+    dataset = None
+    try:
+        dataset = data_module().get_dataset()
+        logger.info("Dataset ready %.3f s after warm-up started", time.monotonic() - _started_at)
+    except Exception:
+        # Requests retry the load themselves (see get_dataset)
+        logger.exception("Error warming up the dataset")
+    finally:
+        _ready.set()
+    if dataset is not None:
+        # Only /county_data/search needs the place index, so build it
+        # after the data is ready rather than before
+        try:
+            dataset.places
+        except Exception:
+            logger.exception("Error building the place search index")
+
+
+def start():
+    """Start loading the dataset in the background, once per process."""
+    global _thread, _started_at
+    if _thread is not None:
+        return
+    with _start_lock:
+        if _thread is None:
+            _started_at = time.monotonic()
+            _thread = threading.Thread(target=_load, name='county-data-warmup', daemon=True)
+            _thread.start()
+
+
+def is_ready():
+    """True once the first load has finished (or failed)."""
+    return _ready.is_set()
+
+
+def current_dataset():
+    """Return the loaded dataset without waiting or loading, or None."""
+    return data_module().loaded_dataset() if _ready.is_set() else None
+
+
+def get_dataset(timeout=None):
+    """Return the process-wide dataset, waiting for the warm-up if needed.
+
+    Raises DataNotReady if the first load takes longer than `timeout`
+    seconds (READY_TIMEOUT by default).  After a failed warm-up each call
+    tries the load again, as dataset.get_dataset() does.
+    """
+    start()
+    if not _ready.wait(READY_TIMEOUT if timeout is None else timeout):
+        raise DataNotReady('The dataset is still loading, try again shortly')
+    return data_module().get_dataset()
+
+
+def _after_fork():
+    # A load in progress in the parent has no thread in the child; start over
+    global _thread
+    if not _ready.is_set():
+        _thread = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
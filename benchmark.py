@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark for the /county_data endpoints.
+
+Generates a synthetic county_health_rankings.csv about the size of the real
+one (next to a copy of csv_data/zip_county.csv), then drives the Flask app
+in-process through its test client and over a local HTTP server.  Every
+configuration runs in a fresh process so cold start time and peak RSS are
+measured from scratch.  Results are written as JSON for comparing releases.
+
+    python3 benchmark.py                       # everything, JSON on stdout
+    python3 benchmark.py --modes client --backends memory -o results.json
+"""
+
+import argparse
+import csv
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+
+API_KEY = 'cs1060-hw4-apikey'
+RESULT_VERSION = 1
+
+MEASURES = [
+    "Violent crime rate", "Unemployment", "Children in poverty", "Diabetic screening",
+    "Mammography screening", "Preventable hospital stays", "Uninsured",
+    "Sexually transmitted infections", "Physical inactivity", "Adult obesity",
+    "Premature Death", "Daily fine particulate matter",
+]
+HEADER = [
+    'State', 'County', 'State_code', 'County_code', 'Year_span', 'Measure_name', 'Measure_id',
+    'Numerator', 'Denominator', 'Raw_value', 'Confidence_Interval_Lower_Bound',
+    'Confidence_Interval_Upper_Bound', 'Data_Release_Year', 'fipscode',
+]
+RELEASE_YEARS = range(2016, 2025)
+# No state has rows for this measure here, so its ZIP codes exercise the
+# state fallback and sample_mode
+SAMPLE_STATE, SAMPLE_MEASURE = 'PR', 'Daily fine particulate matter'
+
+SCENARIOS = ('single', 'miss', 'sample_mode', 'batch')
+
+
+def make_fixture(out_dir, seed=1060):
+    """Write a synthetic dataset to out_dir/csv_data and return its row count.
+
+    Every county in zip_county.csv gets every measure for each release
+    year (a few percent are left out at random), plus one state-level row
+    per state, measure and year, like the real file.
+    """
+    csv_dir = os.path.join(out_dir, 'csv_data')
+    os.makedirs(csv_dir, exist_ok=True)
+    shutil.copy(os.path.join(ROOT, 'csv_data', 'zip_county.csv'), csv_dir)
+
+    rng = random.Random(seed)
+    counties = {}
+    with open(os.path.join(csv_dir, 'zip_county.csv'), encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            fips = row['county_code'].zfill(5)
+            if fips.isdigit() and int(fips) and row['state_abbreviation']:
+                counties.setdefault(fips, (row['state_abbreviation'], row['county'], row['county_state']))
+    states = {fips[:2]: (abbr, name) for fips, (abbr, _, name) in counties.items()}
+    places = [(fips, abbr, county) for fips, (abbr, county, _) in sorted(counties.items())]
+    places += [(code + '000', abbr, name) for code, (abbr, name) in sorted(states.items())]
+
+    rows = 0
+    with open(os.path.join(csv_dir, 'county_health_rankings.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for fips, abbr, county in places:
+            for measure_id, measure in enumerate(MEASURES, 1):
+                if abbr == SAMPLE_STATE and measure == SAMPLE_MEASURE:
+                    continue
+                for release in RELEASE_YEARS:
+                    if rng.random() < 0.03:
+                        continue
+                    end = release - 2
+                    span = f'{end - 2}-{end}' if measure_id % 3 == 0 else str(end)
+                    value = rng.random()
+                    numerator = '' if measure_id % 4 == 0 else str(rng.randint(1, 50000))
+                    writer.writerow([
+                        abbr, county, fips[:2], fips[2:], span, measure, measure_id, numerator, '',
+                        f'{value:.6f}', f'{value * 0.9:.6f}', f'{value * 1.1:.6f}', release,
+                        str(int(fips)),
+                    ])
+                    rows += 1
+    return rows
+
+
+def zip_pools(csv_dir):
+    """ZIP codes for each scenario: ones with data, unknown and sample-mode ones."""
+    known, sample, taken = [], [], set()
+    with open(os.path.join(csv_dir, 'zip_county.csv'), encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            taken.add(row['zip'])
+            if row['state_abbreviation'] == SAMPLE_STATE:
+                sample.append(row['zip'])
+            elif row['state_abbreviation'] and row['county_code'].strip('0').isdigit():
+                known.append(row['zip'])
+    missing = [f'{z:05d}' for z in range(100000) if f'{z:05d}' not in taken]
+    return known, missing, sample
+
+
+def scenario_requests(name, pools, rng):
+    """Return (path, body, expected_status) for one request of a scenario."""
+    known, missing, sample = pools
+    if name == 'single':
+        return '/county_data', {'zip': rng.choice(known), 'measure_name': rng.choice(MEASURES)}, 200
+    if name == 'miss':
+        return '/county_data', {'zip': rng.choice(missing), 'measure_name': rng.choice(MEASURES)}, 404
+    if name == 'sample_mode':
+        return '/county_data', {'zip': rng.choice(sample), 'measure_name': SAMPLE_MEASURE,
+                                'sample_mode': True}, 200
+    return '/county_data/batch', {'zips': rng.sample(known, 100),
+                                  'measure_names': rng.sample(MEASURES, 3)}, 200
+
+
+def summarize(latencies, errors, wall):
+    latencies = sorted(latencies)
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / wall if wall else None,
+        'latency_ms': {
+            'mean': statistics.fmean(latencies),
+            'p50': cuts[49],
+            'p95': cuts[94],
+            'p99': cuts[98],
+            'max': latencies[-1],
+        },
+    }
+
+
+class HttpClient:
+    """Sends requests to a local server over one keep-alive connection."""
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port)
+
+    def post(self, path, body):
+        self.conn.request('POST', path, json.dumps(body),
+                          {'Content-Type': 'application/json', 'X-API-Key': API_KEY})
+        response = self.conn.getresponse()
+        response.read()
+        return response.status
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, body):
+        return self.client.post(path, json=body, headers={'X-API-Key': API_KEY}).status_code
+
+
+def run_scenario(name, clients, pools, count, seed):
+    """Send `count` requests spread over the clients (one thread each)."""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def worker(client, n, rng):
+        mine = []
+        for _ in range(n):
+            path, body, expected = scenario_requests(name, pools, rng)
+            start = time.perf_counter()
+            status = client.post(path, body)
+            mine.append((time.perf_counter() - start) * 1000)
+            if status != expected:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(mine)
+
+    share = [count // len(clients) + (i < count % len(clients)) for i in range(len(clients))]
+    threads = [threading.Thread(target=worker, args=(c, n, random.Random(seed + i)))
+               for i, (c, n) in enumerate(zip(clients, share))]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def child(config):
+    """Run every scenario for one configuration; the environment is already set."""
+    started = time.perf_counter()
+    from index import app
+
+    pools = zip_pools(os.environ['COUNTY_CSV_DIR'])
+    server = None
+    if config['mode'] == 'http':
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        clients = [HttpClient(server.port) for _ in range(config['concurrency'])]
+    else:
+        clients = [TestClient(app) for _ in range(config['concurrency'])]
+
+    # Cold start: import, data load and the first answered request
+    path, body, _ = scenario_requests('single', pools, random.Random(0))
+    clients[0].post(path, body)
+    result = {'cold_start_ms': (time.perf_counter() - started) * 1000, 'scenarios': {}}
+
+    for name in config['scenarios']:
+        run_scenario(name, clients, pools, config['warmup'], config['seed'] + 1000)
+        result['scenarios'][name] = run_scenario(name, clients, pools, config['requests'], config['seed'])
+
+    if server is not None:
+        server.shutdown()
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_mb'] = rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return result
+
+
+def run_config(config, fixture_dir):
+    env = dict(
+        os.environ,
+        COUNTY_CSV_DIR=os.path.join(fixture_dir, 'csv_data'),
+        COUNTY_DB_PATH=os.path.join(fixture_dir, 'county_health.db' if config['source'] == 'db'
+                                    else 'no-such.db'),
+        COUNTY_SNAPSHOT_PATH=os.path.join(fixture_dir, 'county_health.snap'),
+        COUNTY_RATE_LIMIT='0',
+        COUNTY_DATA_BACKEND=config['backend'],
+        COUNTY_CACHE_MAX_ENTRIES=str(4096 if config['cache'] else 0),
+        COUNTY_RELOAD_CHECK_INTERVAL='-1',
+        LOG_LEVEL='WARNING',
+    )
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+                            env=env, check=True, capture_output=True, text=True).stdout
+    return dict(config, **json.loads(output.splitlines()[-1]))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results):
+    for run in results['runs']:
+        print(f"\n{run['mode']} / {run['backend']} / {run['source']}: cold start "
+              f"{run['cold_start_ms']:.0f} ms, peak RSS {run['peak_rss_mb']:.0f} MB", file=sys.stderr)
+        for name, s in run['scenarios'].items():
+            lat = s['latency_ms']
+            print(f"  {name:12} {s['throughput_rps']:8.0f} req/s  p50 {lat['p50']:7.2f}  "
+                  f"p95 {lat['p95']:7.2f}  p99 {lat['p99']:7.2f} ms  errors {s['errors']}",
+                  file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /county_data endpoints offline.')
+    parser.add_argument('--modes', default='client,http', help='client and/or http')
+    parser.add_argument('--backends', default='sqlite,memory,snapshot',
+                        help='sqlite, memory and/or snapshot (which ignores --sources)')
+    parser.add_argument('--sources', default='db,csv',
+                        help='db (prebuilt database file) and/or csv (load the CSVs at startup)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1, help='client threads')
+    parser.add_argument('--cache', action='store_true', help='leave the response cache on')
+    parser.add_argument('--seed', type=int, default=1060)
+    parser.add_argument('--fixture-dir', help='reuse or keep the generated data here')
+    parser.add_argument('-o', '--output', help='write the JSON results here (default: stdout)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(json.loads(args.child))))
+        return
+
+    fixture_dir = args.fixture_dir or tempfile.mkdtemp(prefix='county-bench-')
+    csv_path = os.path.join(fixture_dir, 'csv_data', 'county_health_rankings.csv')
+    if not os.path.exists(csv_path):
+        print(f"Generating fixture in {fixture_dir}", file=sys.stderr)
+        make_fixture(fixture_dir, args.seed)
+    db_path = os.path.join(fixture_dir, 'county_health.db')
+    if 'db' in args.sources.split(','):
+        from csv_to_sqlite import SCHEMA_VERSION, build_database
+        # A database left by an older release would be ignored by the API
+        version = None
+        if os.path.exists(db_path):
+            with sqlite3.connect(db_path) as db:
+                version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            build_database(db_path, os.path.join(fixture_dir, 'csv_data'))
+    if 'snapshot' in args.backends.split(','):
+        from csv_to_sqlite import build_snapshot
+        from snapshot import Snapshot, SnapshotError
+        snapshot_path = os.path.join(fixture_dir, 'county_health.snap')
+        try:
+            Snapshot(snapshot_path)
+        except (OSError, SnapshotError):
+            build_snapshot(snapshot_path, os.path.join(fixture_dir, 'csv_data'))
+
+    with open(csv_path, newline='') as f:
+        fixture_rows = sum(1 for _ in f) - 1
+
+    results = {
+        'version': RESULT_VERSION,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'fixture': {'county_health_rows': fixture_rows, 'seed': args.seed},
+        'runs': [],
+    }
+    for mode in args.modes.split(','):
+        for backend in args.backends.split(','):
+            sources = ['snapshot'] if backend == 'snapshot' else args.sources.split(',')
+            for source in sources:
+                config = {
+                    'mode': mode, 'backend': backend, 'source': source, 'cache': args.cache,
+                    'scenarios': args.scenarios.split(','), 'requests': args.requests,
+                    'warmup': args.warmup, 'concurrency': args.concurrency, 'seed': args.seed,
+                }
+                print(f"Running {mode} / {backend} / {source}", file=sys.stderr)
+                results['runs'].append(run_config(config, fixture_dir))
+
+    if not args.fixture_dir:
+        shutil.rmtree(fixture_dir, ignore_errors=True)
+
+    print_table(results)
+    body = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+
+
+if __name__ == '__main__':
+    main()
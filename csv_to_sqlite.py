@@ -1,23 +1,35 @@
 #!/usr/bin/env python3
 
 import csv
+import logging
+import os
+import shutil
 import sqlite3
 import sys
 
+# Share the table definitions and CSV loader with the API
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api'))
+
+from dataset import (CSV_DIR, DB_PATH, SNAPSHOT_PATH, SCHEMA_VERSION, create_tables, load_csv_files,
+                     create_indexes, create_fallbacks, create_distributions, open_csv, bulk_load_pragmas,
+                     load_health_csv, init_db, open_db, schema_version)
+from snapshot import Snapshot, write_snapshot
+
 def csv_to_sqlite(db_name, csv_file):
     # Connect to SQLite database (create if not exists)
     conn = sqlite3.connect(db_name)
     cursor = conn.cursor()
     
     # Read CSV file
-    with open(csv_file, 'r') as f:
+    # Detects the encoding, so a byte order mark doesn't end up in the header
+    with open_csv(csv_file) as f:
         csv_reader = csv.reader(f)
         
         # Get headers from first row
         headers = next(csv_reader)
         
-        # Create table name from CSV filename (remove .csv extension)
-        table_name = csv_file.rsplit('.', 1)[0]
+        # Create table name from CSV filename (remove directory and .csv extension)
+        table_name = os.path.basename(csv_file).rsplit('.', 1)[0]
         
         # Create columns string for CREATE TABLE
         columns = ', '.join([f'{header} TEXT' for header in headers])
@@ -36,9 +48,155 @@ def csv_to_sqlite(db_name, csv_file):
         conn.commit()
         conn.close()
 
+def build_database(db_path=DB_PATH, csv_dir=CSV_DIR):
+    """Build the indexed database file the API opens at startup.
+
+    Both CSV files are loaded with the same schema the API uses, indexed and
+    analyzed.  The file is written next to its final location and renamed
+    over it, so running API processes never see a half-written database.
+    """
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        # load_csv_files() turns off the journal: there is nothing to
+        # recover if the build fails half way, just rerun it
+        create_tables(conn)
+        load_csv_files(conn, csv_dir)
+
+        # Don't ship an empty table even if its file was (nearly) empty
+        for table in ('county_health_rankings', 'zip_county'):
+            if conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] == 0:
+                raise ValueError(f'No rows loaded into {table}')
+
+        create_indexes(conn)
+        create_fallbacks(conn)
+        create_distributions(conn)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('ANALYZE')
+        conn.commit()
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, db_path)
+
+def update_database(db_path, csv_file, mode='upsert'):
+    """Add a county_health_rankings CSV file to an existing database file.
+
+    With mode 'upsert' the rows of every Data_Release_Year in the file
+    replace the ones already stored; 'append' adds them all.  Like
+    build_database() the update is made on a copy that is renamed over the
+    original, so running API processes only ever see a complete file.
+    """
+    tmp_path = db_path + '.tmp'
+    shutil.copyfile(db_path, tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            raise ValueError(f'{db_path} has schema version {version}, expected {SCHEMA_VERSION}; '
+                             'rebuild it with --build')
+        bulk_load_pragmas(conn)
+        if load_health_csv(conn, csv_file, mode) == 0:
+            raise ValueError(f'No rows loaded from {csv_file}')
+        create_fallbacks(conn)
+        create_distributions(conn)
+        conn.execute('ANALYZE')
+        conn.commit()
+        conn.execute('VACUUM')
+    except Exception:
+        conn.close()
+        os.remove(tmp_path)
+        raise
+    conn.close()
+
+    os.replace(tmp_path, db_path)
+
+def build_snapshot(snapshot_path=SNAPSHOT_PATH, source=None):
+    """Write the snapshot the API can load instead of the database.
+
+    source is a prebuilt database file or a directory of CSV files; by
+    default the database file if it exists and the CSV files otherwise.
+    The new file is opened and its checksum verified before this returns.
+    """
+    if source is None:
+        source = DB_PATH if os.path.exists(DB_PATH) else CSV_DIR
+    if os.path.isdir(source):
+        db = init_db(source, fallbacks=False)
+    else:
+        db = open_db(source)
+        if schema_version(db) != SCHEMA_VERSION:
+            raise ValueError(f'{source} has schema version {schema_version(db)}, expected '
+                             f'{SCHEMA_VERSION}; rebuild it with --build')
+    try:
+        for table in ('county_health_rankings', 'zip_county'):
+            if db.execute(f'SELECT COUNT(*) AS n FROM {table}').fetchone()['n'] == 0:
+                raise ValueError(f'No rows in {table}')
+        write_snapshot(db, snapshot_path)
+    finally:
+        db.close()
+    Snapshot(snapshot_path, verify=True)
+
 if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--build':
+        if len(sys.argv) > 4:
+            print("Usage: python3 csv_to_sqlite.py --build [<database_name>] [<csv_dir>]")
+            sys.exit(1)
+
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        db_name = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+        csv_dir = sys.argv[3] if len(sys.argv) > 3 else CSV_DIR
+
+        try:
+            build_database(db_name, csv_dir)
+            print(f"Built {db_name}")
+        except Exception as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(sys.argv) >= 2 and sys.argv[1] == '--snapshot':
+        if len(sys.argv) > 4:
+            print("Usage: python3 csv_to_sqlite.py --snapshot [<snapshot_name>] [<database_name>|<csv_dir>]")
+            sys.exit(1)
+
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        snapshot_name = sys.argv[2] if len(sys.argv) > 2 else SNAPSHOT_PATH
+
+        try:
+            build_snapshot(snapshot_name, sys.argv[3] if len(sys.argv) > 3 else None)
+            print(f"Built {snapshot_name}")
+        except Exception as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(sys.argv) >= 2 and sys.argv[1] == '--update':
+        args = [arg for arg in sys.argv[2:] if arg != '--append']
+        if len(args) != 2:
+            print("Usage: python3 csv_to_sqlite.py --update <database_name> <county_health_csv> [--append]")
+            sys.exit(1)
+
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        mode = 'append' if '--append' in sys.argv else 'upsert'
+
+        try:
+            update_database(args[0], args[1], mode)
+            print(f"Updated {args[0]}")
+        except Exception as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
     if len(sys.argv) != 3:
         print("Usage: python3 csv_to_sqlite.py <database_name> <csv_file>")
+        print("       python3 csv_to_sqlite.py --build [<database_name>] [<csv_dir>]")
+        print("       python3 csv_to_sqlite.py --update <database_name> <county_health_csv> [--append]")
+        print("       python3 csv_to_sqlite.py --snapshot [<snapshot_name>] [<database_name>|<csv_dir>]")
         sys.exit(1)
         
     db_name = sys.argv[1]
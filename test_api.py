@@ -2,7 +2,11 @@
 
 import requests
 import json
+import math
+import os
+import sqlite3
 import sys
+from array import array
 
 """
 Comprehensive test suite for the County Health Rankings API
@@ -83,6 +87,40 @@ def check_valid_data(response):
     
     return True
 
+def check_numeric_types(response):
+    """Check that numeric fields are JSON numbers (or null), not strings"""
+    data = response.json()
+    if not isinstance(data, list) or len(data) == 0:
+        print("Data should be a non-empty list")
+        return False
+    numeric_fields = ["Numerator", "Denominator", "Raw_value",
+                      "Confidence_Interval_Lower_Bound", "Confidence_Interval_Upper_Bound"]
+    for row in data:
+        for field in numeric_fields:
+            value = row.get(field)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                print(f"{field} should be a number or null, got: {value!r}")
+                return False
+        if not isinstance(row.get("Data_Release_Year"), int):
+            print(f"Data_Release_Year should be an integer, got: {row.get('Data_Release_Year')!r}")
+            return False
+        if not isinstance(row.get("fipscode"), str):
+            print(f"fipscode should stay a string, got: {row.get('fipscode')!r}")
+            return False
+    return True
+
+def check_county_key_join(response):
+    """Check that 02138 resolves to Middlesex County, MA (FIPS 25017)"""
+    data = response.json()
+    if not isinstance(data, list) or len(data) == 0:
+        print("Data should be a non-empty list")
+        return False
+    fipscodes = {row.get("fipscode") for row in data}
+    if fipscodes != {"25017"}:
+        print(f"Expected only Middlesex County (25017) rows, got: {fipscodes}")
+        return False
+    return True
+
 def check_sample_data(response):
     """Check if response contains sample data"""
     data = response.json()
@@ -119,14 +157,39 @@ tests = [
         "expected_status": 400
     },
     
-    # Test 5: Teapot Easter egg
+    # Test 5: Limit too large
+    {
+        "description": "Oversized limit",
+        "data": {"zip": "00801", "measure_name": "Premature Death", "limit": 10**30},
+        "expected_status": 400,
+        "check_fn": lambda response: response.json().get("error") == "Invalid limit parameter"
+    },
+
+    # Test 6: Teapot Easter egg
     {
         "description": "Teapot Easter egg",
         "data": {"zip": "00801", "measure_name": "Premature Death", "coffee": "teapot"},
         "expected_status": 418
     },
     
-    # Test 6: Sample mode
+    # Test 7: Numeric fields are returned as numbers
+    {
+        "description": "Numeric fields returned as JSON numbers",
+        "data": {"zip": "00801", "measure_name": "Premature Death"},
+        "expected_status": 200,
+        "check_fn": check_numeric_types
+    },
+
+    # Test 8: ZIP joined to its county by FIPS code (was a 404 when the
+    # county names didn't match exactly)
+    {
+        "description": "ZIP resolved through the county key",
+        "data": {"zip": "02138", "measure_name": "Adult obesity"},
+        "expected_status": 200,
+        "check_fn": check_county_key_join
+    },
+
+    # Test 9: Sample mode
     {
         "description": "Sample mode for non-existent data",
         "data": {"zip": "02138", "measure_name": "Physical inactivity", "sample_mode": True},
@@ -166,6 +229,528 @@ def test_auth_failure():
         print("❌ FAIL")
         return False
 
+# Run the batch endpoint test separately since it uses a different URL
+def test_batch():
+    print("\nTest: Batch lookup")
+    endpoint = API_URL
+    if not endpoint.endswith('/county_data'):
+        endpoint = f"{endpoint}/county_data"
+    endpoint = f"{endpoint}/batch"
+
+    print(f"Sending request to: {endpoint}")
+
+    try:
+        response = requests.post(
+            endpoint,
+            json={
+                "zips": ["00801", "02138", "99999", "abc"],
+                "measure_names": ["Premature Death", "Adult obesity", "Invalid Measure"]
+            },
+            headers={"Content-Type": "application/json", "X-API-Key": API_KEY}
+        )
+
+        print(f"Status code: {response.status_code} (Expected: 200)")
+
+        data = response.json()
+        # 99999 (unknown), abc (invalid) and the invalid measure are per-item errors
+        errors = {(e.get("zip"), e.get("measure_name")) for e in data.get("errors", [])}
+        expected_errors = {("99999", None), ("abc", None), (None, "Invalid Measure")}
+        if response.status_code == 200 and expected_errors <= errors and "00801" in data["results"]:
+            print("✅ PASS")
+            return True
+        else:
+            print("❌ FAIL")
+            return False
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        print("❌ FAIL")
+        return False
+
+# POST data to an endpoint under /county_data (path "" for /county_data itself)
+def post_json(path, data):
+    endpoint = API_URL
+    if not endpoint.endswith('/county_data'):
+        endpoint = f"{endpoint}/county_data"
+    return requests.post(
+        f"{endpoint}{path}",
+        json=data,
+        headers={"Content-Type": "application/json", "X-API-Key": API_KEY}
+    )
+
+def span_years(year_span):
+    """First and last year of a Year_span such as "2016-2018" or "2020"."""
+    years = [int(year) for year in year_span.split("-")]
+    return years[0], years[-1]
+
+# Year ranges, latest_only and trends over one county's rows of a measure
+def test_time_series():
+    print("\nTest: Year range, latest_only and trend")
+    query = {"zip": "02138", "measure_name": "Adult obesity", "limit": 100}
+
+    try:
+        response = post_json("", query)
+        if response.status_code != 200:
+            print(f"Full series: status {response.status_code} (Expected: 200)")
+            print("❌ FAIL")
+            return False
+        rows = response.json()
+        ok = True
+
+        # Only rows whose last year is in the range, in the same order
+        response = post_json("", dict(query, year_from=2017, year_to=2018))
+        expected = [row for row in rows if 2017 <= span_years(row["Year_span"])[1] <= 2018]
+        ranged = response.json() if response.status_code == 200 else []
+        if expected and ranged != expected:
+            print(f"year_from/year_to: got {[row['Year_span'] for row in ranged]}, "
+                  f"expected {[row['Year_span'] for row in expected]}")
+            ok = False
+        if not expected and response.status_code != 404:
+            print(f"year_from/year_to without rows: status {response.status_code} (Expected: 404)")
+            ok = False
+
+        response = post_json("", dict(query, latest_only=True))
+        if response.status_code != 200 or response.json() != rows[:1]:
+            print(f"latest_only should return only the newest row {rows[0]['Year_span']}")
+            ok = False
+
+        # The trend worked out from the rows: each Year_span once (its newest
+        # release) at the middle of its years, least-squares slope per year
+        points = {}
+        for row in rows:
+            if row["Raw_value"] is None:
+                continue
+            best = points.get(row["Year_span"])
+            if best is None or row["Data_Release_Year"] > best["Data_Release_Year"]:
+                points[row["Year_span"]] = row
+        series = sorted((sum(span_years(span)) / 2, row["Raw_value"]) for span, row in points.items())
+        expected_slope = None
+        if len(series) >= 2:
+            mean_year = sum(year for year, _ in series) / len(series)
+            mean_value = sum(value for _, value in series) / len(series)
+            spread = sum((year - mean_year) ** 2 for year, _ in series)
+            if spread:
+                expected_slope = sum((year - mean_year) * (value - mean_value)
+                                     for year, value in series) / spread
+
+        response = post_json("", dict(query, trend=True))
+        body = response.json() if response.status_code == 200 else {}
+        trend = body.get("trend", {})
+        if body.get("data") != rows:
+            print("trend: data should hold the same rows")
+            ok = False
+        if trend.get("points") != len(series) or len(trend.get("deltas", [])) != max(len(series) - 1, 0):
+            print(f"trend: expected {len(series)} points, got {trend}")
+            ok = False
+        slope = trend.get("slope_per_year")
+        if (slope is None) != (expected_slope is None) or (
+                slope is not None and abs(slope - expected_slope) > 1e-6):
+            print(f"trend: slope_per_year {slope}, expected {expected_slope}")
+            ok = False
+
+        # An empty range is a 404 listing the years that do have data
+        response = post_json("", dict(query, year_from=1900, year_to=1901))
+        if response.status_code != 404 or "available_years" not in response.json():
+            print(f"Empty year range: status {response.status_code} (Expected: 404 with available_years)")
+            ok = False
+
+        print("✅ PASS" if ok else "❌ FAIL")
+        return ok
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        print("❌ FAIL")
+        return False
+
+# Supported measures, i.e. what a "*" profile covers
+ALL_MEASURES = {
+    "Violent crime rate", "Unemployment", "Children in poverty", "Diabetic screening",
+    "Mammography screening", "Preventable hospital stays", "Uninsured",
+    "Sexually transmitted infections", "Physical inactivity", "Adult obesity",
+    "Premature Death", "Daily fine particulate matter",
+}
+
+def check_profile(body, zip_code, measures, limit):
+    """Check a county profile's shape and that it covers exactly the measures asked for"""
+    for field in ("zip", "county_key", "state_key", "measures", "missing_measures"):
+        if field not in body:
+            print(f"Missing profile field: {field}")
+            return False
+    if body["zip"] != zip_code:
+        print(f"zip should be {zip_code}, got {body['zip']}")
+        return False
+    found, missing = set(body["measures"]), set(body["missing_measures"])
+    if found & missing or found | missing != set(measures) or not found:
+        print(f"Profile measures {sorted(found)} / missing {sorted(missing)} don't match {sorted(measures)}")
+        return False
+    for measure, rows in body["measures"].items():
+        if not 0 < len(rows) <= limit:
+            print(f"{measure}: expected 1 to {limit} rows, got {len(rows)}")
+            return False
+        for row in rows:
+            if row["Measure_name"].lower() != measure.lower() or row["fipscode"] != body["county_key"]:
+                print(f"{measure}: row of another measure or county: {row}")
+                return False
+    return True
+
+# County profiles: a list of measures, or "*" for all of them
+def test_county_profile():
+    print("\nTest: County profile")
+
+    try:
+        ok = True
+        measures = ["Adult obesity", "Uninsured", "Premature Death"]
+        response = post_json("", {"zip": "02138", "measure_name": measures, "limit": 2})
+        if response.status_code != 200 or not check_profile(response.json(), "02138", measures, 2):
+            print(f"Measure list: status {response.status_code} (Expected: 200)")
+            ok = False
+
+        response = post_json("", {"zip": "02138", "measure_name": "*", "latest_only": True})
+        if response.status_code != 200 or not check_profile(response.json(), "02138", ALL_MEASURES, 1):
+            print(f'"*": status {response.status_code} (Expected: 200)')
+            ok = False
+
+        # One unknown measure fails the whole request
+        response = post_json("", {"zip": "02138", "measure_name": ["Adult obesity", "Invalid Measure"]})
+        if response.status_code != 400:
+            print(f"Unknown measure in list: status {response.status_code} (Expected: 400)")
+            ok = False
+
+        print("✅ PASS" if ok else "❌ FAIL")
+        return ok
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        print("❌ FAIL")
+        return False
+
+# The database file the API serves, for values worked out independently
+DB_PATH = os.environ.get('COUNTY_DB_PATH', os.path.join('csv_data', 'county_health.db'))
+
+def distribution(db, row, state_key):
+    """Sorted county values of a row's measure and year from county_distributions
+    (state_key "" for the national one)."""
+    found = db.execute(
+        "SELECT value_blob FROM county_distributions WHERE measure = ? AND release_year = ? "
+        "AND year_span = ? AND state_key = ?",
+        (row["Measure_name"].lower(), row["Data_Release_Year"], row["Year_span"], state_key)
+    ).fetchone()
+    values = array("d")
+    if found:
+        values.frombytes(found[0])
+        if sys.byteorder != "little":
+            values.byteswap()
+    return list(values)
+
+def expected_rank(values, value):
+    """Percent of values below value, ties counted as half, by counting."""
+    if not values or value is None:
+        return None
+    below = sum(1 for other in values if other < value)
+    equal = sum(1 for other in values if other == value)
+    return round(100 * (below + equal / 2) / len(values), 1)
+
+def single_county_zip(db, county_key):
+    """A ZIP code that lies only in the given county, or None."""
+    found = db.execute(
+        "SELECT zip FROM zip_county z WHERE county_key = ? AND NOT EXISTS ("
+        "SELECT 1 FROM zip_county o WHERE o.zip = z.zip AND o.county_key != z.county_key) LIMIT 1",
+        (county_key,)
+    ).fetchone()
+    return found[0] if found else None
+
+def check_ranks(db, zip_code, measure_name, state_key, match=None):
+    """Request a ZIP's rows with ranks and compare them with county_distributions.
+
+    Returns the number of rows checked (only rows match() accepts), or None on a mismatch.
+    """
+    response = post_json("", {"zip": zip_code, "measure_name": measure_name,
+                              "limit": 100, "percentile_rank": True})
+    if response.status_code != 200:
+        print(f"{zip_code} {measure_name}: status {response.status_code} (Expected: 200)")
+        return None
+    checked = 0
+    for row in response.json():
+        if match and not match(row):
+            continue
+        expected = (expected_rank(distribution(db, row, state_key), row["Raw_value"]),
+                    expected_rank(distribution(db, row, ""), row["Raw_value"]))
+        if expected[1] is None:
+            expected = (None, None)  # no national rank, no state rank either
+        got = (row.get("state_percentile_rank"), row.get("national_percentile_rank"))
+        if got != expected:
+            print(f"{zip_code} {measure_name} {row['Year_span']} ({row['Data_Release_Year']}): "
+                  f"ranks {got}, expected {expected}")
+            return None
+        checked += 1
+    return checked
+
+# State and national percentile ranks, checked against the database file
+def test_percentile_rank():
+    print("\nTest: Percentile ranks")
+    if not os.path.exists(DB_PATH):
+        print(f"{DB_PATH} not found (set COUNTY_DB_PATH to the server's database file)")
+        print("⏭️  SKIP")
+        return None
+
+    try:
+        db = sqlite3.connect(DB_PATH)
+        ok = True
+
+        # Every row of one county and measure
+        state_key = db.execute("SELECT state_key FROM zip_county WHERE zip = '02138'").fetchone()[0]
+        if not check_ranks(db, "02138", "Adult obesity", state_key):
+            ok = False
+
+        # A value several counties share: ties count as half
+        tie = db.execute(
+            "SELECT Measure_name, Data_Release_Year, Year_span, Raw_value, county_key, state_key "
+            "FROM county_health_rankings WHERE Raw_value IS NOT NULL AND county_key NOT GLOB '[0-9][0-9]000' "
+            "GROUP BY Measure_name, Data_Release_Year, Year_span, Raw_value "
+            "HAVING COUNT(DISTINCT county_key) > 1 LIMIT 20"
+        ).fetchall()
+        tie = [found for found in tie if single_county_zip(db, found[4])]
+        if not tie:
+            print("No tied values found in the database")
+            ok = False
+        else:
+            measure, release, span, value, county_key, tie_state = tie[0]
+            checked = check_ranks(
+                db, single_county_zip(db, county_key), measure, tie_state,
+                lambda row: (row["Data_Release_Year"], row["Year_span"], row["Raw_value"]) == (release, span, value)
+            )
+            if not checked:
+                print(f"Tied value {value} of {measure} ({span}) not checked")
+                ok = False
+
+        # A row without a value has no ranks
+        missing = db.execute(
+            "SELECT county_key, state_key, Measure_name FROM county_health_rankings "
+            "WHERE Raw_value IS NULL AND county_key NOT GLOB '[0-9][0-9]000'"
+        ).fetchall()
+        missing = [found for found in missing if found[2] in ALL_MEASURES and single_county_zip(db, found[0])]
+        if missing:
+            county_key, missing_state, measure = missing[0]
+            checked = check_ranks(db, single_county_zip(db, county_key), measure, missing_state,
+                                  lambda row: row["Raw_value"] is None)
+            if not checked:
+                print(f"Row without a value of {measure} in {county_key} not checked")
+                ok = False
+        else:
+            print("No rows without a value in the database; missing values not checked")
+
+        print("✅ PASS" if ok else "❌ FAIL")
+        return ok
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        print("❌ FAIL")
+        return False
+
+def find_place(body, name, state, kind="city"):
+    """The search result for a place, or None."""
+    for result in body.get("results", []):
+        if (result["type"], result["name"].lower(), result["state"]) == (kind, name.lower(), state):
+            return result
+    return None
+
+# Search for places by partial or misspelled city and county names
+def test_search():
+    print("\nTest: Place search")
+
+    try:
+        ok = True
+
+        # The start of a name
+        response = post_json("/search", {"query": "cambr", "state": "MA"})
+        body = response.json() if response.status_code == 200 else {}
+        cambridge = find_place(body, "Cambridge", "MA")
+        if not cambridge or cambridge["match"] != "prefix" or "02138" not in cambridge["zips"]:
+            print(f"Prefix query: status {response.status_code}, expected Cambridge, MA with 02138 as a prefix match")
+            ok = False
+
+        # A misspelling only the trigram matching can find
+        response = post_json("/search", {"query": "cambrige", "state": "MA", "type": "city"})
+        body = response.json() if response.status_code == 200 else {}
+        cambridge = find_place(body, "Cambridge", "MA")
+        if not cambridge or cambridge["match"] != "fuzzy" or not 0 < cambridge["score"] < 0.75:
+            print(f"Misspelled query: status {response.status_code}, expected a fuzzy match for Cambridge, MA")
+            ok = False
+
+        # Accents are ignored, on both sides
+        for query in ("anasco", "Añasco"):
+            response = post_json("/search", {"query": query, "type": "county", "state": "PR"})
+            body = response.json() if response.status_code == 200 else {}
+            anasco = find_place(body, "Añasco Municipio", "PR", "county")
+            if not anasco or anasco["match"] != "prefix" or "00610" not in anasco["zips"]:
+                print(f"{query}: status {response.status_code}, expected Añasco Municipio, PR as a prefix match")
+                ok = False
+
+        response = post_json("/search", {"query": "new", "limit": 3})
+        if response.status_code != 200 or not 0 < len(response.json()["results"]) <= 3:
+            print(f"limit 3: status {response.status_code}, expected 1 to 3 results")
+            ok = False
+
+        # Validation
+        for data in ({"query": ""}, {"query": "   "}, {"query": "cambr", "limit": 0},
+                     {"query": "cambr", "limit": 51}, {"query": "cambr", "type": "town"}):
+            response = post_json("/search", data)
+            if response.status_code != 400:
+                print(f"{data}: status {response.status_code} (Expected: 400)")
+                ok = False
+
+        print("✅ PASS" if ok else "❌ FAIL")
+        return ok
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        print("❌ FAIL")
+        return False
+
+# County centroids and adjacency for the nearby tests (approximate centroids
+# of the Massachusetts counties, plus two Alaska areas on either side of the
+# antimeridian)
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 6371.0088 * math.asin(min(1.0, math.sqrt(a)))
+
+def fixture_counties():
+    """{county_key: (lat, lon)} and {county_key: set of neighbors} from test_data"""
+    centroids = {}
+    with open(os.path.join(TEST_DATA_DIR, 'county_gazetteer.txt')) as f:
+        next(f)
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            centroids[fields[1]] = (float(fields[-2]), float(fields[-1]))
+    neighbors = {}
+    with open(os.path.join(TEST_DATA_DIR, 'county_adjacency.txt')) as f:
+        next(f)
+        for line in f:
+            fields = line.rstrip('\n').split('|')
+            if fields[1] != fields[3] and fields[3] in centroids:
+                neighbors.setdefault(fields[1], set()).add(fields[3])
+    return centroids, neighbors
+
+def brute_force(centroids, county_key):
+    """[(distance_km, county_key)] of every other county, nearest first"""
+    lat, lon = centroids[county_key]
+    return sorted((haversine_km(lat, lon, *centroids[other]), other)
+                  for other in centroids if other != county_key)
+
+def same_counties(found, expected):
+    """Whether two [(distance_km, county_key)] lists agree (distances to 0.01 km)"""
+    return len(found) == len(expected) and all(
+        key == other_key and abs(distance - other_distance) < 0.01
+        for (distance, key), (other_distance, other_key) in zip(found, expected))
+
+# geo.CountyIndex against brute force over the checked-in fixture (no server needed)
+def test_county_index():
+    print("\nTest: County index radius, nearest and adjacent")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api'))
+
+    try:
+        import dataset
+        from geo import CountyIndex
+
+        db = sqlite3.connect(':memory:')
+        db.row_factory = dataset.dict_factory
+        dataset.create_tables(db)
+        dataset.load_geo_files(db, TEST_DATA_DIR)
+        index = CountyIndex.from_db(db)
+        centroids, neighbors = fixture_counties()
+        ok = len(index) == len(centroids)
+
+        for county_key in centroids:
+            everything = brute_force(centroids, county_key)
+            for radius in (10, 50, 100, 200, 500, 5000, 20000):
+                if not same_counties(index.within(county_key, radius),
+                                     [item for item in everything if item[0] <= radius]):
+                    print(f"within({county_key}, {radius}) differs from brute force")
+                    ok = False
+            for k in range(1, len(centroids) + 1):
+                if not same_counties(index.nearest(county_key, k), everything[:k]):
+                    print(f"nearest({county_key}, {k}) differs from brute force")
+                    ok = False
+            adjacent = [item for item in everything if item[1] in neighbors.get(county_key, ())]
+            if not same_counties(index.adjacent(county_key), adjacent):
+                print(f"adjacent({county_key}) differs from the adjacency file")
+                ok = False
+
+        # The Aleutian areas are about 70 km apart across the antimeridian
+        if [key for _, key in index.within('02016', 100)] != ['02013']:
+            print("within() misses the county across the antimeridian")
+            ok = False
+
+        print("✅ PASS" if ok else "❌ FAIL")
+        return ok
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        print("❌ FAIL")
+        return False
+
+# Counties near a ZIP code's county.  The distance checks expect the server
+# to be built with the files in test_data/ as its county locations; without
+# any locations the endpoint must answer 501.
+def test_nearby():
+    print("\nTest: Nearby counties")
+    query = {"zip": "02138", "measure_name": "Adult obesity", "limit": 1}
+
+    try:
+        ok = True
+
+        # Validation comes first, whether or not locations are loaded
+        for data in (query, dict(query, radius_km=-5), dict(query, radius_km=0),
+                     dict(query, radius_km=5001), dict(query, k=3, radius_km=50),
+                     dict(query, k=0)):
+            response = post_json("/nearby", data)
+            if response.status_code != 400:
+                print(f"{data}: status {response.status_code} (Expected: 400)")
+                ok = False
+
+        response = post_json("/nearby", dict(query, k=3))
+        if response.status_code == 501:
+            if "error" not in response.json():
+                print("501 without an error message")
+                ok = False
+            print("No county locations on the server (501); distance checks not run")
+            print("✅ PASS" if ok else "❌ FAIL")
+            return ok
+
+        centroids, neighbors = fixture_counties()
+        everything = brute_force(centroids, "25017")  # 02138 is in Middlesex County
+        expected = {
+            "k": everything[:3],
+            "radius_km": [item for item in everything if item[0] <= 60],
+            "adjacent": [item for item in everything if item[1] in neighbors["25017"]],
+        }
+        for option, value in (("k", 3), ("radius_km", 60), ("adjacent", True)):
+            response = post_json("/nearby", dict(query, **{option: value}))
+            if response.status_code != 200:
+                print(f"{option}: status {response.status_code} (Expected: 200)")
+                ok = False
+                continue
+            counties = response.json()["counties"]
+            found = [(county["distance_km"], county["county_key"]) for county in counties]
+            if found[:1] != [(0.0, "25017")] or not same_counties(found[1:], expected[option]):
+                print(f"{option}: got {found}, expected Middlesex then {expected[option]}")
+                ok = False
+            if any(len(county["data"]) > 1 for county in counties):
+                print(f"{option}: more rows than the limit")
+                ok = False
+
+        print("✅ PASS" if ok else "❌ FAIL")
+        return ok
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        print("❌ FAIL")
+        return False
+
 # Run all tests
 def run_tests():
     results = []
@@ -183,12 +768,34 @@ def run_tests():
     
     # Run auth failure test
     results.append(test_auth_failure())
+
+    # Run batch endpoint test
+    results.append(test_batch())
+
+    # Run the time series test
+    results.append(test_time_series())
+
+    # Run the county profile test
+    results.append(test_county_profile())
+
+    # Run the percentile rank test (needs the database file, else skipped)
+    results.append(test_percentile_rank())
+
+    # Run the place search test
+    results.append(test_search())
+
+    # Run the county index test (offline) and the nearby endpoint test
+    results.append(test_county_index())
+    results.append(test_nearby())
     
     # Print summary
+    skipped = results.count(None)
     passed = results.count(True)
-    total = len(results)
+    total = len(results) - skipped
     print(f"\n----- TEST SUMMARY -----")
     print(f"Passed: {passed}/{total} tests ({passed/total*100:.1f}%)")
+    if skipped:
+        print(f"Skipped: {skipped}")
     
     if passed == total:
         print("✅ All tests passed! Your API meets all requirements.")